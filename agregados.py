@@ -0,0 +1,82 @@
+import pandas as pd
+
+# Agregado materializado de los indicadores por (código de operario, día, molde).
+# Estructura: {código: {(fecha, molde): [filas, suma producción, suma tiempo, suma retrabajo,
+#                                         suma real trabajada, filas con real trabajada]}}
+# Se agrupa primero por operario para que las consultas de un operario no recorran a los demás.
+
+COLUMNAS_AGREGADO = [
+    "Código", "Fecha", "Molde", "Filas", "Suma Producción", "Suma Tiempo",
+    "Suma Retrabajo", "Suma Real", "Filas Real",
+]
+
+
+def _sumas_por_clave(df):
+    # df con los indicadores ya numéricos (almacenamiento.preparar_final)
+    fechas = pd.to_datetime(df["Fecha"], errors="coerce")
+    produccion = pd.to_numeric(df["Indicador de Producción"], errors="coerce")
+    tiempo = pd.to_numeric(df["Indicador de Tiempo"], errors="coerce")
+    retrabajo = pd.to_numeric(df["Indicador Retrabajo"], errors="coerce")
+    real = produccion - tiempo - retrabajo
+
+    tabla = pd.DataFrame({
+        "Código": df["Código"].astype(str),
+        "Fecha": fechas.dt.date,
+        "Molde": df["Molde"].astype(object).fillna("").astype(str),
+        "Filas": 1,
+        "Suma Producción": produccion,
+        "Suma Tiempo": tiempo,
+        "Suma Retrabajo": retrabajo,
+        "Suma Real": real,
+        "Filas Real": real.notna().astype(int),
+    })[fechas.notna() & df["Código"].notna()]
+    return tabla.groupby(["Código", "Fecha", "Molde"]).sum()
+
+
+def actualizar_agregado(agregado, df, signo):
+    # signo 1 al guardar, -1 al eliminar; se recorren solo las claves afectadas
+    if df.empty:
+        return agregado
+    sumas_por_clave = _sumas_por_clave(df)
+    for (codigo, fecha, molde), sumas in zip(sumas_por_clave.index, sumas_por_clave.itertuples(index=False, name=None)):
+        por_operario = agregado.setdefault(codigo, {})
+        valores = por_operario.setdefault((fecha, molde), [0] * len(sumas))
+        for i, suma in enumerate(sumas):
+            valores[i] += signo * suma
+        if valores[0] <= 0:
+            del por_operario[(fecha, molde)]
+            if not por_operario:
+                del agregado[codigo]
+    return agregado
+
+
+def construir_agregado(df):
+    return actualizar_agregado({}, df, 1)
+
+
+def consultar_agregado(agregado, desde=None, hasta=None, codigo=None):
+    operarios = [str(codigo)] if codigo else list(agregado)
+    filas = [
+        (cod, fecha, molde, *valores)
+        for cod in operarios
+        for (fecha, molde), valores in agregado.get(cod, {}).items()
+        if (desde is None or fecha >= desde) and (hasta is None or fecha <= hasta)
+    ]
+    return pd.DataFrame(filas, columns=COLUMNAS_AGREGADO)
+
+
+def resumir_agregado(df_agregado, por=None):
+    # Promedio simple y porcentaje ponderado de la Producción Real Trabajada.
+    # Ponderado: horas reales trabajadas / (días con registro × 8 h), es decir suma real / días.
+    df = df_agregado.assign(Mes=pd.to_datetime(df_agregado["Fecha"]).dt.strftime("%Y-%m"))
+    grupos = df.groupby(por) if por else df.groupby(lambda _: "Total")
+    resumen = grupos.agg(
+        Días=("Fecha", "nunique"),
+        Registros=("Filas", "sum"),
+        suma_real=("Suma Real", "sum"),
+        filas_real=("Filas Real", "sum"),
+    )
+    resumen["Promedio Real (%)"] = resumen["suma_real"] / resumen["filas_real"].where(resumen["filas_real"] > 0)
+    resumen["Ponderado Real (%)"] = resumen["suma_real"] / resumen["Días"].where(resumen["Días"] > 0)
+    resumen["Horas Reales"] = resumen["suma_real"] / 100 * 8
+    return resumen.drop(columns=["suma_real", "filas_real"]).reset_index()
@@ -0,0 +1,1303 @@
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from numbers import Number
+from xml.sax.saxutils import escape, unescape
+
+import pandas as pd
+
+import metricas
+from agregados import actualizar_agregado, construir_agregado, consultar_agregado
+from instantanea import actualizar_instantanea, categorizar, escribir_instantanea, leer_instantanea
+from lectura import HojaNoEncontrada, leer_hojas, ruta_hoja
+
+HOJA_FINAL = "FINAL"
+
+# Columnas que escribe el formulario en la hoja FINAL, en su orden original
+COLUMNAS_FINAL = [
+    "Fecha", "Molde", "Moldes/Persona", "Código", "Nombre", "Tiempo Usado",
+    "Indicador de Producción", "Pieza", "Parte", "Cantidad", "Cantidad KG",
+    "Tiempo en Minutos", "Indicador de Tiempo", "Molde Retrabajo",
+    "Linea Retrabajo", "Tiempo Retrabajo (minutos)", "Indicador Retrabajo", "ID Envío",
+]
+
+# Identificador estable de cada envío del formulario (todas sus filas lo comparten):
+# "AAAAMMDD-xxxxxxxx" con el día de producción. Los registros anteriores a esta columna
+# reciben al leerlos uno derivado de su Fecha ("AAAAMMDD-HHMMSSmmm").
+COLUMNA_ID = "ID Envío"
+
+HOJAS_MAESTRAS = ["Base_Produccion", "Tiempo_Fallas", "Operarios"]
+
+# Columnas de las hojas maestras que usa la app (indices.construir_indices y construir_opciones)
+COLUMNAS_MAESTRAS = {
+    "Base_Produccion": ["COD MAT", "MOLDES/TURNO", "PERSONAS/MOLDE"],
+    "Tiempo_Fallas": ["CODIGO", "PARTE MOLDE", "CANTIDAD KG", "TIEMPO (MIN)", "LINEA"],
+    "Operarios": ["CÓDIGO", "OPERARIO"],
+}
+
+# Tipos explícitos del lector rápido (lectura.leer_hojas); las demás columnas, como vienen.
+# Los indicadores quedan como vienen porque los antiguos son texto ("87.5%").
+TIPOS_LECTURA = {
+    "Fecha": "fecha", "Código": "texto", "ID Envío": "texto", "Moldes/Persona": "numero",
+    "Tiempo Usado": "numero", "Cantidad": "numero", "Cantidad KG": "numero",
+    "Tiempo en Minutos": "numero", "Tiempo Retrabajo (minutos)": "numero",
+    "COD MAT": "texto", "MOLDES/TURNO": "numero", "PERSONAS/MOLDE": "numero",
+    "CODIGO": "texto", "CANTIDAD KG": "numero", "TIEMPO (MIN)": "numero", "CÓDIGO": "texto",
+}
+
+# Tipos de columna del backend SQLite
+TIPOS_SQL = {
+    "Fecha": "TEXT", "Molde": "TEXT", "Moldes/Persona": "REAL", "Código": "TEXT",
+    "Nombre": "TEXT", "Tiempo Usado": "REAL", "Indicador de Producción": "REAL",
+    "Pieza": "TEXT", "Parte": "TEXT", "Cantidad": "INTEGER", "Cantidad KG": "REAL",
+    "Tiempo en Minutos": "REAL", "Indicador de Tiempo": "REAL", "Molde Retrabajo": "TEXT",
+    "Linea Retrabajo": "TEXT", "Tiempo Retrabajo (minutos)": "INTEGER", "Indicador Retrabajo": "REAL",
+    "ID Envío": "TEXT",
+}
+
+# Indicadores en porcentaje (0-100). Los registros nuevos los guardan como número;
+# los antiguos los tienen como texto "87.5%" y se convierten al leer.
+COLUMNAS_INDICADORES = ["Indicador de Producción", "Indicador de Tiempo", "Indicador Retrabajo"]
+
+# Almacén particionado: meses que siguen abiertos (el actual y el anterior, para los partes
+# que se transcriben tarde); los anteriores se cierran como particiones de solo lectura
+MESES_ABIERTOS = 2
+SIN_FECHA = "sin_fecha"
+
+# Las eliminaciones dejan una lápida (el ID del envío en <almacén>.bajas) que los lectores
+# filtran; cuando las lápidas superan esta proporción de los envíos conviene reescribir el
+# almacén sin esas filas con "python almacenamiento.py compactar", fuera del horario de carga
+# (la reescritura toma el candado y detiene los guardados mientras dura; el panel de
+# administración avisa cuando hace falta). Mientras tanto las filas eliminadas siguen en el
+# libro (o en la partición) y el archivo .bajas, un ID por línea, es la única constancia de la
+# eliminación:
+#   - se respalda y se copia siempre junto con el almacén (BASE_FINAL.xlsx.bajas, historial.bajas);
+#   - si se pierde o se borra, los envíos eliminados vuelven a aparecer;
+#   - quien abra el libro en Excel ve también las filas eliminadas; antes de usarlo fuera de la
+#     aplicación conviene "python almacenamiento.py compactar" o exportar con "exportar".
+# SQLite borra las filas directamente y no usa lápidas.
+UMBRAL_COMPACTACION = 0.05
+_PATRON_PARTICION = re.compile(r"^FINAL_(\d{4}-\d{2}|sin_fecha)(\.cerrada)?\.xlsx$")
+
+_FORMATO_FECHA_SQL = "%Y-%m-%d %H:%M:%S.%f"
+_EPOCA_EXCEL = datetime(1899, 12, 30)
+
+
+def indicador_numerico(serie):
+    # Versión vectorizada de parse_percent: "87.5%" -> 87.5, números se conservan,
+    # vacíos quedan NaN y el texto que no se puede interpretar vale 0.0
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float)
+    valores = pd.to_numeric(serie.astype(str).str.strip().str.rstrip("%"), errors="coerce")
+    return valores.mask(valores.isna() & serie.notna(), 0.0)
+
+
+def preparar_final(df):
+    # Tipos de lectura comunes a todos los backends
+    if df.empty:
+        return df
+    if not pd.api.types.is_datetime64_any_dtype(df["Fecha"]):
+        df["Fecha"] = pd.to_datetime(df["Fecha"], errors="coerce")
+    for columna in COLUMNAS_INDICADORES:
+        if columna in df.columns:
+            df[columna] = indicador_numerico(df[columna])
+    if COLUMNA_ID not in df.columns:
+        df[COLUMNA_ID] = None
+    sin_id = df[COLUMNA_ID].isna()
+    if sin_id.any():
+        df[COLUMNA_ID] = df[COLUMNA_ID].astype(object)
+        df.loc[sin_id, COLUMNA_ID] = id_legado(df.loc[sin_id, "Fecha"])
+    return df
+
+
+def nuevo_id_envio(dia):
+    return f"{dia:%Y%m%d}-{uuid.uuid4().hex[:8]}"
+
+
+def id_legado(fechas):
+    # Registros guardados antes de la columna de ID: el envío se identificaba por su Fecha
+    return fechas.dt.strftime("%Y%m%d-%H%M%S%f").str[:-3]
+
+
+def dia_de_envio(id_envio):
+    return datetime.strptime(str(id_envio)[:8], "%Y%m%d").date()
+
+
+def firma_archivo(ruta):
+    # (mtime, tamaño) identifica la versión del archivo sin tener que abrirlo
+    try:
+        estado = os.stat(ruta)
+    except OSError:
+        return None
+    return estado.st_mtime_ns, estado.st_size
+
+
+def leer_maestros(ruta):
+    # Las tres hojas en una sola pasada por el libro, solo con las columnas que se usan
+    hojas = leer_hojas(ruta, COLUMNAS_MAESTRAS, TIPOS_LECTURA)
+    return hojas["Base_Produccion"], hojas["Tiempo_Fallas"], hojas["Operarios"]
+
+
+def ruta_maestros(ruta_libro, existente=True):
+    # Libro propio de datos maestros (YESERIA_MAESTROS, por defecto MAESTROS.xlsx junto al libro
+    # de registros); mientras no exista se siguen leyendo las hojas maestras del libro de registros
+    ruta = os.environ.get("YESERIA_MAESTROS") or os.path.join(
+        os.path.dirname(os.path.abspath(ruta_libro)), "MAESTROS.xlsx"
+    )
+    if existente and not os.path.exists(ruta):
+        return ruta_libro
+    return ruta
+
+
+class AlmacenRegistros:
+    # Interfaz común de los backends que guardan los registros de producción (hoja FINAL).
+    # Los datos maestros viven en un libro de Excel para todos los backends (ver ruta_maestros).
+    # La lectura completa se guarda en memoria por proceso y se invalida cuando cambia la firma.
+
+    _cache = {}
+    _derivados = {}
+    _candado_cache = threading.Lock()
+
+    def __init__(self, ruta_libro):
+        self.ruta_libro = ruta_libro
+
+    def clave(self):
+        raise NotImplementedError
+
+    def firma(self):
+        raise NotImplementedError
+
+    def _leer_todo(self):
+        raise NotImplementedError
+
+    def _agregar(self, df_nuevo):
+        raise NotImplementedError
+
+    def _filas_envio(self, id_envio):
+        # Filas de un envío sin copiar el historial: el conteo de envíos descarta los IDs que no
+        # existen y las filas se toman de la lectura en memoria
+        df = self._lectura()
+        if id_envio not in self._derivado("envios"):
+            return df.iloc[:0]
+        return df[df[COLUMNA_ID] == id_envio]
+
+    def _eliminar_envio(self, id_envio):
+        # Por defecto se deja una lápida y las filas siguen en el almacén hasta la compactación.
+        # Devuelve las filas eliminadas completas.
+        eliminadas = self._filas_envio(id_envio)
+        if not eliminadas.empty:
+            with open(self.ruta_bajas(), "a", encoding="utf-8") as archivo:
+                archivo.write(f"{id_envio}\n")
+                archivo.flush()
+                os.fsync(archivo.fileno())
+        return eliminadas
+
+    def _compactar(self, bajas):
+        # Reescribe el almacén sin las filas de los envíos con lápida
+        raise NotImplementedError
+
+    def _reemplazar_todo(self, df):
+        raise NotImplementedError
+
+    def migrar_indicadores(self):
+        # Reescribe una sola vez los indicadores antiguos en texto como columnas numéricas
+        df = self.leer_final()
+        try:
+            self._reemplazar_todo(df)
+        finally:
+            self.invalidar()
+        return len(df)
+
+    def agregar(self, df_nuevo):
+        firma_antes = self.firma()
+        try:
+            self._agregar(df_nuevo)
+        finally:
+            self.invalidar()
+        self._actualizar_derivados(firma_antes, df_nuevo, 1)
+
+    def eliminar_envio(self, id_envio):
+        firma_antes = self.firma()
+        try:
+            eliminadas = self._eliminar_envio(id_envio)
+        except Exception:
+            self.invalidar()
+            raise
+        self._pasar_cache(firma_antes, {id_envio})
+        self._actualizar_derivados(firma_antes, eliminadas, -1)
+        return len(eliminadas)
+
+    def ruta_bajas(self):
+        return self.clave()[1] + ".bajas"
+
+    def bajas(self):
+        # IDs de los envíos eliminados que todavía siguen físicamente en el almacén
+        try:
+            with open(self.ruta_bajas(), encoding="utf-8") as archivo:
+                return {linea.strip() for linea in archivo if linea.strip()}
+        except FileNotFoundError:
+            return set()
+
+    def _borrar_bajas(self):
+        # Después de reescribir el almacén sin esos envíos las lápidas ya no hacen falta
+        if os.path.exists(self.ruta_bajas()):
+            os.remove(self.ruta_bajas())
+
+    def _sin_bajas(self, df, bajas=None):
+        bajas = self.bajas() if bajas is None else bajas
+        if df.empty or not bajas:
+            return df
+        return df[~df[COLUMNA_ID].isin(bajas)].reset_index(drop=True)
+
+    def requiere_compactacion(self):
+        # Con el conteo de envíos (un derivado más): no se relee el historial en cada eliminación
+        bajas = self.bajas()
+        if not bajas:
+            return False
+        vivos = len(self._derivado("envios"))
+        return len(bajas) / (len(bajas) + vivos) >= UMBRAL_COMPACTACION
+
+    def compactar(self):
+        # Los datos visibles no cambian, solo la firma: cachés, derivados e instantánea se
+        # pasan a la firma nueva sin releer el almacén
+        bajas = self.bajas()
+        if not bajas:
+            return 0
+        firma_antes = self.firma()
+        try:
+            self._compactar(bajas)
+            self._borrar_bajas()
+        except Exception:
+            self.invalidar()
+            raise
+        self._pasar_cache(firma_antes)
+        self._actualizar_derivados(firma_antes, pd.DataFrame(columns=COLUMNAS_FINAL), -1)
+        return len(bajas)
+
+    def exportar_excel(self, destino=None):
+        # Devuelve los registros a la hoja FINAL para quienes siguen usando la planilla
+        df = self.leer_final()
+        reescribir_final(destino or self.ruta_libro, df)
+        return len(df)
+
+    def ruta_maestros(self):
+        return ruta_maestros(self.ruta_libro)
+
+    def leer_maestros(self):
+        return leer_maestros(self.ruta_maestros())
+
+    def ruta_candado(self):
+        # Archivo auxiliar sobre el que se toma el candado de escritura entre procesos
+        return self.clave()[1] + ".lock"
+
+    def ruta_instantanea(self):
+        return self.clave()[1] + ".arrow"
+
+    def ruta_calidad(self):
+        return self.clave()[1] + ".calidad.json"
+
+    def meses_crudos(self):
+        # (mes, firma, origen) para el revisor de calidad (calidad.py), sin leer el historial:
+        # cada proceso del pool lee su origen con leer_crudo. Con mes None el origen es todo el
+        # historial y el proceso que lo revisa lo separa por meses y calcula sus firmas.
+        raise NotImplementedError
+
+    def leer_final(self, columnas=None):
+        # Caché en memoria -> instantánea columnar (instantanea.py) -> lectura completa del almacén
+        df = self._lectura(columnas)
+        # Copia para que las vistas de la aplicación puedan agregar columnas sin tocar el caché
+        return (df if columnas is None else df[columnas]).copy()
+
+    def _lectura(self, columnas=None):
+        # La lectura en memoria sin copiar, para las consultas internas que no la modifican
+        firma = self.firma()
+        guardado = self._cache.get(self.clave())
+        metricas.contar_cache("final", guardado is not None and guardado[0] == firma)
+        if guardado is None or guardado[0] != firma:
+            if columnas is not None:
+                # Con el caché vacío, una proyección se lee de la instantánea sin cargar el resto
+                df = leer_instantanea(self.ruta_instantanea(), firma, columnas)
+                metricas.contar_cache("instantanea", df is not None)
+                if df is not None:
+                    return df
+            guardado = (firma, self._cargar(firma))
+            with self._candado_cache:
+                self._cache[self.clave()] = guardado
+        return guardado[1]
+
+    def _cargar(self, firma):
+        df = leer_instantanea(self.ruta_instantanea(), firma)
+        metricas.contar_cache("instantanea", df is not None)
+        if df is None:
+            with metricas.fase("leer_final_almacen"):
+                df = categorizar(self._sin_bajas(preparar_final(self._leer_todo())))
+            escribir_instantanea(self.ruta_instantanea(), firma, df)
+        return df
+
+    def invalidar(self):
+        with self._candado_cache:
+            self._cache.pop(self.clave(), None)
+
+    def _pasar_cache(self, firma_antes, quitar=()):
+        # Después de una eliminación o una compactación propias la lectura en memoria pasa a la
+        # firma nueva sin las filas de los envíos quitados, en lugar de releer el almacén
+        firma_despues = self.firma()
+        with self._candado_cache:
+            guardado = self._cache.pop(self.clave(), None)
+            if guardado is None or guardado[0] != firma_antes:
+                return
+            df = guardado[1]
+            if quitar:
+                df = df[~df[COLUMNA_ID].isin(quitar)].reset_index(drop=True)
+            self._cache[self.clave()] = (firma_despues, df)
+
+    def _derivado(self, nombre):
+        # Estructuras derivadas de FINAL (ver _DERIVADOS). Se construyen una vez por versión de
+        # los datos y nuestras propias escrituras las actualizan en lugar de reconstruirlas.
+        firma = self.firma()
+        guardado = self._derivados.get((self.clave(), nombre))
+        metricas.contar_cache(nombre, guardado is not None and guardado[0] == firma)
+        if guardado is None or guardado[0] != firma:
+            construir, _ = _DERIVADOS[nombre]
+            guardado = (firma, construir(self.leer_final()))
+            with self._candado_cache:
+                self._derivados[(self.clave(), nombre)] = guardado
+        return guardado[1]
+
+    def _actualizar_derivados(self, firma_antes, df_cambio, signo):
+        df_cambio = preparar_final(df_cambio.copy())
+        firma_despues = self.firma()
+        with self._candado_cache:
+            for nombre, (_, actualizar) in _DERIVADOS.items():
+                guardado = self._derivados.pop((self.clave(), nombre), None)
+                if guardado is None or guardado[0] != firma_antes:
+                    continue
+                self._derivados[(self.clave(), nombre)] = (firma_despues, actualizar(guardado[1], df_cambio, signo))
+        actualizar_instantanea(self.ruta_instantanea(), firma_antes, firma_despues, df_cambio, signo)
+
+    def registrados(self):
+        # Conteo de registros por (código de operario, día de producción)
+        return self._derivado("registrados")
+
+    def ya_registrados(self, codigos, fecha):
+        # Verificación por lotes: códigos que ya tienen registro en esa fecha
+        conteo = self.registrados()
+        return [codigo for codigo in codigos if conteo[(str(codigo), fecha)] > 0]
+
+    def agregado(self, desde=None, hasta=None, codigo=None):
+        # Filas del agregado (código, día, molde) en el rango; no toca el historial completo
+        agregado = self._derivado("agregado")
+        with self._candado_cache:
+            return consultar_agregado(agregado, desde, hasta, codigo)
+
+    def meses_cerrados(self):
+        # Meses ("%Y-%m") que ya no admiten escrituras; solo el almacén particionado los tiene
+        return set()
+
+    def hay_registros(self):
+        return not self._lectura().empty
+
+    def buscar(self, desde=None, hasta=None, codigo=None, molde=None):
+        return _filtrar(self.leer_final(), desde, hasta, codigo, molde)
+
+    def iterar(self, desde=None, hasta=None, codigo=None, columnas=None, tamano=5000):
+        # Resultados de buscar() por bloques de a lo sumo `tamano` filas, del más reciente al más
+        # antiguo. Aquí el historial ya está en memoria (caché o instantánea) y solo se copian las
+        # columnas pedidas; los backends que pueden leer por partes lo redefinen.
+        if columnas is not None:
+            columnas = list(dict.fromkeys(["Fecha", "Código", *columnas]))
+        yield from _en_bloques(_filtrar(self.leer_final(columnas), desde, hasta, codigo), columnas, tamano)
+
+    def pagina(self, inicio, cantidad, orden="Fecha", descendente=True, **filtros):
+        # Filtra y ordena en el servidor y devuelve solo la porción visible junto al total
+        if orden not in COLUMNAS_FINAL:
+            raise ValueError(f"Columna de orden desconocida: {orden}")
+        df = self.buscar(**filtros)
+        if df.empty:
+            return df, 0
+        df = df.sort_values(orden, ascending=not descendente, kind="stable")
+        return df.iloc[inicio:inicio + cantidad].reset_index(drop=True), len(df)
+
+    def envios(self, dia, codigo=None, limite=50):
+        # Envíos del día agrupados por su ID, del más reciente al más antiguo
+        df = self.buscar(dia, dia)
+        if df.empty:
+            return pd.DataFrame(columns=[COLUMNA_ID, "Fecha", "Molde", "Códigos", "Filas"])
+        df = df.assign(Código=df["Código"].astype(str))
+        if codigo:
+            df = df[df[COLUMNA_ID].isin(df.loc[df["Código"] == str(codigo), COLUMNA_ID])]
+        resumen = df.groupby(COLUMNA_ID).agg(
+            Fecha=("Fecha", "first"), Molde=("Molde", "first"), Códigos=("Código", ", ".join), Filas=("Código", "size")
+        )
+        return resumen.sort_values("Fecha", ascending=False).head(limite).reset_index()
+
+
+class AlmacenExcel(AlmacenRegistros):
+    # Comportamiento original: la hoja FINAL del mismo libro es el almacén transaccional
+
+    def clave(self):
+        return ("xlsx", os.path.abspath(self.ruta_libro))
+
+    def firma(self):
+        return firma_archivo(self.ruta_libro), firma_archivo(self.ruta_bajas())
+
+    def _leer_todo(self):
+        return leer_final_sin_cache(self.ruta_libro)
+
+    def meses_crudos(self):
+        # La hoja no se puede leer por meses: un solo origen, fuera del proceso de la app
+        return [(None, None, self.ruta_libro)]
+
+    def _agregar(self, df_nuevo):
+        agregar_filas_final(self.ruta_libro, df_nuevo)
+
+    def _reemplazar_todo(self, df):
+        reescribir_final(self.ruta_libro, df)
+        self._borrar_bajas()
+
+    def _compactar(self, bajas):
+        # leer_final ya viene sin las filas con lápida
+        reescribir_final(self.ruta_libro, self.leer_final())
+
+
+class AlmacenSQLite(AlmacenRegistros):
+    # Registros en una base SQLite embebida con índices por (Código, Fecha) y por Fecha
+
+    def __init__(self, ruta_libro, ruta_db):
+        super().__init__(ruta_libro)
+        self.ruta_db = ruta_db
+        with self._transaccion() as con:
+            self._crear_esquema(con)
+            con.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor INTEGER NOT NULL)")
+            con.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+            self._agregar_ids(con)
+
+    def _crear_esquema(self, con):
+        columnas = ", ".join(f'"{columna}" {tipo}' for columna, tipo in TIPOS_SQL.items())
+        con.execute(f"CREATE TABLE IF NOT EXISTS final (id INTEGER PRIMARY KEY, {columnas})")
+        con.execute('CREATE INDEX IF NOT EXISTS idx_final_codigo_fecha ON final ("Código", "Fecha")')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_final_fecha ON final ("Fecha")')
+
+    def _agregar_ids(self, con):
+        # Bases creadas antes de la columna de ID: se agrega y se completa una sola vez
+        existentes = {fila[1] for fila in con.execute("PRAGMA table_info(final)")}
+        if COLUMNA_ID not in existentes:
+            con.execute(f'ALTER TABLE final ADD COLUMN "{COLUMNA_ID}" TEXT')
+        sin_id = pd.read_sql_query(f'SELECT id, "Fecha" FROM final WHERE "{COLUMNA_ID}" IS NULL', con)
+        if not sin_id.empty:
+            ids = id_legado(pd.to_datetime(sin_id["Fecha"], format="ISO8601", errors="coerce"))
+            con.executemany(
+                f'UPDATE final SET "{COLUMNA_ID}" = ? WHERE id = ?',
+                [(None if pd.isna(valor) else valor, int(fila)) for valor, fila in zip(ids, sin_id["id"])],
+            )
+            self._cerrar_escritura(con)
+        con.execute(f'CREATE INDEX IF NOT EXISTS idx_final_id ON final ("{COLUMNA_ID}")')
+
+    def _conectar(self):
+        return _conectar_sqlite(self.ruta_db)
+
+    @contextmanager
+    def _transaccion(self):
+        con = self._conectar()
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def _cerrar_escritura(self, con):
+        # La versión sube en la misma transacción que la escritura y sirve de firma
+        con.execute("UPDATE meta SET valor = valor + 1 WHERE clave = 'version'")
+
+    def clave(self):
+        return ("sqlite", os.path.abspath(self.ruta_db))
+
+    def firma(self):
+        con = self._conectar()
+        try:
+            return con.execute("SELECT valor FROM meta WHERE clave = 'version'").fetchone()[0]
+        finally:
+            con.close()
+
+    def _consultar(self, where="", parametros=(), orden="ORDER BY id"):
+        return _consultar_sqlite(self.ruta_db, where, parametros, orden)
+
+    def _leer_todo(self):
+        return self._consultar()
+
+    def meses_crudos(self):
+        # Las filas no se modifican en el lugar (solo se agregan o se borran): la cantidad, la
+        # suma y el máximo de los id de cada mes cambian con cualquier escritura en ese mes
+        con = self._conectar()
+        try:
+            meses = con.execute(
+                f"SELECT CASE WHEN {_FECHA_SQL_VALIDA} THEN substr(\"Fecha\", 1, 7) ELSE ? END AS mes, "
+                "COUNT(*), SUM(id), MAX(id) FROM final GROUP BY mes ORDER BY mes",
+                (SIN_FECHA,),
+            ).fetchall()
+        finally:
+            con.close()
+        return [(mes, repr(tuple(firma)), (self.ruta_db, mes)) for mes, *firma in meses]
+
+    def hay_registros(self):
+        con = self._conectar()
+        try:
+            return bool(con.execute("SELECT EXISTS (SELECT 1 FROM final)").fetchone()[0])
+        finally:
+            con.close()
+
+    def _where(self, desde=None, hasta=None, codigo=None, molde=None):
+        condiciones, parametros = [], []
+        if codigo:
+            condiciones.append('"Código" = ?')
+            parametros.append(str(codigo))
+        if molde:
+            condiciones.append('"Molde" = ?')
+            parametros.append(str(molde))
+        if desde is not None:
+            condiciones.append('"Fecha" >= ?')
+            parametros.append(desde.strftime("%Y-%m-%d"))
+        if hasta is not None:
+            condiciones.append('"Fecha" < ?')
+            parametros.append((hasta + timedelta(days=1)).strftime("%Y-%m-%d"))
+        where = "WHERE " + " AND ".join(condiciones) if condiciones else ""
+        return where, parametros
+
+    def buscar(self, desde=None, hasta=None, codigo=None, molde=None):
+        return self._consultar(*self._where(desde, hasta, codigo, molde))
+
+    def pagina(self, inicio, cantidad, orden="Fecha", descendente=True, **filtros):
+        # LIMIT/OFFSET en SQL: solo la página pedida sale de la base
+        if orden not in COLUMNAS_FINAL:
+            raise ValueError(f"Columna de orden desconocida: {orden}")
+        where, parametros = self._where(**filtros)
+        con = self._conectar()
+        try:
+            total = con.execute(f"SELECT COUNT(*) FROM final {where}", parametros).fetchone()[0]
+        finally:
+            con.close()
+        sentido = "DESC" if descendente else "ASC"
+        df = self._consultar(
+            where, [*parametros, cantidad, inicio], f'ORDER BY "{orden}" {sentido}, id {sentido} LIMIT ? OFFSET ?'
+        )
+        return df, total
+
+    def iterar(self, desde=None, hasta=None, codigo=None, columnas=None, tamano=5000):
+        # Un solo cursor ordenado por Fecha; cada bloque sale de la base con fetchmany
+        columnas = COLUMNAS_FINAL if columnas is None else list(dict.fromkeys(["Fecha", *columnas]))
+        where, parametros = self._where(desde, hasta, codigo)
+        lista = ", ".join(f'"{columna}"' for columna in columnas)
+        con = self._conectar()
+        try:
+            cursor = con.execute(f'SELECT {lista} FROM final {where} ORDER BY "Fecha" DESC, id DESC', parametros)
+            while True:
+                filas = cursor.fetchmany(tamano)
+                if not filas:
+                    return
+                df = pd.DataFrame(filas, columns=columnas)
+                df["Fecha"] = pd.to_datetime(df["Fecha"], format="ISO8601", errors="coerce")
+                yield preparar_final(df)
+        finally:
+            con.close()
+
+    def _insertar(self, con, df_nuevo):
+        filas = [
+            tuple(_valor_sql(columna, valor) for columna, valor in zip(COLUMNAS_FINAL, fila))
+            for fila in df_nuevo.reindex(columns=COLUMNAS_FINAL).itertuples(index=False)
+        ]
+        columnas = ", ".join(f'"{columna}"' for columna in COLUMNAS_FINAL)
+        marcas = ", ".join("?" for _ in COLUMNAS_FINAL)
+        con.executemany(f"INSERT INTO final ({columnas}) VALUES ({marcas})", filas)
+
+    def _agregar(self, df_nuevo):
+        with self._transaccion() as con:
+            self._insertar(con, df_nuevo)
+            self._cerrar_escritura(con)
+
+    def _reemplazar_todo(self, df):
+        # Se recrea la tabla para que tome los tipos actuales de TIPOS_SQL
+        with self._transaccion() as con:
+            con.execute("DROP TABLE IF EXISTS final")
+            self._crear_esquema(con)
+            self._insertar(con, df)
+            self._cerrar_escritura(con)
+
+    def _eliminar_envio(self, id_envio):
+        # Con el índice por ID el borrado directo ya es barato: SQLite no usa lápidas
+        eliminadas = self._consultar(f'WHERE "{COLUMNA_ID}" = ?', (id_envio,))
+        with self._transaccion() as con:
+            con.execute(f'DELETE FROM final WHERE "{COLUMNA_ID}" = ?', (id_envio,))
+            self._cerrar_escritura(con)
+        return eliminadas
+
+    def importar_excel(self, reemplazar=False):
+        # Importación única desde la hoja FINAL del libro (sin los envíos con lápida)
+        df = AlmacenExcel(self.ruta_libro).leer_final()
+        with self._transaccion() as con:
+            existentes = con.execute("SELECT COUNT(*) FROM final").fetchone()[0]
+            if existentes and not reemplazar:
+                raise ValueError(f"La base {self.ruta_db} ya tiene {existentes} registros; use --reemplazar")
+            con.execute("DELETE FROM final")
+            self._insertar(con, df)
+            self._cerrar_escritura(con)
+        return len(df)
+
+
+class RegistradosPorMes:
+    # Se consulta igual que el conteo de registrados (conteo[(código, día)]), pero cada
+    # consulta abre solo la partición del mes de ese día
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self._archivos = almacen._archivos()
+        self._meses = {}
+
+    def __getitem__(self, par):
+        codigo, dia = par
+        if dia is None or pd.isna(dia):
+            return 0
+        mes = mes_de(dia)
+        if mes not in self._meses:
+            self._meses[mes] = self.almacen._registrados_mes(mes, self._archivos.get(mes))
+        return self._meses[mes][(str(codigo), dia)]
+
+
+class AlmacenParticionado(AlmacenRegistros):
+    # Registros repartidos en un libro por mes dentro de una carpeta:
+    #   FINAL_2026-10.xlsx          partición abierta (admite guardados y eliminaciones)
+    #   FINAL_2026-07.cerrada.xlsx  partición cerrada, de solo lectura
+    # Las consultas por rango de fechas abren solo los meses del rango, y cada partición se
+    # guarda en memoria por separado: después de un guardado solo se relee el mes tocado.
+
+    _particiones = {}
+
+    def __init__(self, ruta_libro, carpeta):
+        super().__init__(ruta_libro)
+        self.carpeta = carpeta
+        os.makedirs(carpeta, exist_ok=True)
+
+    def clave(self):
+        return ("particiones", os.path.abspath(self.carpeta))
+
+    def _archivos(self):
+        # mes -> (ruta, cerrada)
+        archivos = {}
+        for entrada in os.scandir(self.carpeta):
+            coincide = _PATRON_PARTICION.match(entrada.name)
+            if coincide:
+                archivos[coincide.group(1)] = (entrada.path, coincide.group(2) is not None)
+        return archivos
+
+    def _ruta(self, mes, cerrada=False):
+        return os.path.join(self.carpeta, f"FINAL_{mes}{'.cerrada' if cerrada else ''}.xlsx")
+
+    def firma(self):
+        return tuple(sorted(
+            (mes, cerrada, firma_archivo(ruta)) for mes, (ruta, cerrada) in self._archivos().items()
+        )), firma_archivo(self.ruta_bajas())
+
+    def _firma_particion(self, ruta):
+        # Una lápida nueva también cambia lo que se lee de la partición
+        return firma_archivo(ruta), firma_archivo(self.ruta_bajas())
+
+    def meses_cerrados(self):
+        return {mes for mes, (_, cerrada) in self._archivos().items() if cerrada}
+
+    def hay_registros(self):
+        # Del mes más reciente hacia atrás; normalmente basta con abrir la partición actual
+        archivos = self._archivos()
+        return any(not self._leer_particion(mes, archivos[mes][0]).empty for mes in sorted(archivos, reverse=True))
+
+    def _leer_particion(self, mes, ruta, guardar=True):
+        # guardar=False (exportaciones): un mes que no está en memoria se lee sin quedar en caché
+        firma = self._firma_particion(ruta)
+        guardado = self._particiones.get((self.clave(), mes))
+        metricas.contar_cache("particion", guardado is not None and guardado[0] == firma)
+        if guardado is None or guardado[0] != firma:
+            guardado = (firma, self._sin_bajas(preparar_final(leer_final_sin_cache(ruta))))
+            if not guardar:
+                return guardado[1]
+            with self._candado_cache:
+                self._particiones[(self.clave(), mes)] = guardado
+        return guardado[1]
+
+    def _meses_en_rango(self, desde=None, hasta=None):
+        # Los registros sin fecha solo aparecen en la lectura completa, igual que al filtrar por fecha
+        inicio = None if desde is None else mes_de(desde)
+        fin = None if hasta is None else mes_de(hasta)
+        completa = desde is None and hasta is None
+        return [
+            (mes, ruta)
+            for mes, (ruta, _) in sorted(self._archivos().items())
+            if (mes == SIN_FECHA and completa)
+            or (mes != SIN_FECHA and (inicio is None or mes >= inicio) and (fin is None or mes <= fin))
+        ]
+
+    def meses_crudos(self):
+        # Cada partición la lee el proceso que la revisa, y solo si cambió su archivo
+        return [(mes, repr(firma_archivo(ruta)), ruta) for mes, (ruta, _) in sorted(self._archivos().items())]
+
+    def _leer_meses(self, desde=None, hasta=None):
+        partes = [self._leer_particion(mes, ruta) for mes, ruta in self._meses_en_rango(desde, hasta)]
+        partes = [parte for parte in partes if not parte.empty]
+        if not partes:
+            return pd.DataFrame(columns=COLUMNAS_FINAL)
+        return pd.concat(partes, ignore_index=True)
+
+    def _leer_todo(self):
+        return self._leer_meses()
+
+    def buscar(self, desde=None, hasta=None, codigo=None, molde=None):
+        if desde is None and hasta is None:
+            return super().buscar(codigo=codigo, molde=molde)
+        return _filtrar(self._leer_meses(desde, hasta), desde, hasta, codigo, molde)
+
+    def iterar(self, desde=None, hasta=None, codigo=None, columnas=None, tamano=5000):
+        # Mes por mes, del más reciente al más antiguo (los registros sin fecha al final)
+        meses = self._meses_en_rango(desde, hasta)
+        meses.sort(key=lambda par: (par[0] != SIN_FECHA, par[0]), reverse=True)
+        for mes, ruta in meses:
+            df = _filtrar(self._leer_particion(mes, ruta, guardar=False), desde, hasta, codigo)
+            yield from _en_bloques(df, columnas, tamano)
+
+    def registrados(self):
+        return RegistradosPorMes(self)
+
+    def _registrados_mes(self, mes, archivo):
+        if archivo is None:
+            return Counter()
+        ruta, _ = archivo
+        firma = self._firma_particion(ruta)
+        guardado = self._derivados.get((self.clave(), "registrados", mes))
+        metricas.contar_cache("registrados", guardado is not None and guardado[0] == firma)
+        if guardado is None or guardado[0] != firma:
+            guardado = (firma, _contar_registrados(self._leer_particion(mes, ruta)))
+            with self._candado_cache:
+                self._derivados[(self.clave(), "registrados", mes)] = guardado
+        return guardado[1]
+
+    def _por_mes(self, df):
+        if df.empty:
+            return {}
+        fechas = pd.to_datetime(df["Fecha"], errors="coerce")
+        return dict(tuple(df.groupby(fechas.map(mes_de), sort=True)))
+
+    def _agregar(self, df_nuevo):
+        archivos = self._archivos()
+        por_mes = self._por_mes(df_nuevo)
+        cerrados = sorted(mes for mes in por_mes if archivos.get(mes, (None, False))[1])
+        if cerrados:
+            raise ValueError(f"El mes {', '.join(cerrados)} está cerrado; no admite registros nuevos")
+        mes_nuevo = False
+        for mes, filas in por_mes.items():
+            if mes in archivos:
+                agregar_filas_final(archivos[mes][0], filas)
+            else:
+                _crear_libro_final(self._ruta(mes), filas)
+                mes_nuevo = True
+        # El primer registro de un mes nuevo cierra los meses que quedaron fuera de la ventana
+        if mes_nuevo:
+            self.cerrar_meses()
+
+    def _filas_envio(self, id_envio):
+        # Solo se abre la partición del día del envío
+        dia = dia_de_envio(id_envio)
+        df = self.buscar(dia, dia)
+        return df[df[COLUMNA_ID] == id_envio] if not df.empty else df
+
+    def _eliminar_envio(self, id_envio):
+        mes = mes_de(dia_de_envio(id_envio))
+        if self._archivos().get(mes, (None, False))[1]:
+            raise ValueError(f"El mes {mes} está cerrado; no se pueden eliminar registros")
+        return super()._eliminar_envio(id_envio)
+
+    def requiere_compactacion(self):
+        # La compactación reescribe mes por mes: la proporción se mide en cada mes con lápidas,
+        # abriendo solo esas particiones
+        archivos = self._archivos()
+        por_mes = Counter(mes_de(dia_de_envio(id_envio)) for id_envio in self.bajas())
+        for mes, n_bajas in por_mes.items():
+            if mes not in archivos:
+                continue
+            vivos = self._leer_particion(mes, archivos[mes][0])[COLUMNA_ID].nunique()
+            if n_bajas / (n_bajas + vivos) >= UMBRAL_COMPACTACION:
+                return True
+        return False
+
+    def _compactar(self, bajas):
+        # Solo se reescriben los meses que tienen envíos con lápida. Un mes que se cerró después
+        # de la eliminación también se compacta: su contenido visible no cambia.
+        archivos = self._archivos()
+        for mes in sorted({mes_de(dia_de_envio(id_envio)) for id_envio in bajas}):
+            ruta, cerrada = archivos.get(mes, (None, False))
+            if ruta is None:
+                continue
+            df = self._sin_bajas(preparar_final(leer_final_sin_cache(ruta)), bajas)
+            os.chmod(ruta, 0o644)
+            if df.empty:
+                os.remove(ruta)
+                continue
+            reescribir_final(ruta, df)
+            if cerrada:
+                os.chmod(ruta, 0o444)
+
+    def _reemplazar_todo(self, df):
+        # Reescribe todas las particiones; las cerradas siguen cerradas
+        archivos = self._archivos()
+        por_mes = self._por_mes(df)
+        for mes, (ruta, _) in archivos.items():
+            os.chmod(ruta, 0o644)
+            if mes not in por_mes:
+                os.remove(ruta)
+        for mes, filas in por_mes.items():
+            ruta, cerrada = archivos.get(mes, (self._ruta(mes), False))
+            _crear_libro_final(ruta, filas)
+            if cerrada:
+                os.chmod(ruta, 0o444)
+        self._borrar_bajas()
+        self.cerrar_meses()
+
+    def cerrar_meses(self, hoy=None):
+        # Cierra las particiones anteriores a los MESES_ABIERTOS más recientes
+        primer_abierto = (pd.Timestamp(hoy or datetime.now()) - pd.DateOffset(months=MESES_ABIERTOS - 1)).strftime("%Y-%m")
+        cerrados = []
+        for mes, (ruta, cerrada) in sorted(self._archivos().items()):
+            if mes != SIN_FECHA and mes < primer_abierto and not cerrada:
+                destino = self._ruta(mes, cerrada=True)
+                os.replace(ruta, destino)
+                _sincronizar_carpeta(destino)
+                os.chmod(destino, 0o444)
+                cerrados.append(mes)
+        return cerrados
+
+    def reabrir_mes(self, mes):
+        # Para corregir un mes cerrado; se vuelve a cerrar al empezar el siguiente mes nuevo
+        ruta, cerrada = self._archivos().get(mes, (None, False))
+        if not cerrada:
+            raise ValueError(f"El mes {mes} no tiene una partición cerrada")
+        os.chmod(ruta, 0o644)
+        os.replace(ruta, self._ruta(mes))
+        _sincronizar_carpeta(ruta)
+
+    def importar_excel(self, reemplazar=False):
+        # Reparte la hoja FINAL del libro en particiones mensuales
+        if self._archivos() and not reemplazar:
+            raise ValueError(f"La carpeta {self.carpeta} ya tiene particiones; use --reemplazar")
+        df = AlmacenExcel(self.ruta_libro).leer_final()
+        self._reemplazar_todo(df)
+        return len(df)
+
+
+def mes_de(fecha):
+    return SIN_FECHA if pd.isna(fecha) else pd.Timestamp(fecha).strftime("%Y-%m")
+
+
+def _filtrar(df, desde=None, hasta=None, codigo=None, molde=None):
+    if df.empty:
+        return df
+    mascara = pd.Series(True, index=df.index)
+    if desde is not None:
+        mascara &= df["Fecha"].dt.date >= desde
+    if hasta is not None:
+        mascara &= df["Fecha"].dt.date <= hasta
+    if codigo:
+        mascara &= df["Código"].astype(str) == str(codigo)
+    if molde:
+        mascara &= df["Molde"].astype(str) == str(molde)
+    return df[mascara]
+
+
+def _en_bloques(df, columnas, tamano):
+    if df.empty:
+        return
+    df = df.sort_values("Fecha", ascending=False, kind="stable")
+    if columnas is not None:
+        df = df[columnas]
+    for inicio in range(0, len(df), tamano):
+        yield df.iloc[inicio:inicio + tamano]
+
+
+def _contar_registrados(df):
+    if df.empty:
+        return Counter()
+    fechas = pd.to_datetime(df["Fecha"], errors="coerce")
+    validos = df["Código"].notna() & fechas.notna()
+    return Counter(zip(df.loc[validos, "Código"].astype(str), fechas[validos].dt.date))
+
+
+def _actualizar_registrados(conteo, df, signo):
+    for par, cantidad in _contar_registrados(df).items():
+        conteo[par] += signo * cantidad
+        if conteo[par] <= 0:
+            del conteo[par]
+    return conteo
+
+
+def _contar_envios(df):
+    # Filas por ID de envío
+    if df.empty:
+        return Counter()
+    return Counter(df[COLUMNA_ID].dropna().astype(str))
+
+
+def _actualizar_envios(conteo, df, signo):
+    for id_envio, cantidad in _contar_envios(df).items():
+        conteo[id_envio] += signo * cantidad
+        if conteo[id_envio] <= 0:
+            del conteo[id_envio]
+    return conteo
+
+
+# nombre -> (construir a partir de FINAL, actualizar con filas agregadas/eliminadas)
+_DERIVADOS = {
+    "registrados": (_contar_registrados, _actualizar_registrados),
+    "agregado": (construir_agregado, actualizar_agregado),
+    "envios": (_contar_envios, _actualizar_envios),
+}
+
+
+def _valor_sql(columna, valor):
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return None
+    if columna == "Fecha":
+        return pd.Timestamp(valor).strftime(_FORMATO_FECHA_SQL)
+    if columna == "Código":
+        return str(valor)
+    if hasattr(valor, "item"):
+        return valor.item()
+    return valor
+
+
+_almacenes = {}
+_candado_almacenes = threading.Lock()
+
+
+_FECHA_SQL_VALIDA = "\"Fecha\" GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'"
+
+
+def _conectar_sqlite(ruta_db):
+    con = sqlite3.connect(ruta_db, timeout=30)
+    con.execute("PRAGMA journal_mode=WAL")
+    return con
+
+
+def _consultar_sqlite(ruta_db, where="", parametros=(), orden="ORDER BY id"):
+    columnas = ", ".join(f'"{columna}"' for columna in COLUMNAS_FINAL)
+    con = _conectar_sqlite(ruta_db)
+    try:
+        df = pd.read_sql_query(f"SELECT {columnas} FROM final {where} {orden}", con, params=parametros)
+    finally:
+        con.close()
+    df["Fecha"] = pd.to_datetime(df["Fecha"], format="ISO8601", errors="coerce")
+    return preparar_final(df)
+
+
+def leer_crudo(origen):
+    # Origen de meses_crudos, leído en el proceso del revisor de calidad: la ruta de un libro o
+    # de una partición, o (base SQLite, mes)
+    if isinstance(origen, str):
+        return leer_final_sin_cache(origen)
+    ruta_db, mes = origen
+    if mes == SIN_FECHA:
+        return _consultar_sqlite(ruta_db, f"WHERE \"Fecha\" IS NULL OR NOT {_FECHA_SQL_VALIDA}")
+    siguiente = (pd.Period(mes, "M") + 1).strftime("%Y-%m")
+    return _consultar_sqlite(ruta_db, 'WHERE "Fecha" >= ? AND "Fecha" < ?', (mes, siguiente))
+
+
+def obtener_almacen(ruta_libro):
+    # YESERIA_ALMACEN=sqlite activa el backend SQLite (ruta en YESERIA_SQLITE) y
+    # YESERIA_ALMACEN=particiones el historial por meses (carpeta en YESERIA_PARTICIONES).
+    # Un almacén por configuración y por proceso: el esquema y la migración de SQLite corren
+    # una sola vez y no en cada rerun de Streamlit.
+    tipo = os.environ.get("YESERIA_ALMACEN", "xlsx").lower()
+    if tipo == "sqlite":
+        ubicacion = os.environ.get("YESERIA_SQLITE", "produccion.db")
+    elif tipo == "particiones":
+        ubicacion = os.environ.get("YESERIA_PARTICIONES", "historial")
+    else:
+        tipo, ubicacion = "xlsx", ruta_libro
+    clave = (tipo, os.path.abspath(ruta_libro), os.path.abspath(ubicacion))
+    with _candado_almacenes:
+        almacen = _almacenes.get(clave)
+        if almacen is None:
+            if tipo == "sqlite":
+                almacen = AlmacenSQLite(ruta_libro, ubicacion)
+            elif tipo == "particiones":
+                almacen = AlmacenParticionado(ruta_libro, ubicacion)
+            else:
+                almacen = AlmacenExcel(ruta_libro)
+            _almacenes[clave] = almacen
+        return almacen
+
+
+def reescribir_final(ruta, df):
+    # Reescritura completa de la hoja (eliminaciones y hojas nuevas). Se trabaja sobre una
+    # copia para que los lectores nunca vean un libro a medio escribir. Si el libro todavía
+    # no existe (exportar a un archivo nuevo, primer envío) se crea con solo la hoja FINAL.
+    temporal = _temporal_junto_a(ruta)
+    try:
+        existe = os.path.exists(ruta)
+        if existe:
+            shutil.copy2(ruta, temporal)
+        opciones = {"mode": "a", "if_sheet_exists": "replace"} if existe else {}
+        with pd.ExcelWriter(temporal, engine='openpyxl', **opciones) as writer:
+            df.to_excel(writer, sheet_name=HOJA_FINAL, index=False)
+            # openpyxl vuelve a serializar todas las hojas del libro, no solo FINAL
+            hojas = len(writer.book.sheetnames)
+    except Exception:
+        os.remove(temporal)
+        raise
+    reemplazar_en_disco(temporal, ruta)
+    metricas.contar_io("escritura", ruta, hojas=hojas)
+
+
+def _crear_libro_final(ruta, df):
+    # Libro nuevo con solo la hoja FINAL (particiones mensuales)
+    temporal = _temporal_junto_a(ruta)
+    try:
+        with pd.ExcelWriter(temporal, engine="openpyxl") as writer:
+            df.reindex(columns=COLUMNAS_FINAL).to_excel(writer, sheet_name=HOJA_FINAL, index=False)
+    except Exception:
+        os.remove(temporal)
+        raise
+    reemplazar_en_disco(temporal, ruta)
+    metricas.contar_io("escritura", ruta, hojas=1)
+
+
+def guardar_libro(libro, ruta):
+    # Libro de openpyxl guardado sobre una copia y reemplazado de una vez, como reescribir_final
+    temporal = _temporal_junto_a(ruta)
+    try:
+        libro.save(temporal)
+    except Exception:
+        os.remove(temporal)
+        raise
+    reemplazar_en_disco(temporal, ruta)
+    metricas.contar_io("escritura", ruta, hojas=len(libro.sheetnames))
+
+
+def reemplazar_en_disco(temporal, ruta):
+    # Una escritura se confirma recién cuando el contenido del temporal y el cambio de nombre
+    # están en el disco: sin fsync un corte de luz puede dejar el libro anterior o uno vacío
+    with open(temporal, "rb+") as archivo:
+        os.fsync(archivo.fileno())
+    os.replace(temporal, ruta)
+    _sincronizar_carpeta(ruta)
+
+
+def _sincronizar_carpeta(ruta):
+    # El cambio de nombre vive en la carpeta; en Windows no se puede abrir una carpeta y
+    # os.replace ya es persistente
+    if os.name == "nt":
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(ruta)), os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _temporal_junto_a(ruta):
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ruta)), suffix=".xlsx")
+    os.close(descriptor)
+    return temporal
+
+
+def agregar_filas_final(ruta, df_nuevo):
+    # Agrega solo las filas nuevas al final de la hoja FINAL sin pasar por openpyxl:
+    # se insertan las filas en el XML de la hoja y el resto del libro se copia tal cual.
+    # Si el libro no tiene la forma esperada se recurre a la reescritura completa.
+    if df_nuevo.empty:
+        return
+    if not os.path.exists(ruta) or not _agregar_en_xml(ruta, df_nuevo):
+        existente = leer_final_sin_cache(ruta)
+        reescribir_final(ruta, pd.concat([existente, df_nuevo], ignore_index=True))
+    else:
+        metricas.contar_io("escritura", ruta, hojas=1)
+
+
+def leer_final_sin_cache(ruta):
+    # Todas las columnas de FINAL (también las que no escribe el formulario, para no perderlas
+    # al reescribir la hoja). Solo un libro o una hoja FINAL inexistentes son "sin historial";
+    # cualquier otro error se propaga para que la escritura que depende de esta lectura se
+    # cancele en lugar de reescribir el historial vacío.
+    if not os.path.exists(ruta):
+        return pd.DataFrame()
+    try:
+        return leer_hojas(ruta, {HOJA_FINAL: None}, TIPOS_LECTURA)[HOJA_FINAL]
+    except HojaNoEncontrada:
+        return pd.DataFrame()
+
+
+def huella_hojas(ruta, hojas):
+    # sha1 del XML de las hojas pedidas y de sus textos compartidos, sin interpretarlos: los
+    # agregados a FINAL (que se escriben en su propia hoja) no cambian la huella de las demás
+    sha1 = hashlib.sha1()
+    with zipfile.ZipFile(ruta) as libro_zip:
+        partes = [ruta_hoja(libro_zip, hoja) for hoja in hojas] + ["xl/sharedStrings.xml"]
+        for parte in partes:
+            if parte in libro_zip.namelist():
+                sha1.update(parte.encode("utf-8"))
+                sha1.update(libro_zip.read(parte))
+    return sha1.hexdigest()
+
+
+def _letra_columna(numero):
+    letras = ""
+    while numero:
+        numero, resto = divmod(numero - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+
+def _encabezados(xml):
+    inicio = xml.find(b'<row r="1"')
+    if inicio == -1:
+        return None
+    fin = xml.find(b"</row>", inicio)
+    celdas = re.findall(rb"<c [^>]*?(?:/>|>.*?</c>)", xml[inicio:fin])
+    encabezados = []
+    for celda in celdas:
+        texto = re.search(rb"<t[^>]*>(.*?)</t>", celda)
+        if texto is None:
+            return None  # encabezados en sharedStrings (libro guardado desde Excel)
+        encabezados.append(unescape(texto.group(1).decode("utf-8")))
+    return encabezados
+
+
+def _celda(referencia, valor, estilo_fecha):
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return ""
+    if isinstance(valor, datetime):
+        serial = (pd.Timestamp(valor).to_pydatetime() - _EPOCA_EXCEL).total_seconds() / 86400
+        return f'<c r="{referencia}" s="{estilo_fecha}" t="n"><v>{serial!r}</v></c>'
+    if isinstance(valor, Number) and not isinstance(valor, bool):
+        numero = int(valor) if float(valor).is_integer() else float(valor)
+        return f'<c r="{referencia}" t="n"><v>{numero!r}</v></c>'
+    texto = escape(str(valor))
+    if texto == "":
+        return f'<c r="{referencia}" t="inlineStr" />'
+    return f'<c r="{referencia}" t="inlineStr"><is><t>{texto}</t></is></c>'
+
+
+def _agregar_en_xml(ruta, df_nuevo):
+    with zipfile.ZipFile(ruta) as libro_zip:
+        parte = ruta_hoja(libro_zip, HOJA_FINAL)
+        if parte is None:
+            return False
+        xml = libro_zip.read(parte)
+
+        cierre = xml.rfind(b"</sheetData>")
+        ultima_fila = xml.rfind(b'<row r="', 0, cierre)
+        encabezados = _encabezados(xml)
+        if cierre == -1 or ultima_fila == -1 or not encabezados:
+            return False
+        if not set(df_nuevo.columns) <= set(encabezados):
+            return False
+
+        # El estilo de fecha se toma de la columna A de la última fila con datos. Con solo el
+        # encabezado (su estilo no es de fecha) se recurre a la reescritura completa.
+        numero_fila = int(re.match(rb'<row r="(\d+)"', xml[ultima_fila:]).group(1))
+        estilo = re.search(rb'<c r="A\d+"[^>]*? s="(\d+)"', xml[ultima_fila:cierre])
+        if estilo is None or numero_fila == 1:
+            return False
+        estilo_fecha = estilo.group(1).decode()
+
+        letras = [_letra_columna(i) for i in range(1, len(encabezados) + 1)]
+        filas = []
+        for valores in df_nuevo.reindex(columns=encabezados).itertuples(index=False):
+            numero_fila += 1
+            celdas = "".join(
+                _celda(f"{letra}{numero_fila}", valor, estilo_fecha)
+                for letra, valor in zip(letras, valores)
+            )
+            filas.append(f'<row r="{numero_fila}">{celdas}</row>')
+
+        nuevo_xml = xml[:cierre] + "".join(filas).encode("utf-8") + xml[cierre:]
+        nuevo_xml = re.sub(
+            rb'<dimension ref="[^"]*"',
+            f'<dimension ref="A1:{letras[-1]}{numero_fila}"'.encode(),
+            nuevo_xml,
+            count=1,
+        )
+
+        # Se escribe en un temporal del mismo directorio y se reemplaza de forma atómica
+        temporal = _temporal_junto_a(ruta)
+        shutil.copymode(ruta, temporal)
+        try:
+            with zipfile.ZipFile(temporal, "w") as destino:
+                for info in libro_zip.infolist():
+                    if info.filename == parte:
+                        destino.writestr(info, nuevo_xml, compresslevel=1)
+                    else:
+                        destino.writestr(info, libro_zip.read(info.filename))
+        except Exception:
+            os.remove(temporal)
+            raise
+
+    reemplazar_en_disco(temporal, ruta)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importa o exporta los registros entre BASE_FINAL.xlsx y otro almacén")
+    parser.add_argument("accion", choices=["importar", "exportar", "migrar", "compactar", "cerrar", "reabrir"],
+                        help="migrar convierte los indicadores en texto a números y compactar elimina las filas "
+                             "con lápida, ambos en el almacén configurado; "
+                             "cerrar y reabrir gestionan los meses del almacén particionado")
+    parser.add_argument("--almacen", choices=["sqlite", "particiones"], default="sqlite",
+                        help="almacén de destino para importar y de origen para exportar")
+    parser.add_argument("--libro", default="BASE_FINAL.xlsx")
+    parser.add_argument("--db", default=os.environ.get("YESERIA_SQLITE", "produccion.db"))
+    parser.add_argument("--carpeta", default=os.environ.get("YESERIA_PARTICIONES", "historial"))
+    parser.add_argument("--destino", help="libro de destino para exportar (por defecto --libro)")
+    parser.add_argument("--reemplazar", action="store_true", help="vacía el almacén antes de importar")
+    parser.add_argument("--mes", help="mes a reabrir, con formato AAAA-MM")
+    args = parser.parse_args()
+
+    from escritura import candado_archivo
+
+    if args.accion == "migrar":
+        almacen = obtener_almacen(args.libro)
+        with candado_archivo(almacen.ruta_candado()):
+            print(f"{almacen.migrar_indicadores()} registros con indicadores numéricos")
+        raise SystemExit
+
+    if args.accion == "compactar":
+        almacen = obtener_almacen(args.libro)
+        with candado_archivo(almacen.ruta_candado()):
+            print(f"{almacen.compactar()} envíos eliminados físicamente")
+        raise SystemExit
+
+    if args.almacen == "particiones" or args.accion in ("cerrar", "reabrir"):
+        almacen = AlmacenParticionado(args.libro, args.carpeta)
+        destino = args.carpeta
+    else:
+        almacen = AlmacenSQLite(args.libro, args.db)
+        destino = args.db
+
+    with candado_archivo(almacen.ruta_candado()):
+        try:
+            if args.accion == "importar":
+                print(f"{almacen.importar_excel(reemplazar=args.reemplazar)} registros importados en {destino}")
+            elif args.accion == "exportar":
+                print(f"{almacen.exportar_excel(args.destino)} registros exportados a {args.destino or args.libro}")
+            elif args.accion == "cerrar":
+                print(f"Meses cerrados: {', '.join(almacen.cerrar_meses()) or 'ninguno'}")
+            else:
+                if not args.mes:
+                    parser.error("reabrir necesita --mes")
+                almacen.reabrir_mes(args.mes)
+                print(f"Mes {args.mes} reabierto")
+        except ValueError as e:
+            parser.error(str(e))
@@ -0,0 +1,410 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+from agregados import resumir_agregado
+from almacenamiento import (
+    COLUMNA_ID, COLUMNAS_FINAL, AlmacenExcel, AlmacenParticionado, AlmacenRegistros, AlmacenSQLite,
+    agregar_filas_final, leer_final_sin_cache, reescribir_final,
+)
+from escritura import cola_escritura
+from exportacion import ESCRITORES, exportar
+from indices import PARTES_POR_LETRA, construir_indices
+from maestros import cache_maestros
+from reglas import calcular_registros, preparar_filas, validar_envios
+
+MOLDES_EJEMPLO = ["IFZ", "INV", "IAG", "IAL", "IGE", "DMA", "LCH", "VTR", "OPL", "TRC"]
+
+
+def generar_maestros(n_moldes=10, n_operarios=30, semilla=0):
+    # Hojas Base_Produccion, Tiempo_Fallas y Operarios con las mismas columnas que el libro real
+    rng = np.random.default_rng(semilla)
+    letras = list(PARTES_POR_LETRA)
+    moldes = MOLDES_EJEMPLO[:n_moldes] + [
+        f"{letras[i % len(letras)]}{i:03d}" for i in range(len(MOLDES_EJEMPLO), n_moldes)
+    ]
+    moldes_turno = rng.integers(4, 15, len(moldes))
+    personas_molde = rng.integers(1, 5, len(moldes))
+    base_produccion = pd.DataFrame({
+        "COD MAT": moldes,
+        "COD2": "MY",
+        "CODIGO AS400": ["MY" + molde for molde in moldes],
+        "MOLDES/TURNO": moldes_turno,
+        "PERSONAS/MOLDE": personas_molde,
+        "MOLDE/PERSONA/TURNO": moldes_turno / personas_molde,
+        "HORAS/MOLDE 1PERSONA": 8 / (moldes_turno / personas_molde),
+        "HORAS/MOLDE 2 PERSONAS": 8 / moldes_turno,
+    })
+
+    fallas = [(molde, parte) for molde in moldes for parte in PARTES_POR_LETRA[molde[0]]]
+    tiempo_fallas = pd.DataFrame({
+        "COD MAT": [molde for molde, _ in fallas],
+        "CODIGO": [molde for molde, _ in fallas],
+        "PARTE MOLDE": [parte.title() for _, parte in fallas],
+        "TIEMPO (MIN)": rng.integers(10, 90, len(fallas)),
+        "CANTIDAD KG": rng.integers(1, 10, len(fallas)),
+        "OBSERVACION": rng.choice(["SE ROMPE AL DESMOLDAR", "MAL LLENADO", "SE PASA TINA SECA"], len(fallas)),
+        "LINEA": [f"C{i + 1}" for i in range(len(fallas))],
+    })
+
+    operarios = pd.DataFrame({
+        "N° ": range(1, n_operarios + 1),
+        "CÓDIGO": [1000 + i for i in range(n_operarios)],
+        "OPERARIO": [f"OPERARIO {1000 + i}" for i in range(n_operarios)],
+    })
+    return base_produccion, tiempo_fallas, operarios
+
+
+def generar_final(n_filas, semilla=0, inicio=datetime(2024, 1, 1), moldes=None, codigos=None, dias=365 * 3):
+    # Historial sintético con el mismo esquema de 18 columnas que escribe el formulario
+    rng = np.random.default_rng(semilla)
+    moldes = np.array(MOLDES_EJEMPLO if moldes is None else moldes)
+    codigos = np.array([str(1000 + i) for i in range(30)] if codigos is None else codigos)
+    partes = np.array(["", "BASE", "TAPA", "LATERAL", "MACHO", "HEMBRA"])
+
+    minutos = np.sort(rng.integers(0, 60 * 24 * dias, n_filas))
+    produccion = rng.uniform(20, 100, n_filas).round(1)
+    tiempo_merma = rng.integers(0, 240, n_filas)
+    retrabajo = rng.integers(0, 120, n_filas)
+    codigo = rng.choice(codigos, n_filas)
+
+    final = pd.DataFrame({
+        "Fecha": [inicio + timedelta(minutes=int(m)) for m in minutos],
+        "Molde": rng.choice(moldes, n_filas),
+        "Moldes/Persona": rng.integers(1, 6, n_filas).astype(float),
+        "Código": codigo,
+        "Nombre": np.char.add("OPERARIO ", codigo),
+        "Tiempo Usado": (produccion / 100 * 8).round(2),
+        "Indicador de Producción": produccion,
+        "Pieza": rng.choice(moldes, n_filas),
+        "Parte": rng.choice(partes, n_filas),
+        "Cantidad": rng.integers(0, 4, n_filas),
+        "Cantidad KG": rng.integers(0, 30, n_filas),
+        "Tiempo en Minutos": tiempo_merma,
+        "Indicador de Tiempo": (tiempo_merma / 480 * 100).round(2),
+        "Molde Retrabajo": "",
+        "Linea Retrabajo": "",
+        "Tiempo Retrabajo (minutos)": retrabajo,
+        "Indicador Retrabajo": (retrabajo / 480 * 100).round(2),
+    }, columns=COLUMNAS_FINAL)
+
+    # Envíos de 1 a 5 operarios: sus filas comparten Fecha e ID, como las que guarda el formulario
+    envio = np.repeat(np.arange(n_filas), rng.integers(1, 6, n_filas))[:n_filas]
+    sufijos = rng.integers(0, 16 ** 8, n_filas)
+    final["Fecha"] = final["Fecha"].to_numpy()[np.searchsorted(envio, envio)]
+    final[COLUMNA_ID] = [f"{fecha:%Y%m%d}-{sufijo:08x}" for fecha, sufijo in zip(final["Fecha"], sufijos[envio])]
+    return final
+
+
+def crear_libro(ruta, n_filas, n_moldes=10, n_operarios=30, semilla=0, inicio=datetime(2024, 1, 1), dias=365 * 3):
+    # Libro completo: hojas maestras e historial FINAL de n_filas con esos moldes y operarios
+    base_produccion, tiempo_fallas, operarios = generar_maestros(n_moldes, n_operarios, semilla)
+    final = generar_final(
+        n_filas, semilla, inicio, base_produccion["COD MAT"], operarios["CÓDIGO"].astype(str), dias
+    )
+    with pd.ExcelWriter(ruta, engine="openpyxl") as writer:
+        operarios.to_excel(writer, sheet_name="Operarios", index=False)
+        base_produccion.to_excel(writer, sheet_name="Base_Produccion", index=False)
+        tiempo_fallas.to_excel(writer, sheet_name="Tiempo_Fallas", index=False)
+        final.to_excel(writer, sheet_name="FINAL", index=False)
+
+
+def guardar_reescribiendo(ruta, df_nuevo):
+    # Camino anterior: leer toda la hoja, concatenar y reescribirla
+    existente = leer_final_sin_cache(ruta)
+    reescribir_final(ruta, pd.concat([existente, df_nuevo], ignore_index=True))
+
+
+def medir(funcion, *args, repeticiones=3):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(*args)
+        tiempos.append(time.perf_counter() - inicio)
+    return min(tiempos)
+
+
+def benchmark_guardado(tamanos, incluir_reescritura):
+    resultados = []
+    envio = generar_final(5, semilla=1, inicio=datetime.now())
+    with tempfile.TemporaryDirectory() as carpeta:
+        for n_filas in tamanos:
+            ruta = os.path.join(carpeta, f"final_{n_filas}.xlsx")
+            crear_libro(ruta, n_filas)
+            fila = {"filas_existentes": n_filas, "agregar_s": medir(agregar_filas_final, ruta, envio)}
+            if incluir_reescritura:
+                fila["reescribir_s"] = medir(guardar_reescribiendo, ruta, envio, repeticiones=1)
+            resultados.append(fila)
+            print(fila, flush=True)
+    return pd.DataFrame(resultados)
+
+
+def _enviar_en_paralelo(ruta, n_envios, filas_por_envio, semilla):
+    # Simula n_envios supervisores guardando al mismo tiempo desde un mismo proceso
+    escritor = cola_escritura(AlmacenExcel(ruta))
+    envios = [generar_final(filas_por_envio, semilla=semilla + i, inicio=datetime.now()) for i in range(n_envios)]
+    with ThreadPoolExecutor(max_workers=n_envios) as hilos:
+        futuros = list(hilos.map(escritor.agregar, envios))
+    for futuro in futuros:
+        futuro.result(timeout=300)
+    return escritor.lotes_escritos
+
+
+def prueba_estres(n_envios, filas_por_envio, procesos, filas_iniciales=1_000):
+    # Varios procesos (cada uno con su propia cola) compiten por el candado de archivo;
+    # al final deben haber llegado exactamente procesos × n_envios × filas_por_envio filas.
+    with tempfile.TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, "estres.xlsx")
+        crear_libro(ruta, filas_iniciales)
+        inicio = time.perf_counter()
+        with multiprocessing.Pool(procesos) as pool:
+            lotes = pool.starmap(
+                _enviar_en_paralelo,
+                [(ruta, n_envios, filas_por_envio, 1000 * p) for p in range(procesos)],
+            )
+        duracion = time.perf_counter() - inicio
+        esperadas = filas_iniciales + procesos * n_envios * filas_por_envio
+        obtenidas = len(leer_final_sin_cache(ruta))
+
+    print(f"{procesos} procesos × {n_envios} envíos × {filas_por_envio} filas en {duracion:.2f} s, "
+          f"{sum(lotes)} escrituras por lotes; filas esperadas {esperadas}, obtenidas {obtenidas}")
+    if obtenidas != esperadas:
+        raise SystemExit("ERROR: se perdieron o duplicaron registros")
+
+
+def _abrir_almacen(tipo, carpeta, ruta_libro):
+    if tipo == "sqlite":
+        almacen = AlmacenSQLite(ruta_libro, os.path.join(carpeta, "produccion.db"))
+    elif tipo == "particiones":
+        almacen = AlmacenParticionado(ruta_libro, os.path.join(carpeta, "historial"))
+    else:
+        return AlmacenExcel(ruta_libro)
+    almacen.importar_excel(reemplazar=True)
+    return almacen
+
+
+def _vaciar_caches(almacen, instantanea=False, solo_derivados=False):
+    # Deja el proceso como un trabajador recién iniciado (o solo sin los índices derivados)
+    AlmacenRegistros._derivados.clear()
+    if solo_derivados:
+        return
+    AlmacenRegistros._cache.clear()
+    AlmacenParticionado._particiones.clear()
+    if instantanea and os.path.exists(almacen.ruta_instantanea()):
+        os.remove(almacen.ruta_instantanea())
+
+
+def armar_envio(indices, base_produccion, operarios, dia, n_operarios=5):
+    # Un envío válido del formulario: el primer molde a su máximo por turno y un operario con merma
+    molde = base_produccion["COD MAT"].iloc[0]
+    parte = PARTES_POR_LETRA[molde[0]][0]
+    codigos = operarios["CÓDIGO"].astype(str).tolist()[:n_operarios]
+    filas = pd.DataFrame({
+        "Posición": range(1, len(codigos) + 1),
+        "Código": codigos,
+        "Pieza": molde,
+        "Parte": [parte] + [""] * (len(codigos) - 1),
+        "Cantidad": [1] + [0] * (len(codigos) - 1),
+        "Molde Retrabajo": "",
+        "Linea Retrabajo": "",
+        "Tiempo Retrabajo (minutos)": 0,
+    }).assign(**{
+        "Envío": 0, "Fecha": dia, "Molde": molde,
+        "Cantidad Total": int(base_produccion["MOLDES/TURNO"].iloc[0]),
+    })
+    return preparar_filas(filas)
+
+
+def _reporte(almacen, desde, hasta, codigo):
+    # Lo que calcula el Buscador de Producción Real para un operario y un rango
+    df = almacen.buscar(desde, hasta, codigo)
+    real = (
+        df["Indicador de Producción"].to_numpy(dtype=float)
+        - df["Indicador de Tiempo"].to_numpy(dtype=float)
+        - df["Indicador Retrabajo"].to_numpy(dtype=float)
+    )
+    return real, resumir_agregado(almacen.agregado(desde, hasta, codigo))
+
+
+def _descargar(almacen, formato):
+    # Lo que hace st.download_button al pulsarlo: llama a la función diferida y convierte el
+    # resultado con el mismo conversor de Streamlit, que rechaza los tipos que no sabe descargar
+    datos, _ = convert_data_to_bytes_and_infer_mime(
+        exportar(almacen, formato), unsupported_error=TypeError(f"descarga {formato} no soportada")
+    )
+    if not datos:
+        raise ValueError(f"descarga {formato} vacía")
+    return datos
+
+
+def suite(tamanos, n_moldes=10, n_operarios=30, repeticiones=3, tipo_almacen="xlsx", semilla=0):
+    # Operaciones principales de programa.py medidas fuera de Streamlit sobre libros sintéticos.
+    # El historial termina ayer para que el envío de hoy pase la validación.
+    hoy = date.today()
+    inicio = datetime.combine(hoy - timedelta(days=365 * 3), datetime.min.time())
+    resultados = []
+
+    def anotar(n_filas, operacion, tiempos):
+        fila = {
+            "almacen": tipo_almacen, "filas": n_filas, "operacion": operacion,
+            "mejor_s": round(min(tiempos), 5), "mediana_s": round(statistics.median(tiempos), 5),
+            "repeticiones": len(tiempos),
+        }
+        resultados.append(fila)
+        print(fila, flush=True)
+
+    def cronometrar(funcion, preparar=None):
+        tiempos = []
+        for _ in range(repeticiones):
+            if preparar:
+                preparar()
+            inicio_medida = time.perf_counter()
+            funcion()
+            tiempos.append(time.perf_counter() - inicio_medida)
+        return tiempos
+
+    for n_filas in tamanos:
+        with tempfile.TemporaryDirectory() as carpeta:
+            ruta = os.path.join(carpeta, "BASE_FINAL.xlsx")
+            crear_libro(ruta, n_filas, n_moldes, n_operarios, semilla, inicio, dias=365 * 3 - 1)
+            almacen = _abrir_almacen(tipo_almacen, carpeta, ruta)
+            maestros = almacen.leer_maestros()
+            indices = construir_indices(*maestros)
+            base_produccion, _, operarios = maestros
+
+            anotar(n_filas, "carga_maestros", cronometrar(lambda: construir_indices(*almacen.leer_maestros())))
+            # Rerun con la caché de maestros ya cargada: solo se revisa la firma del libro
+            cache = cache_maestros(almacen.ruta_maestros())
+            cache.obtener()
+            anotar(n_filas, "carga_maestros_cache", cronometrar(cache.obtener))
+            anotar(n_filas, "carga_final", cronometrar(
+                almacen.leer_final, lambda: _vaciar_caches(almacen, instantanea=True)
+            ))
+            # Referencia: la misma hoja con pd.read_excel (openpyxl), antes del lector de lectura.py
+            anotar(n_filas, "carga_final_read_excel", cronometrar(lambda: pd.read_excel(ruta, sheet_name="FINAL")))
+            almacen.leer_final()
+            anotar(n_filas, "carga_final_instantanea", cronometrar(almacen.leer_final, lambda: _vaciar_caches(almacen)))
+
+            codigos = operarios["CÓDIGO"].astype(str).tolist()[:5]
+            anotar(n_filas, "chequeo_duplicados", cronometrar(
+                lambda: almacen.ya_registrados(codigos, hoy), lambda: _vaciar_caches(almacen, solo_derivados=True)
+            ))
+
+            filas = armar_envio(indices, base_produccion, operarios, hoy)
+
+            def construir():
+                motivos = validar_envios(filas, indices, almacen.registrados(), hoy, almacen.meses_cerrados())
+                if motivos.notna().any():
+                    raise RuntimeError(f"El envío sintético no pasó la validación: {motivos.iloc[0]}")
+                return calcular_registros(filas, indices, datetime.now())
+
+            anotar(n_filas, "armar_envio", cronometrar(construir))
+
+            tiempos_guardar, tiempos_eliminar = [], []
+            for _ in range(repeticiones):
+                df_nuevos = construir()
+                inicio_medida = time.perf_counter()
+                almacen.agregar(df_nuevos)
+                tiempos_guardar.append(time.perf_counter() - inicio_medida)
+                inicio_medida = time.perf_counter()
+                eliminadas = almacen.eliminar_envio(df_nuevos[COLUMNA_ID].iloc[0])
+                tiempos_eliminar.append(time.perf_counter() - inicio_medida)
+                if eliminadas != len(df_nuevos):
+                    raise RuntimeError(f"Se eliminaron {eliminadas} filas de {len(df_nuevos)}")
+            anotar(n_filas, "guardar", tiempos_guardar)
+            anotar(n_filas, "eliminar", tiempos_eliminar)
+            # Envíos que ya estaban en el historial, del más reciente hacia atrás (los meses
+            # abiertos del almacén particionado)
+            ids_historial = iter(almacen.leer_final([COLUMNA_ID])[COLUMNA_ID].dropna().unique()[::-1])
+            if n_filas >= repeticiones * 5:
+                anotar(n_filas, "eliminar_historial", cronometrar(lambda: almacen.eliminar_envio(next(ids_historial))))
+            # Una sola vez: reescribe el almacén sin las filas con lápida de las eliminaciones anteriores
+            inicio_medida = time.perf_counter()
+            almacen.compactar()
+            anotar(n_filas, "compactar", [time.perf_counter() - inicio_medida])
+
+            desde = hoy - timedelta(days=90)
+            anotar(n_filas, "reporte", cronometrar(
+                lambda: _reporte(almacen, desde, hoy, codigos[0]), lambda: _vaciar_caches(almacen, solo_derivados=True)
+            ))
+            for formato in ESCRITORES:
+                anotar(n_filas, f"exportar_{formato}", cronometrar(lambda: _descargar(almacen, formato)))
+
+    return pd.DataFrame(resultados)
+
+
+def guardar_resultados(resultados, ruta):
+    # CSV plano o JSON con el entorno, para comparar corridas entre versiones
+    if ruta.lower().endswith(".csv"):
+        resultados.to_csv(ruta, index=False)
+        return
+    entorno = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "sistema": platform.platform(),
+    }
+    with open(ruta, "w", encoding="utf-8") as archivo:
+        json.dump({"entorno": entorno, "resultados": resultados.to_dict("records")}, archivo, ensure_ascii=False, indent=2)
+
+
+def leer_resultados(ruta):
+    if ruta.lower().endswith(".csv"):
+        return pd.read_csv(ruta)
+    with open(ruta, encoding="utf-8") as archivo:
+        return pd.DataFrame(json.load(archivo)["resultados"])
+
+
+def comparar(resultados, ruta_base, tolerancia):
+    # Devuelve las operaciones cuya mediana empeoró más que la tolerancia respecto de la base
+    clave = ["almacen", "filas", "operacion"]
+    tabla = resultados.merge(leer_resultados(ruta_base), on=clave, suffixes=("", "_base"))
+    tabla["razon"] = (tabla["mediana_s"] / tabla["mediana_s_base"]).round(2)
+    print(tabla[clave + ["mediana_s_base", "mediana_s", "razon"]].to_string(index=False))
+    return tabla[tabla["razon"] > tolerancia]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark del guardado de registros en la hoja FINAL")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--sin-reescritura", action="store_true", help="omite la medición del camino de reescritura completa")
+    parser.add_argument("--estres", type=int, metavar="N", help="en lugar del benchmark, lanza N envíos simultáneos por proceso y verifica que no se pierdan filas")
+    parser.add_argument("--procesos", type=int, default=2, help="procesos escritores para --estres")
+    parser.add_argument("--filas-envio", type=int, default=5, help="filas por envío para --estres")
+    parser.add_argument("--suite", action="store_true",
+                        help="mide carga de maestros, carga de FINAL, chequeo de duplicados, armado del envío, "
+                             "guardado, eliminación, compactación, reporte y exportación sobre libros sintéticos de --tamanos filas")
+    parser.add_argument("--moldes", type=int, default=10, help="moldes del libro sintético de --suite")
+    parser.add_argument("--operarios", type=int, default=30, help="operarios del libro sintético de --suite")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--almacen", choices=["xlsx", "sqlite", "particiones"], default="xlsx")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", help="archivo .json o .csv donde guardar los resultados de --suite")
+    parser.add_argument("--comparar", metavar="BASE", help="resultados anteriores (.json o .csv) contra los que comparar")
+    parser.add_argument("--tolerancia", type=float, default=1.25,
+                        help="razón máxima de la mediana frente a la base antes de fallar")
+    args = parser.parse_args()
+
+    if args.suite:
+        resultados = suite(args.tamanos, args.moldes, args.operarios, args.repeticiones, args.almacen, args.semilla)
+        if args.salida:
+            guardar_resultados(resultados, args.salida)
+        if args.comparar:
+            regresiones = comparar(resultados, args.comparar, args.tolerancia)
+            if not regresiones.empty:
+                raise SystemExit(f"ERROR: {len(regresiones)} operaciones más lentas que la base × {args.tolerancia}")
+    elif args.estres:
+        prueba_estres(args.estres, args.filas_envio, args.procesos)
+    else:
+        print(benchmark_guardado(args.tamanos, not args.sin_reescritura).to_string(index=False))
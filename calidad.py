@@ -0,0 +1,256 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+import metricas
+from almacenamiento import (
+    COLUMNA_ID, COLUMNAS_INDICADORES, SIN_FECHA, firma_archivo, leer_crudo, obtener_almacen, preparar_final,
+)
+from reglas import MINUTOS_TURNO
+
+# Revisión de calidad del historial de FINAL. Las validaciones del formulario solo protegen
+# los registros nuevos; aquí se aplican las mismas reglas, vectorizadas, a todo lo guardado.
+# Se revisa en un pool de procesos que leen cada uno su parte del historial (una partición, un
+# mes de SQLite o el libro completo), fuera del proceso de la app, y el resultado queda en
+# <almacén>.calidad.json con la firma de cada mes: la próxima revisión solo vuelve a revisar los
+# meses que cambiaron. La app muestra el reporte guardado, sin los envíos eliminados, y solo
+# revisa de nuevo cuando se lo pide.
+#   python calidad.py --libro BASE_FINAL.xlsx
+
+REGLAS = {
+    "registro_duplicado": "Operario con más de un registro el mismo día",
+    "indicador_mayor_100": "Indicador de Producción mayor a 100%",
+    "merma_supera_total": "Piezas mal hechas superan la cantidad producida",
+    "retrabajo_mayor_turno": "Más de 8 horas de retrabajo",
+    "porcentaje_ilegible": "Porcentaje que no se puede interpretar (se lee como 0%)",
+}
+
+COLUMNAS_HALLAZGO = ["Regla", COLUMNA_ID, "Fecha", "Código", "Detalle"]
+COLUMNAS_REPORTE = ["Mes", "Regla", "Descripción", COLUMNA_ID, "Fecha", "Código", "Detalle"]
+
+# Procesos del pool (YESERIA_PROCESOS_CALIDAD); con 1 se revisa en el mismo proceso
+PROCESOS_CALIDAD = int(os.environ.get("YESERIA_PROCESOS_CALIDAD", str(min(4, os.cpu_count() or 1))))
+
+
+def _hallazgos(df, mascara, regla, detalle):
+    filas = df[mascara]
+    return pd.DataFrame({
+        "Regla": regla,
+        COLUMNA_ID: filas[COLUMNA_ID],
+        "Fecha": filas["Fecha"],
+        "Código": filas["Código"],
+        "Detalle": detalle[mascara],
+    })
+
+
+def porcentaje_ilegible(serie):
+    # El texto que indicador_numerico convierte en 0.0 porque no es un porcentaje
+    if pd.api.types.is_numeric_dtype(serie):
+        return pd.Series(False, index=serie.index)
+    valores = pd.to_numeric(serie.astype(str).str.strip().str.rstrip("%"), errors="coerce")
+    return valores.isna() & serie.notna()
+
+
+def revisar(crudo):
+    # Hallazgos de un bloque de filas de FINAL tal como están guardadas
+    if crudo.empty:
+        return pd.DataFrame(columns=COLUMNAS_HALLAZGO)
+    df = preparar_final(crudo.copy())
+    codigo = df["Código"].astype(str)
+    hallazgos = []
+
+    # Un registro por operario y día: más de un envío con el mismo código en la misma fecha
+    validos = df["Código"].notna() & df["Fecha"].notna()
+    dia = df["Fecha"].dt.date
+    envios_dia = df[validos].groupby([codigo[validos], dia[validos]])[COLUMNA_ID].transform("nunique")
+    envios_dia = envios_dia.reindex(df.index, fill_value=0)
+    hallazgos.append(_hallazgos(
+        df, envios_dia > 1, "registro_duplicado",
+        "El operario " + codigo + " tiene " + envios_dia.astype(str) + " envíos el " + dia.astype(str),
+    ))
+
+    produccion = df["Indicador de Producción"]
+    hallazgos.append(_hallazgos(
+        df, produccion > 100, "indicador_mayor_100", "Indicador de Producción " + produccion.astype(str) + "%",
+    ))
+
+    # La cantidad total del envío no se guarda: es Moldes/Persona por el número de operarios
+    cantidad = pd.to_numeric(df["Cantidad"], errors="coerce").fillna(0)
+    por_envio = df[COLUMNA_ID]
+    merma = cantidad.groupby(por_envio).transform("sum")
+    total = (pd.to_numeric(df["Moldes/Persona"], errors="coerce") * por_envio.groupby(por_envio).transform("size")).round()
+    excede = (merma > total) & ~df[COLUMNA_ID].duplicated()
+    hallazgos.append(_hallazgos(
+        df, excede, "merma_supera_total",
+        "Piezas mal hechas " + merma.map("{:g}".format) + " de " + total.map("{:g}".format) + " producidas",
+    ))
+
+    retrabajo = pd.to_numeric(df["Tiempo Retrabajo (minutos)"], errors="coerce")
+    hallazgos.append(_hallazgos(
+        df, retrabajo > MINUTOS_TURNO, "retrabajo_mayor_turno", retrabajo.map("{:g} minutos".format),
+    ))
+
+    for columna in COLUMNAS_INDICADORES:
+        if columna in crudo.columns:
+            ilegible = porcentaje_ilegible(crudo[columna])
+            hallazgos.append(_hallazgos(
+                df, ilegible, "porcentaje_ilegible", columna + ': "' + crudo[columna].astype(str) + '"',
+            ))
+
+    return pd.concat(hallazgos, ignore_index=True)
+
+
+def revisar_origen(tarea):
+    # Tarea del pool: {mes: (firma, hallazgos)}. Un origen sin mes (el libro completo) se separa
+    # por meses y los que tienen la misma firma que en firmas_previas vuelven con hallazgos None.
+    mes, firma, origen, firmas_previas = tarea
+    crudo = leer_crudo(origen)
+    if mes is not None:
+        return {mes: (firma, revisar(crudo))}
+    if crudo.empty:
+        return {}
+    meses = pd.to_datetime(crudo["Fecha"], errors="coerce").dt.strftime("%Y-%m").fillna(SIN_FECHA)
+    resultado = {}
+    for mes, filas in crudo.groupby(meses):
+        firma = hashlib.sha1(pd.util.hash_pandas_object(filas, index=False).to_numpy()).hexdigest()
+        resultado[mes] = (firma, None if firmas_previas.get(mes) == firma else revisar(filas))
+    return resultado
+
+
+def leer_reporte(ruta):
+    try:
+        with open(ruta, encoding="utf-8") as archivo:
+            return json.load(archivo)
+    except (OSError, ValueError):
+        return None
+
+
+def _escribir_reporte(ruta, reporte):
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ruta)), suffix=".json")
+    with os.fdopen(descriptor, "w", encoding="utf-8") as archivo:
+        json.dump(reporte, archivo, ensure_ascii=False)
+    os.replace(temporal, ruta)
+
+
+def _registros(hallazgos):
+    hallazgos = hallazgos.assign(Fecha=pd.to_datetime(hallazgos["Fecha"]).dt.strftime("%Y-%m-%d %H:%M:%S"))
+    return hallazgos.astype(object).where(hallazgos.notna(), None).to_dict("records")
+
+
+def escanear(almacen, procesos=None):
+    # Revisa los meses cuya firma cambió desde el último reporte y guarda el reporte nuevo.
+    # Devuelve los meses revisados.
+    procesos = PROCESOS_CALIDAD if procesos is None else procesos
+    ruta = almacen.ruta_calidad()
+    anterior = leer_reporte(ruta) or {}
+    firma = repr(almacen.firma())
+    if anterior.get("firma") == firma:
+        return []
+
+    with metricas.medicion("calidad") as en_curso:
+        previos = anterior.get("meses", {})
+        firmas_previas = {mes: previo["firma"] for mes, previo in previos.items()}
+        meses = {}
+        tareas = []
+        for mes, firma_mes, origen in almacen.meses_crudos():
+            if mes is not None and firmas_previas.get(mes) == firma_mes:
+                meses[mes] = previos[mes]
+            else:
+                tareas.append((mes, firma_mes, origen, firmas_previas))
+
+        if tareas and procesos > 1:
+            # spawn: el proceso de Streamlit tiene hilos y no conviene copiarlo con fork
+            contexto = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(min(procesos, len(tareas)), mp_context=contexto) as pool:
+                resultados = list(pool.map(revisar_origen, tareas))
+        else:
+            resultados = [revisar_origen(tarea) for tarea in tareas]
+        revisados = []
+        for resultado in resultados:
+            for mes, (firma_mes, hallazgos) in resultado.items():
+                if hallazgos is None:
+                    meses[mes] = previos[mes]
+                else:
+                    meses[mes] = {"firma": firma_mes, "hallazgos": _registros(hallazgos)}
+                    revisados.append(mes)
+        en_curso.datos.update(meses=len(meses), revisados=len(revisados))
+
+        _escribir_reporte(ruta, {
+            "firma": firma,
+            "generado": datetime.now().isoformat(timespec="seconds"),
+            "meses": meses,
+        })
+    return sorted(revisados)
+
+
+_reportes = {}
+_escaneos = {}
+_candado_escaneos = threading.Lock()
+
+
+def escanear_en_segundo_plano(almacen):
+    # Un escaneo a la vez por almacén y por proceso; devuelve False si ya había uno en curso
+    with _candado_escaneos:
+        hilo = _escaneos.get(almacen.clave())
+        if hilo is not None and hilo.is_alive():
+            return False
+        hilo = _escaneos[almacen.clave()] = threading.Thread(
+            target=escanear, args=(almacen,), name="revision-calidad", daemon=True
+        )
+        hilo.start()
+        return True
+
+
+def escaneo_en_curso(almacen):
+    hilo = _escaneos.get(almacen.clave())
+    return hilo is not None and hilo.is_alive()
+
+
+def reporte(almacen):
+    # (hallazgos, generado, al_dia) desde el reporte guardado, sin los envíos eliminados.
+    # El DataFrame se arma una vez por versión del archivo del reporte.
+    ruta = almacen.ruta_calidad()
+    firma = firma_archivo(ruta)
+    guardado = _reportes.get(ruta)
+    if guardado is None or guardado[0] != firma:
+        datos = leer_reporte(ruta) or {}
+        filas = [
+            {"Mes": mes, **hallazgo}
+            for mes, contenido in sorted(datos.get("meses", {}).items(), reverse=True)
+            for hallazgo in contenido["hallazgos"]
+        ]
+        hallazgos = pd.DataFrame(filas, columns=["Mes"] + COLUMNAS_HALLAZGO)
+        hallazgos.insert(2, "Descripción", hallazgos["Regla"].map(REGLAS))
+        hallazgos["Fecha"] = pd.to_datetime(hallazgos["Fecha"])
+        guardado = _reportes[ruta] = (firma, hallazgos, datos.get("generado"), datos.get("firma"))
+    _, hallazgos, generado, firma_datos = guardado
+    bajas = almacen.bajas()
+    if bajas:
+        hallazgos = hallazgos[~hallazgos[COLUMNA_ID].isin(bajas)]
+    return hallazgos, generado, firma_datos == repr(almacen.firma())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Revisa la calidad del historial de FINAL")
+    parser.add_argument("--libro", default="BASE_FINAL.xlsx")
+    parser.add_argument("--procesos", type=int, default=PROCESOS_CALIDAD)
+    parser.add_argument("--completo", action="store_true", help="vuelve a revisar todos los meses")
+    args = parser.parse_args()
+
+    almacen = obtener_almacen(args.libro)
+    if args.completo and os.path.exists(almacen.ruta_calidad()):
+        os.remove(almacen.ruta_calidad())
+    revisados = escanear(almacen, args.procesos)
+    print(f"Meses revisados: {', '.join(revisados) if revisados else 'ninguno (sin cambios)'}")
+    hallazgos, generado, _ = reporte(almacen)
+    print(f"Reporte del {generado}: {len(hallazgos)} hallazgos")
+    if not hallazgos.empty:
+        print(hallazgos.groupby("Regla").size().to_string())
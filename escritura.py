@@ -0,0 +1,187 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import pandas as pd
+
+import metricas
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Tiempo que espera el escritor para juntar envíos que llegan casi al mismo tiempo
+VENTANA_LOTE = 0.05
+
+
+class EnvioRechazado(Exception):
+    # La verificación hecha bajo el candado rechazó el envío; el mensaje es el motivo
+    pass
+
+
+@contextmanager
+def candado_archivo(ruta):
+    # Candado exclusivo del sistema operativo, válido entre procesos
+    with open(ruta, "a+b") as archivo:
+        if fcntl is not None:
+            fcntl.flock(archivo.fileno(), fcntl.LOCK_EX)
+        else:
+            archivo.seek(0)
+            msvcrt.locking(archivo.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(archivo.fileno(), fcntl.LOCK_UN)
+            else:
+                archivo.seek(0)
+                msvcrt.locking(archivo.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ColaEscritura:
+    # Único escritor por almacén dentro del proceso. Las operaciones se encolan y un hilo
+    # en segundo plano las aplica por lotes bajo el candado de archivo; el Future de cada
+    # operación se resuelve cuando su escritura ya está en el disco (fsync), con su propio
+    # resultado o su propio error.
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+        self.lotes_escritos = 0
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._procesar, name="escritor-final", daemon=True)
+        self._hilo.start()
+
+    def agregar(self, df_nuevo, verificar=None):
+        # verificar(registrados) corre bajo el candado, con el conteo de lo ya guardado más lo
+        # agregado antes en el mismo lote (como ingesta.py); si devuelve un motivo el envío no
+        # se guarda y su Future falla con EnvioRechazado
+        return self._encolar("agregar", (df_nuevo, verificar))
+
+    def eliminar_envio(self, id_envio):
+        return self._encolar("eliminar_envio", id_envio)
+
+    def _encolar(self, operacion, dato):
+        futuro = Future()
+        self._cola.put((operacion, dato, futuro))
+        return futuro
+
+    def _tomar_lote(self):
+        lote = [self._cola.get()]
+        time.sleep(VENTANA_LOTE)
+        while True:
+            try:
+                lote.append(self._cola.get_nowait())
+            except queue.Empty:
+                return lote
+
+    def _procesar(self):
+        while True:
+            lote = self._tomar_lote()
+            # Cada lote queda en el log de métricas con su espera del candado y su escritura
+            en_curso = metricas.iniciar("escritura", operaciones=len(lote))
+            inicio = time.perf_counter()
+            try:
+                with candado_archivo(self.almacen.ruta_candado()):
+                    en_curso.fases["espera_candado"] += time.perf_counter() - inicio
+                    with metricas.fase("escritura"):
+                        resultados = self._aplicar(lote)
+                self.lotes_escritos += 1
+            except Exception as e:
+                # Sin candado no se aplicó ninguna operación del lote
+                metricas.terminar(en_curso, error=str(e))
+                for _, _, futuro in lote:
+                    futuro.set_exception(e)
+                continue
+            errores = [resultado for correcto, resultado in resultados if not correcto]
+            metricas.terminar(en_curso, **({"error": str(errores[0]), "errores": len(errores)} if errores else {}))
+            for (_, _, futuro), (correcto, resultado) in zip(lote, resultados):
+                if correcto:
+                    futuro.set_result(resultado)
+                else:
+                    futuro.set_exception(resultado)
+
+    def _aplicar(self, lote):
+        # Las inserciones consecutivas se combinan en una sola escritura; las eliminaciones se
+        # aplican en el orden en que llegaron. Devuelve (correcto, resultado o excepción) por
+        # operación: el error de una eliminación no se informa en las inserciones ya escritas.
+        resultados = [None] * len(lote)
+        pendientes = []
+        registrados = None
+        en_lote = Counter()
+        for posicion, (operacion, dato, _) in enumerate(lote):
+            if operacion == "agregar":
+                df_nuevo, verificar = dato
+                if verificar is not None:
+                    if registrados is None:
+                        registrados = self.almacen.registrados()
+                    try:
+                        motivo = verificar(_RegistradosConLote(registrados, en_lote))
+                    except Exception as e:
+                        resultados[posicion] = (False, e)
+                        continue
+                    if motivo is not None:
+                        resultados[posicion] = (False, EnvioRechazado(motivo))
+                        continue
+                en_lote.update(_pares_registrados(df_nuevo))
+                pendientes.append(posicion)
+                continue
+            self._agregar_juntas(lote, pendientes, resultados)
+            pendientes = []
+            # Lo pendiente ya quedó guardado y la operación puede cambiar los registros
+            registrados = None
+            en_lote = Counter()
+            try:
+                resultados[posicion] = (True, getattr(self.almacen, operacion)(dato))
+            except Exception as e:
+                resultados[posicion] = (False, e)
+        self._agregar_juntas(lote, pendientes, resultados)
+        return resultados
+
+    def _agregar_juntas(self, lote, posiciones, resultados):
+        # Una sola escritura atómica: o quedan todas las inserciones o ninguna
+        if not posiciones:
+            return
+        try:
+            self.almacen.agregar(pd.concat([lote[posicion][1][0] for posicion in posiciones], ignore_index=True))
+        except Exception as e:
+            for posicion in posiciones:
+                resultados[posicion] = (False, e)
+            return
+        for posicion in posiciones:
+            resultados[posicion] = (True, len(lote[posicion][1][0]))
+
+
+class _RegistradosConLote:
+    # Se consulta como almacen.registrados() (conteo[(código, día)]) y suma las filas que el
+    # lote ya aceptó pero que todavía no se escribieron
+
+    def __init__(self, guardados, en_lote):
+        self.guardados = guardados
+        self.en_lote = en_lote
+
+    def __getitem__(self, par):
+        return self.guardados[par] + self.en_lote[par]
+
+
+def _pares_registrados(df):
+    fechas = pd.to_datetime(df["Fecha"], errors="coerce")
+    validos = df["Código"].notna() & fechas.notna()
+    return Counter(zip(df.loc[validos, "Código"].astype(str), fechas[validos].dt.date))
+
+
+_colas = {}
+_candado_colas = threading.Lock()
+
+
+def cola_escritura(almacen):
+    # Una cola por almacén y por proceso; sobrevive a los reruns de Streamlit
+    with _candado_colas:
+        cola = _colas.get(almacen.clave())
+        if cola is None:
+            cola = _colas[almacen.clave()] = ColaEscritura(almacen)
+        return cola
@@ -0,0 +1,121 @@
+import argparse
+import tempfile
+from datetime import date
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+
+import metricas
+from almacenamiento import COLUMNAS_FINAL, obtener_almacen
+
+# Descarga de los resultados del buscador de Producción Real. Los registros salen del almacén
+# por bloques (almacen.iterar) y cada bloque se escribe y se descarta, así que la memoria usada
+# no depende del rango exportado. El xlsx usa un libro de solo escritura de openpyxl, que
+# vuelca las filas a disco a medida que se agregan.
+
+COLUMNAS_RESULTADOS = [
+    "Fecha", "Molde", "Moldes/Persona", "Código", "Nombre",
+    "Cantidad", "Indicador de Producción", "Indicador de Tiempo",
+    "Indicador Retrabajo", "Producción Real Trabajada",
+]
+
+TAMANO_BLOQUE = 5000
+
+FORMATOS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Tipos fijos: cada bloque trae sus propias categorías y un bloque sin datos en una columna
+# no debe cambiar el esquema del archivo
+ESQUEMA_PARQUET = pa.schema([
+    ("Fecha", pa.timestamp("ms")),
+    ("Molde", pa.string()),
+    ("Moldes/Persona", pa.float64()),
+    ("Código", pa.string()),
+    ("Nombre", pa.string()),
+    ("Cantidad", pa.float64()),
+    ("Indicador de Producción", pa.float64()),
+    ("Indicador de Tiempo", pa.float64()),
+    ("Indicador Retrabajo", pa.float64()),
+    ("Producción Real Trabajada", pa.float64()),
+])
+
+
+def produccion_real(df):
+    # Los indicadores ya llegan numéricos desde el almacén: cálculo vectorizado
+    df["Producción Real Trabajada"] = (
+        df["Indicador de Producción"].to_numpy(dtype=float)
+        - df["Indicador de Tiempo"].to_numpy(dtype=float)
+        - df["Indicador Retrabajo"].to_numpy(dtype=float)
+    )
+    return df
+
+
+def bloques_resultados(almacen, desde=None, hasta=None, codigo=None, tamano=TAMANO_BLOQUE):
+    columnas = [columna for columna in COLUMNAS_RESULTADOS if columna in COLUMNAS_FINAL]
+    for bloque in almacen.iterar(desde, hasta, codigo, columnas, tamano):
+        bloque = produccion_real(bloque.copy())[COLUMNAS_RESULTADOS]
+        for campo in ESQUEMA_PARQUET:
+            if pa.types.is_string(campo.type):
+                serie = bloque[campo.name]
+                bloque[campo.name] = serie.astype(str).where(serie.notna())
+        yield bloque
+
+
+def escribir_csv(bloques, destino):
+    # Con BOM para que Excel reconozca los acentos al abrir el archivo
+    destino.write(pd.DataFrame(columns=COLUMNAS_RESULTADOS).to_csv(index=False).encode("utf-8-sig"))
+    for bloque in bloques:
+        destino.write(bloque.to_csv(index=False, header=False).encode("utf-8"))
+
+
+def escribir_xlsx(bloques, destino):
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet("Resultados")
+    hoja.append(COLUMNAS_RESULTADOS)
+    for bloque in bloques:
+        valores = bloque.astype(object).where(bloque.notna(), None)
+        for fila in valores.itertuples(index=False, name=None):
+            hoja.append(fila)
+    libro.save(destino)
+
+
+def escribir_parquet(bloques, destino):
+    with pq.ParquetWriter(destino, ESQUEMA_PARQUET) as escritor:
+        for bloque in bloques:
+            escritor.write_table(pa.Table.from_pandas(bloque, schema=ESQUEMA_PARQUET, preserve_index=False))
+
+
+ESCRITORES = {"xlsx": escribir_xlsx, "csv": escribir_csv, "parquet": escribir_parquet}
+
+
+def exportar(almacen, formato, desde=None, hasta=None, codigo=None):
+    # Los bloques se escriben en un temporal en disco y el archivo terminado se devuelve como
+    # bytes, que es lo que st.download_button acepta de la función de descarga diferida
+    with tempfile.TemporaryFile() as destino:
+        with metricas.medicion("exportacion", formato=formato):
+            ESCRITORES[formato](bloques_resultados(almacen, desde, hasta, codigo), destino)
+        destino.seek(0)
+        return destino.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporta los resultados de Producción Real Trabajada")
+    parser.add_argument("destino", help="archivo .xlsx, .csv o .parquet")
+    parser.add_argument("--libro", default="BASE_FINAL.xlsx")
+    parser.add_argument("--desde", type=date.fromisoformat, help="AAAA-MM-DD")
+    parser.add_argument("--hasta", type=date.fromisoformat, help="AAAA-MM-DD")
+    parser.add_argument("--codigo", help="código de operario")
+    args = parser.parse_args()
+
+    formato = args.destino.rsplit(".", 1)[-1].lower()
+    if formato not in ESCRITORES:
+        parser.error(f"formato no soportado: {formato} (use {', '.join(ESCRITORES)})")
+    almacen = obtener_almacen(args.libro)
+    with open(args.destino, "wb") as destino:
+        ESCRITORES[formato](bloques_resultados(almacen, args.desde, args.hasta, args.codigo), destino)
+    print(f"Resultados exportados a {args.destino}")
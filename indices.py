@@ -0,0 +1,103 @@
+from collections import namedtuple
+
+import pandas as pd
+
+# Índices de búsqueda sobre los datos maestros, construidos una sola vez al cargarlos:
+#   nombres: código de operario -> nombre
+#   moldes:  COD MAT normalizado -> DatosMolde
+#   fallas:  (CODIGO, PARTE MOLDE) normalizados -> DatosFalla
+#   partes:  PARTE MOLDE normalizadas (las de los moldes que no están en PARTES_POR_LETRA)
+#   lineas:  LINEA normalizadas
+IndicesMaestros = namedtuple("IndicesMaestros", ["nombres", "moldes", "fallas", "partes", "lineas"])
+DatosMolde = namedtuple("DatosMolde", ["moldes_turno", "personas_molde", "horas_molde"])
+DatosFalla = namedtuple("DatosFalla", ["cantidad_kg", "tiempo_min"])
+
+# Listas de opciones del formulario, compartidas por todas las sesiones y todos los operarios:
+#   valores:  tupla con "" (sin selección) en la posición 0
+#   posicion: valor -> índice en valores, para el valor por defecto de cada selectbox
+ListaOpciones = namedtuple("ListaOpciones", ["valores", "posicion"])
+OpcionesFormulario = namedtuple("OpcionesFormulario", ["moldes", "codigos", "partes", "lineas", "partes_por_letra"])
+
+# Partes del molde según su primera letra; los demás moldes usan todas las partes de Tiempo_Fallas
+PARTES_POR_LETRA = {
+    "I": ["BASE", "TAPA", "LATERAL"],
+    "D": ["MACHO", "HEMBRA"],
+    "L": ["MACHO", "HEMBRA"],
+    "V": ["MACHO", "HEMBRA"],
+    "O": ["BASE", "TAPA", "LATERAL"],
+    "T": ["MACHO", "HEMBRA"],
+}
+
+
+def normalizar(valor):
+    return str(valor).strip().upper()
+
+
+def _columna_normalizada(serie):
+    return serie.astype(str).str.strip().str.upper()
+
+
+def _a_float(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return None
+
+
+def _horas_molde(moldes_turno, personas_molde):
+    if pd.notna(moldes_turno) and pd.notna(personas_molde) and moldes_turno != 0:
+        return 8 * (personas_molde / moldes_turno)
+    return None
+
+
+def construir_indices(base_produccion, tiempo_fallas, operarios):
+    # Ante claves repetidas se conserva la primera fila, igual que las búsquedas con iloc[0]
+    operarios_unicos = operarios.dropna(subset=["CÓDIGO"]).drop_duplicates("CÓDIGO")
+    nombres = dict(zip(operarios_unicos["CÓDIGO"], operarios_unicos["OPERARIO"]))
+
+    base = base_produccion.assign(_clave=_columna_normalizada(base_produccion["COD MAT"]))
+    base = base.drop_duplicates("_clave")
+    moldes = {
+        clave: DatosMolde(moldes_turno, personas_molde, _horas_molde(moldes_turno, personas_molde))
+        for clave, moldes_turno, personas_molde in zip(base["_clave"], base["MOLDES/TURNO"], base["PERSONAS/MOLDE"])
+    }
+
+    fallas_df = tiempo_fallas.assign(
+        _codigo=_columna_normalizada(tiempo_fallas["CODIGO"]),
+        _parte=_columna_normalizada(tiempo_fallas["PARTE MOLDE"]),
+    ).drop_duplicates(["_codigo", "_parte"])
+    fallas = {
+        (codigo, parte): DatosFalla(_a_float(kg), _a_float(tiempo))
+        for codigo, parte, kg, tiempo in zip(
+            fallas_df["_codigo"], fallas_df["_parte"], fallas_df["CANTIDAD KG"], fallas_df["TIEMPO (MIN)"]
+        )
+    }
+
+    partes = frozenset(_columna_normalizada(tiempo_fallas["PARTE MOLDE"].dropna()))
+    lineas = frozenset(_columna_normalizada(tiempo_fallas["LINEA"].dropna()))
+    return IndicesMaestros(nombres, moldes, fallas, partes, lineas)
+
+
+def lista_opciones(valores):
+    # Sin repetidos: la posición de cada valor es la de su primera aparición
+    valores = ("",) + tuple(dict.fromkeys(valor for valor in valores if valor != ""))
+    return ListaOpciones(valores, {valor: i for i, valor in enumerate(valores)})
+
+
+def construir_opciones(base_produccion, tiempo_fallas, operarios):
+    return OpcionesFormulario(
+        moldes=lista_opciones(base_produccion["COD MAT"].dropna().astype(str)),
+        codigos=lista_opciones(operarios["CÓDIGO"].dropna().astype(str)),
+        partes=lista_opciones(_columna_normalizada(tiempo_fallas["PARTE MOLDE"].dropna())),
+        lineas=lista_opciones(tiempo_fallas["LINEA"].dropna().astype(str)),
+        partes_por_letra={letra: lista_opciones(lista) for letra, lista in PARTES_POR_LETRA.items()},
+    )
+
+
+def partes_validas(indices, molde):
+    # Las mismas partes que ofrece el formulario para el molde (partes_de_molde), normalizadas
+    return PARTES_POR_LETRA.get(str(molde)[:1].upper(), indices.partes) if molde else indices.partes
+
+
+def partes_de_molde(opciones, molde):
+    return opciones.partes_por_letra.get(str(molde)[:1].upper(), opciones.partes) if molde else opciones.partes
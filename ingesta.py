@@ -0,0 +1,89 @@
+import argparse
+from datetime import date, datetime
+
+import pandas as pd
+
+from almacenamiento import obtener_almacen
+from escritura import candado_archivo
+from maestros import cache_maestros
+from reglas import calcular_registros, preparar_filas, validar_envios
+
+# Carga por lotes de los partes de turno transcritos (CSV o xlsx), con las mismas reglas del formulario.
+# Columnas esperadas, una fila por operario:
+#   Fecha, Molde, Cantidad Total, Código, Parte, Cantidad, Molde Retrabajo, Linea Retrabajo,
+#   Tiempo Retrabajo (minutos)  (o bien Horas Retrabajo + Minutos Retrabajo)
+# Opcionales: Pieza (por defecto el molde) y Envío (agrupa los operarios de un mismo parte).
+# Fecha en formato AAAA-MM-DD o DD/MM/AAAA; las filas con otra fecha se rechazan.
+
+
+def leer_archivo(ruta, hoja=None):
+    if str(ruta).lower().endswith((".xlsx", ".xlsm", ".xls")):
+        filas = pd.read_excel(ruta, sheet_name=hoja or 0, dtype=str)
+    else:
+        filas = pd.read_csv(ruta, dtype=str, sep=None, engine="python")
+    filas.columns = filas.columns.str.strip()
+
+    if "Tiempo Retrabajo (minutos)" not in filas.columns:
+        cero = pd.Series(0, index=filas.index)
+        horas = pd.to_numeric(filas.get("Horas Retrabajo", cero), errors="coerce").fillna(0)
+        minutos = pd.to_numeric(filas.get("Minutos Retrabajo", cero), errors="coerce").fillna(0)
+        filas["Tiempo Retrabajo (minutos)"] = horas * 60 + minutos
+    for columna in ["Parte", "Cantidad", "Molde Retrabajo", "Linea Retrabajo"]:
+        if columna not in filas.columns:
+            filas[columna] = None
+
+    faltantes = [c for c in ["Fecha", "Molde", "Cantidad Total", "Código"] if c not in filas.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en {ruta}: {', '.join(faltantes)}")
+    return filas
+
+
+def ingresar(filas, almacen, simular=False):
+    # Valida y calcula todo el lote bajo el candado, para que el chequeo de duplicados
+    # vea lo mismo que la escritura; las filas aceptadas se guardan en una sola escritura.
+    filas = preparar_filas(filas)
+    indices = cache_maestros(almacen.ruta_maestros()).obtener().indices
+    with candado_archivo(almacen.ruta_candado()):
+        motivos = validar_envios(filas, indices, almacen.registrados(), date.today(), almacen.meses_cerrados())
+        rechazados = motivos[motivos.notna()]
+        aceptadas = filas[~filas["Envío"].isin(rechazados.index)]
+        registros = calcular_registros(aceptadas, indices, datetime.now())
+        if not simular and not registros.empty:
+            almacen.agregar(registros)
+
+    df_rechazos = filas[filas["Envío"].isin(rechazados.index)].assign(
+        Motivo=filas["Envío"].map(rechazados)
+    )
+    return registros, df_rechazos, len(motivos)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga por lotes de partes de turno en la hoja FINAL")
+    parser.add_argument(
+        "archivo",
+        help="CSV o xlsx con una fila por operario; Fecha como AAAA-MM-DD o DD/MM/AAAA (nunca mes/día)",
+    )
+    parser.add_argument("--hoja", help="hoja a leer si el archivo es xlsx (por defecto la primera)")
+    parser.add_argument("--libro", default="BASE_FINAL.xlsx")
+    parser.add_argument("--rechazos", help="CSV donde guardar las filas rechazadas con su motivo")
+    parser.add_argument("--simular", action="store_true", help="valida y calcula sin guardar")
+    args = parser.parse_args()
+
+    try:
+        filas = leer_archivo(args.archivo, args.hoja)
+    except ValueError as e:
+        parser.error(str(e))
+
+    registros, df_rechazos, n_envios = ingresar(filas, obtener_almacen(args.libro), simular=args.simular)
+    n_rechazados = df_rechazos["Envío"].nunique()
+    print(f"{n_envios - n_rechazados} envíos aceptados ({len(registros)} registros"
+          f"{', sin guardar' if args.simular else ' guardados'}), {n_rechazados} rechazados")
+
+    if n_rechazados:
+        resumen = df_rechazos.groupby("Envío", sort=False).agg(
+            Fecha=("Fecha", "first"), Molde=("Molde", "first"), Motivo=("Motivo", "first")
+        )
+        print(resumen.to_string())
+        if args.rechazos:
+            df_rechazos.to_csv(args.rechazos, index=False)
+            print(f"Filas rechazadas guardadas en {args.rechazos}")
@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+
+import metricas
+
+# Instantánea columnar (archivo Arrow IPC sin comprimir) de los registros de FINAL, guardada
+# junto al almacén. Lleva en sus metadatos la firma del almacén del que salió: si no coincide
+# con la firma actual se ignora. Se abre con memory map, así que leer unas pocas columnas no
+# decodifica el resto del archivo.
+
+# Columnas de texto muy repetidas: se guardan como categorías (diccionario en Arrow)
+COLUMNAS_CATEGORIA = ["Código", "Nombre", "Molde", "Pieza", "Parte", "Molde Retrabajo", "Linea Retrabajo"]
+
+
+def categorizar(df):
+    # Todo pasa a texto (el código de operario no mezcla números y cadenas) y las celdas
+    # vacías quedan como NaN, igual que al releerlas del libro de Excel
+    for columna in COLUMNAS_CATEGORIA:
+        if columna in df.columns and not isinstance(df[columna].dtype, pd.CategoricalDtype):
+            serie = df[columna]
+            texto = serie.astype(object).where(serie.isna(), serie.astype(str))
+            df[columna] = texto.mask(texto == "").astype("category")
+    return df
+
+
+def _marca(firma):
+    return repr(firma).encode("utf-8")
+
+
+def leer_instantanea(ruta, firma, columnas=None):
+    # Devuelve None si no hay instantánea o si es de otra versión de los datos
+    try:
+        lector = pa.ipc.open_file(pa.memory_map(ruta, "r"))
+        if (lector.schema.metadata or {}).get(b"firma") != _marca(firma):
+            return None
+        tabla = lector.read_all()
+        if columnas is not None:
+            tabla = tabla.select(columnas)
+        # Con memory map solo se leen del disco las columnas que se convierten
+        metricas.contar_io("lectura_instantanea", n_bytes=tabla.nbytes)
+        return tabla.to_pandas()
+    except (OSError, pa.ArrowException):
+        return None
+
+
+def escribir_instantanea(ruta, firma, df):
+    try:
+        tabla = pa.Table.from_pandas(df, preserve_index=False)
+    except pa.ArrowException:
+        # Columnas con tipos mezclados que Arrow no acepta: se sigue leyendo del almacén
+        return False
+    tabla = tabla.replace_schema_metadata({**(tabla.schema.metadata or {}), b"firma": _marca(firma)})
+
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ruta)), suffix=".arrow")
+    os.close(descriptor)
+    try:
+        with pa.OSFile(temporal, "wb") as destino, pa.ipc.new_file(destino, tabla.schema) as escritor:
+            escritor.write_table(tabla)
+        os.replace(temporal, ruta)
+        metricas.contar_io("escritura_instantanea", ruta)
+    except OSError:
+        # En Windows no se puede reemplazar un archivo que otro proceso tiene mapeado;
+        # la instantánea vieja queda con su firma anterior y se ignora
+        os.remove(temporal)
+        return False
+    return True
+
+
+def actualizar_instantanea(ruta, firma_antes, firma_despues, df_cambio, signo):
+    # Tras una escritura propia se aplica el cambio a la instantánea en lugar de releer el almacén.
+    # signo 1: filas agregadas; -1: filas eliminadas (un envío se identifica por su ID).
+    df = leer_instantanea(ruta, firma_antes)
+    if df is None:
+        return False
+    if signo > 0:
+        df = categorizar(pd.concat([df, categorizar(df_cambio.copy())], ignore_index=True))
+    else:
+        df = df[~df["ID Envío"].isin(df_cambio["ID Envío"])].reset_index(drop=True)
+    return escribir_instantanea(ruta, firma_despues, df)
@@ -0,0 +1,290 @@
+import html
+import itertools
+import os
+import re
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+
+import metricas
+
+# Lector rápido de solo lectura para los libros de la app. En lugar de pd.read_excel (que con
+# openpyxl arma el modelo completo del libro, estilos incluidos, una vez por hoja) se abre el
+# zip una sola vez y se recorre el XML de cada hoja pedida en streaming, fila por fila,
+# guardando solo las columnas pedidas. Los estilos no se leen: las columnas de fecha se
+# declaran en los tipos y se convierten desde el número de serie de Excel.
+#
+# Tipos de columna:
+#   "texto":  cadena (los códigos numéricos pasan a "1313"), vacíos NaN
+#   "fecha":  datetime; números de serie de Excel o texto con fecha
+#   "numero": float/int; el texto que no es número queda NaN
+# Las columnas sin tipo conservan el valor de la celda, igual que read_excel.
+
+# Hilos para leer varias hojas a la vez (YESERIA_HILOS_LECTURA); con 1 se leen en orden
+HILOS_LECTURA = int(os.environ.get("YESERIA_HILOS_LECTURA", "1"))
+
+_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+_TEXTO = _NS + "t"
+_TRAMO = _NS + "r"
+_TEXTOS_COMPARTIDOS = "xl/sharedStrings.xml"
+_EPOCA_EXCEL = pd.Timestamp("1899-12-30")
+_MS_POR_DIA = 86400000
+_TAMANO_BLOQUE = 1 << 20
+
+# El XML de las hojas se recorre con una expresión regular (como al agregar filas en
+# almacenamiento): bastante más rápido que armar un elemento por celda
+_PATRON_CELDA = re.compile(rb'<c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_PATRON_VALOR = re.compile(rb"<v>(.*?)</v>", re.S)
+_PATRON_TEXTO = re.compile(rb"<t\b[^>]*>(.*?)</t>", re.S)
+_INDICES_COLUMNA = {}
+
+
+class HojaNoEncontrada(ValueError):
+    pass
+
+
+class _FormatoNoReconocido(Exception):
+    pass
+
+
+def ruta_hoja(libro_zip, nombre_hoja):
+    # Parte del zip (xl/worksheets/sheetN.xml) de la hoja con ese nombre, o None
+    workbook = ElementTree.fromstring(libro_zip.read("xl/workbook.xml"))
+    id_relacion = None
+    for hoja in workbook.iter(_NS + "sheet"):
+        if hoja.get("name") == nombre_hoja:
+            id_relacion = hoja.get(_NS_REL)
+    if id_relacion is None:
+        return None
+
+    relaciones = ElementTree.fromstring(libro_zip.read("xl/_rels/workbook.xml.rels"))
+    for relacion in relaciones:
+        if relacion.get("Id") == id_relacion:
+            destino = relacion.get("Target")
+            return destino.lstrip("/") if destino.startswith("/") else "xl/" + destino
+    return None
+
+
+def _texto_si(elemento):
+    # Texto simple (<t>) o enriquecido (<r><t>); se omite la guía fonética
+    if elemento.find(_TEXTO) is not None:
+        return elemento.find(_TEXTO).text or ""
+    return "".join(tramo.findtext(_TEXTO, "") for tramo in elemento.iter(_TRAMO))
+
+
+def _textos_compartidos(libro_zip):
+    if _TEXTOS_COMPARTIDOS not in libro_zip.namelist():
+        return []
+    textos = []
+    for _, elemento in ElementTree.iterparse(libro_zip.open(_TEXTOS_COMPARTIDOS)):
+        if elemento.tag == _NS + "si":
+            textos.append(_texto_si(elemento))
+            elemento.clear()
+    return textos
+
+
+def _indice_columna(letras):
+    # b"AB" -> 27 (base 0)
+    indice = _INDICES_COLUMNA.get(letras)
+    if indice is None:
+        indice = 0
+        for letra in letras:
+            indice = indice * 26 + letra - 64
+        indice = _INDICES_COLUMNA[letras] = indice - 1
+    return indice
+
+
+def _texto_xml(texto):
+    texto = texto.decode("utf-8")
+    return html.unescape(texto) if "&" in texto else texto
+
+
+def _valor(tipo, contenido, textos):
+    # Valor de la celda como lo guarda Excel (sin estilos); los vacíos son None
+    if not contenido:
+        return None
+    if tipo == b"inlineStr":
+        if contenido.startswith(b"<is><t>") and contenido.count(b"<") == 4:
+            return _texto_xml(contenido[7:-9]) or None
+        return "".join(_texto_xml(texto) for texto in _PATRON_TEXTO.findall(contenido)) or None
+    if contenido.startswith(b"<v>") and contenido.endswith(b"</v>"):
+        valor = contenido[3:-4]
+    else:
+        valor = _PATRON_VALOR.search(contenido)
+        valor = valor.group(1) if valor else None
+    if not valor:
+        return None
+    if tipo == b"s":
+        return textos[int(valor)] or None
+    if tipo in (b"str", b"d"):
+        return _texto_xml(valor)
+    if tipo == b"b":
+        return valor == b"1"
+    if tipo == b"e":
+        return None
+    numero = float(valor)
+    return int(numero) if numero.is_integer() else numero
+
+
+def _celdas(archivo):
+    # (fila, columna, atributos, contenido) de cada celda del XML de la hoja, leyendo el zip por
+    # bloques que terminan en un fin de fila. Excel y openpyxl escriben siempre r="A1" como primer
+    # atributo; si alguna celda no lo tiene la hoja no se puede leer por este camino.
+    resto = b""
+    while True:
+        bloque = archivo.read(_TAMANO_BLOQUE)
+        texto = resto + bloque
+        corte = texto.rfind(b"</row>") + len(b"</row>") if bloque else len(texto)
+        if corte < len(b"</row>"):
+            resto = texto
+            continue
+        celdas = _PATRON_CELDA.findall(texto, 0, corte)
+        if len(celdas) != texto.count(b"<c ", 0, corte) + texto.count(b"<c>", 0, corte):
+            raise _FormatoNoReconocido
+        yield from celdas
+        resto = texto[corte:]
+        if not bloque:
+            return
+
+
+def _tipo(atributos):
+    inicio = atributos.find(b' t="')
+    if inicio == -1:
+        return b"n"
+    return atributos[inicio + 4:atributos.index(b'"', inicio + 4)]
+
+
+def _posiciones(encabezado, columnas, parte):
+    # Índice de cada columna pedida -> nombre, según la fila de encabezado
+    encabezados = {}
+    for indice in range(max(encabezado) + 1):
+        nombre = encabezado.get(indice)
+        nombre = f"Unnamed: {indice}" if nombre is None else str(nombre).strip()
+        encabezados.setdefault(nombre, indice)
+    if columnas is None:
+        columnas = list(encabezados)
+    faltantes = [columna for columna in columnas if columna not in encabezados]
+    if faltantes:
+        raise ValueError(f"La hoja {parte} no tiene las columnas: {', '.join(faltantes)}")
+    return {encabezados[columna]: columna for columna in columnas}
+
+
+def _leer_hoja(libro_zip, parte, textos, columnas):
+    # columnas: nombres pedidos (None = todas). La primera fila con datos es el encabezado.
+    # Devuelve None si el XML no tiene la forma que escriben Excel y openpyxl (prefijos de
+    # espacio de nombres o celdas sin referencia, por ejemplo).
+    with libro_zip.open(parte) as archivo:
+        if b"<sheetData" not in archivo.read(_TAMANO_BLOQUE):
+            return None
+    posiciones = None
+    valores = None
+    fila = {}
+    fila_actual = None
+    try:
+        with libro_zip.open(parte) as archivo:
+            # La marca final cierra la última fila
+            for letras, numero, atributos, contenido in itertools.chain(_celdas(archivo), [(b"", None, b"", b"")]):
+                if numero != fila_actual:
+                    if any(valor is not None for valor in fila.values()):
+                        if posiciones is None:
+                            posiciones = _posiciones(fila, columnas, parte)
+                            valores = {columna: [] for columna in posiciones.values()}
+                        else:
+                            for indice, columna in posiciones.items():
+                                valores[columna].append(fila.get(indice))
+                    fila = {}
+                    fila_actual = numero
+                if numero is None:
+                    break
+                indice = _indice_columna(letras)
+                if posiciones is None or indice in posiciones:
+                    fila[indice] = _valor(_tipo(atributos), contenido, textos)
+    except _FormatoNoReconocido:
+        return None
+    if valores is None:
+        return pd.DataFrame(columns=columnas or [])
+    # Columnas sin ningún valor: NaN numérico, como en read_excel
+    return pd.DataFrame({
+        columna: lista if any(valor is not None for valor in lista) else np.full(len(lista), np.nan)
+        for columna, lista in valores.items()
+    })
+
+
+def _como_fecha(serie):
+    # Número de serie de Excel redondeado al milisegundo, como openpyxl
+    numeros = pd.to_numeric(serie, errors="coerce")
+    dias = np.floor(numeros)
+    fechas = (
+        _EPOCA_EXCEL
+        + pd.to_timedelta(dias, unit="D")
+        + pd.to_timedelta(np.round((numeros - dias) * _MS_POR_DIA), unit="ms")
+    )
+    texto = serie.where(numeros.isna() & serie.notna())
+    if texto.notna().any():
+        fechas = fechas.fillna(pd.to_datetime(texto, errors="coerce"))
+    return fechas
+
+
+def _aplicar_tipos(df, tipos):
+    for columna, tipo in tipos.items():
+        if columna not in df.columns:
+            continue
+        serie = df[columna]
+        if tipo == "texto":
+            # Los vacíos siguen NaN (astype(str) solo los deja así desde pandas 3)
+            df[columna] = serie.astype(object).where(serie.isna(), serie.astype(str))
+        elif tipo == "fecha":
+            if not pd.api.types.is_datetime64_any_dtype(serie):
+                df[columna] = _como_fecha(serie)
+        elif tipo == "numero":
+            df[columna] = pd.to_numeric(serie, errors="coerce")
+        else:
+            raise ValueError(f"tipo de columna desconocido: {tipo}")
+    return df
+
+
+def _leer_con_pandas(ruta, nombre, columnas):
+    # Hojas con un XML que el lector rápido no reconoce
+    df = pd.read_excel(ruta, sheet_name=nombre)
+    df.columns = df.columns.astype(str).str.strip()
+    if columnas is None:
+        return df
+    faltantes = [columna for columna in columnas if columna not in df.columns]
+    if faltantes:
+        raise ValueError(f"La hoja {nombre} no tiene las columnas: {', '.join(faltantes)}")
+    return df[columnas]
+
+
+def leer_hojas(ruta, hojas, tipos=None, hilos=None):
+    # hojas: {nombre: columnas o None}; tipos: {columna: tipo} para cualquiera de las hojas.
+    # Devuelve {nombre: DataFrame}; una hoja que no existe es un ValueError, como en read_excel.
+    hilos = HILOS_LECTURA if hilos is None else hilos
+    with zipfile.ZipFile(ruta) as libro_zip:
+        partes = {}
+        for nombre in hojas:
+            partes[nombre] = ruta_hoja(libro_zip, nombre)
+            if partes[nombre] is None:
+                raise HojaNoEncontrada(f"Worksheet named '{nombre}' not found")
+        textos = _textos_compartidos(libro_zip)
+
+        def leer(nombre):
+            df = _leer_hoja(libro_zip, partes[nombre], textos, hojas[nombre])
+            if df is None:
+                df = _leer_con_pandas(ruta, nombre, hojas[nombre])
+            return _aplicar_tipos(df, tipos or {})
+
+        if hilos > 1 and len(hojas) > 1:
+            with ThreadPoolExecutor(max_workers=min(hilos, len(hojas))) as ejecutor:
+                resultado = dict(zip(hojas, ejecutor.map(leer, hojas)))
+        else:
+            resultado = {nombre: leer(nombre) for nombre in hojas}
+
+        # Solo se descomprimen las hojas pedidas y los textos compartidos
+        leidas = list(partes.values()) + [_TEXTOS_COMPARTIDOS]
+        n_bytes = sum(info.compress_size for info in libro_zip.infolist() if info.filename in leidas)
+    metricas.contar_io("lectura", hojas=len(hojas), n_bytes=n_bytes)
+    return resultado
@@ -0,0 +1,129 @@
+import argparse
+import os
+import threading
+from collections import namedtuple
+
+from openpyxl import load_workbook
+
+import metricas
+from almacenamiento import (
+    HOJAS_MAESTRAS, firma_archivo, guardar_libro, huella_hojas, leer_maestros, obtener_almacen, ruta_maestros,
+)
+from indices import construir_indices, construir_opciones
+
+# Datos maestros (Base_Produccion, Tiempo_Fallas, Operarios) en memoria, compartidos por todas
+# las sesiones del proceso. Cada acceso compara (mtime, tamaño) del libro de maestros; si cambió,
+# un hilo en segundo plano compara la huella de las hojas maestras y solo si es distinta vuelve a
+# leerlas; mientras tanto las sesiones siguen con la versión anterior, sin esperar. Si los maestros
+# aún viven en el libro de registros, un guardado en FINAL cambia la firma pero no la huella.
+DatosMaestros = namedtuple(
+    "DatosMaestros", ["base_produccion", "tiempo_fallas", "operarios", "indices", "opciones", "huella", "version"]
+)
+
+
+class CacheMaestros:
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.datos = None
+        self.ultimo_error = None
+        self._firma = None
+        self._recargando = False
+        self._candado = threading.Lock()
+
+    def obtener(self):
+        if self.datos is None:
+            # Primera carga del proceso: no hay versión anterior que mostrar
+            metricas.contar_cache("maestros", False)
+            with self._candado:
+                if self.datos is None:
+                    firma = firma_archivo(self.ruta)
+                    self.datos = self._leer(0)
+                    self._firma = firma
+            return self.datos
+        metricas.contar_cache("maestros", True)
+        self._revisar()
+        return self.datos
+
+    def _revisar(self):
+        firma = firma_archivo(self.ruta)
+        if firma == self._firma or firma is None:
+            return
+        with self._candado:
+            if self._recargando or firma == self._firma:
+                return
+            self._recargando = True
+        threading.Thread(target=self._recargar, args=(firma,), name="recarga-maestros", daemon=True).start()
+
+    def _recargar(self, firma):
+        try:
+            with metricas.medicion("recarga_maestros"):
+                if huella_hojas(self.ruta, HOJAS_MAESTRAS) != self.datos.huella:
+                    self.datos = self._leer(self.datos.version + 1)
+            self.ultimo_error = None
+        except Exception as e:
+            # Libro a medio guardar o con errores: se sigue con la versión anterior. La firma
+            # igual se marca como vista; cuando el libro se vuelva a guardar se reintenta.
+            self.ultimo_error = e
+        finally:
+            with self._candado:
+                self._firma = firma
+                self._recargando = False
+
+    def _leer(self, version):
+        huella = huella_hojas(self.ruta, HOJAS_MAESTRAS)
+        base_produccion, tiempo_fallas, operarios = leer_maestros(self.ruta)
+        indices = construir_indices(base_produccion, tiempo_fallas, operarios)
+        opciones = construir_opciones(base_produccion, tiempo_fallas, operarios)
+        return DatosMaestros(base_produccion, tiempo_fallas, operarios, indices, opciones, huella, version)
+
+
+_caches = {}
+_candado_caches = threading.Lock()
+
+
+def cache_maestros(ruta):
+    # Uno por libro de maestros y por proceso; sobrevive a los reruns de Streamlit
+    clave = os.path.abspath(ruta)
+    with _candado_caches:
+        cache = _caches.get(clave)
+        if cache is None:
+            cache = _caches[clave] = CacheMaestros(ruta)
+        return cache
+
+
+def separar_maestros(ruta_libro, destino, quitar=False):
+    # Copia las hojas maestras a su propio libro (con sus fórmulas) y, con quitar=True, las
+    # elimina del libro de registros para que los guardados de FINAL no las vuelvan a escribir.
+    # Los dos libros se guardan sobre una copia: la app puede estar leyéndolos.
+    maestros = load_workbook(ruta_libro)
+    for hoja in list(maestros.sheetnames):
+        if hoja not in HOJAS_MAESTRAS:
+            maestros.remove(maestros[hoja])
+    guardar_libro(maestros, destino)
+
+    if quitar:
+        libro = load_workbook(ruta_libro)
+        for hoja in HOJAS_MAESTRAS:
+            if hoja in libro.sheetnames:
+                libro.remove(libro[hoja])
+        guardar_libro(libro, ruta_libro)
+    return maestros.sheetnames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Separa los datos maestros del libro de registros")
+    parser.add_argument("--libro", default="BASE_FINAL.xlsx")
+    parser.add_argument("--destino", help="libro de maestros (por defecto el que usa la aplicación)")
+    parser.add_argument("--quitar", action="store_true", help="elimina las hojas maestras del libro de registros")
+    args = parser.parse_args()
+
+    destino = args.destino or ruta_maestros(args.libro, existente=False)
+    if os.path.abspath(destino) == os.path.abspath(args.libro):
+        parser.error("el destino debe ser un libro distinto de --libro")
+    from escritura import candado_archivo
+
+    # Con --quitar se reescribe el libro de registros: se toma el mismo candado que los guardados
+    with candado_archivo(obtener_almacen(args.libro).ruta_candado()):
+        hojas = separar_maestros(args.libro, destino, args.quitar)
+    print(f"Hojas {', '.join(hojas)} copiadas a {destino}" + (f" y quitadas de {args.libro}" if args.quitar else ""))
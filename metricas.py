@@ -0,0 +1,184 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+# Instrumentación de cada rerun de programa.py y de cada lote del escritor.
+# Una medición vive en el hilo que la inició (el hilo del script de Streamlit o el del escritor);
+# fuera de una medición (scripts, CLI) las funciones de conteo no hacen nada.
+# Cada medición terminada se agrega como una línea JSON al log (YESERIA_METRICAS, vacío para
+# desactivarlo) y se puede resumir con: python metricas.py
+# Al pasar de YESERIA_METRICAS_MB el log se rota a <log>.1 (se conserva un solo archivo anterior)
+# y los resúmenes leen solo las últimas líneas.
+
+RUTA_LOG = os.environ.get("YESERIA_METRICAS", "metricas.jsonl")
+TAMANO_MAXIMO_LOG = int(float(os.environ.get("YESERIA_METRICAS_MB", "10")) * 1024 * 1024)
+_BLOQUE_LOG = 1 << 16
+
+_local = threading.local()
+_candado_log = threading.Lock()
+
+
+class Medicion:
+    def __init__(self, tipo, **datos):
+        self.tipo = tipo
+        self.datos = datos
+        self.inicio = datetime.now()
+        self.fases = Counter()
+        self.io = Counter()
+        self.cache = Counter()
+        self._reloj = time.perf_counter()
+        self.total_s = None
+
+    def transcurrido(self):
+        return time.perf_counter() - self._reloj
+
+    def como_dict(self):
+        return {
+            "tipo": self.tipo,
+            "inicio": self.inicio.isoformat(timespec="milliseconds"),
+            "total_s": round(self.total_s if self.total_s is not None else self.transcurrido(), 4),
+            "fases": {fase: round(segundos, 4) for fase, segundos in self.fases.items()},
+            "io": dict(self.io),
+            "cache": dict(self.cache),
+            **self.datos,
+        }
+
+
+def actual():
+    return getattr(_local, "medicion", None)
+
+
+def iniciar(tipo, **datos):
+    _local.medicion = Medicion(tipo, **datos)
+    return _local.medicion
+
+
+def terminar(en_curso, **datos):
+    # Se llama también antes de st.rerun()/st.stop(), que cortan el script con una excepción
+    if en_curso.total_s is not None:
+        return
+    en_curso.total_s = en_curso.transcurrido()
+    en_curso.datos.update(datos)
+    if actual() is en_curso:
+        _local.medicion = None
+    if RUTA_LOG:
+        linea = json.dumps(en_curso.como_dict(), ensure_ascii=False)
+        try:
+            with _candado_log:
+                with open(RUTA_LOG, "a", encoding="utf-8") as log:
+                    log.write(linea + "\n")
+                    lleno = log.tell() > TAMANO_MAXIMO_LOG
+                if lleno:
+                    os.replace(RUTA_LOG, RUTA_LOG + ".1")
+        except OSError:
+            pass  # las métricas nunca deben interrumpir la aplicación
+
+
+@contextmanager
+def medicion(tipo, **datos):
+    en_curso = iniciar(tipo, **datos)
+    try:
+        yield en_curso
+    finally:
+        terminar(en_curso)
+
+
+@contextmanager
+def fase(nombre):
+    # Las fases pueden anidarse (p. ej. la tabla dentro de su sección); cada una suma su propio tiempo
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        en_curso = actual()
+        if en_curso is not None:
+            en_curso.fases[nombre] += time.perf_counter() - inicio
+
+
+def sumar_fase(nombre, inicio):
+    # Para secciones largas del script donde un bloque with obligaría a reindentar todo
+    en_curso = actual()
+    if en_curso is not None:
+        en_curso.fases[nombre] += time.perf_counter() - inicio
+
+
+def contar_io(operacion, ruta=None, hojas=0, n_bytes=None):
+    # operacion: "lectura" o "escritura"; sin n_bytes se toma el tamaño actual del archivo
+    en_curso = actual()
+    if en_curso is None:
+        return
+    if n_bytes is None:
+        try:
+            n_bytes = os.path.getsize(ruta)
+        except (OSError, TypeError):
+            n_bytes = 0
+    en_curso.io[f"{operacion}_bytes"] += n_bytes
+    if hojas:
+        en_curso.io[f"{operacion}_hojas"] += hojas
+
+
+def contar_cache(nombre, acierto):
+    en_curso = actual()
+    if en_curso is not None:
+        en_curso.cache[f"{nombre}_{'acierto' if acierto else 'fallo'}"] += 1
+
+
+def _ultimas_lineas(ruta, cantidad):
+    # Lee el archivo desde el final, por bloques, hasta juntar las líneas pedidas
+    with open(ruta, "rb") as log:
+        posicion = log.seek(0, os.SEEK_END)
+        datos = b""
+        while posicion > 0 and datos.count(b"\n") <= cantidad:
+            tamano = min(_BLOQUE_LOG, posicion)
+            posicion -= tamano
+            log.seek(posicion)
+            datos = log.read(tamano) + datos
+    lineas = datos.split(b"\n")
+    if posicion > 0:
+        lineas = lineas[1:]  # la primera puede haber quedado cortada por el bloque
+    return [linea.decode("utf-8") for linea in lineas if linea.strip()][-cantidad:]
+
+
+def leer_log(ruta=None, ultimas=2000):
+    # Las últimas mediciones del log y, si no alcanzan, del archivo rotado
+    ruta = ruta or RUTA_LOG
+    lineas = []
+    for archivo in (ruta, ruta + ".1"):
+        if len(lineas) >= ultimas:
+            break
+        try:
+            lineas = _ultimas_lineas(archivo, ultimas - len(lineas)) + lineas
+        except OSError:
+            continue
+    return [json.loads(linea) for linea in lineas]
+
+
+def percentiles(registros):
+    # p50/p95 del total y de cada fase, por tipo de medición
+    filas = []
+    for registro in registros:
+        filas.append((registro["tipo"], "total", registro["total_s"]))
+        filas.extend((registro["tipo"], fase, segundos) for fase, segundos in registro["fases"].items())
+    if not filas:
+        return pd.DataFrame(columns=["Tipo", "Medida", "N", "p50 (s)", "p95 (s)"])
+    df = pd.DataFrame(filas, columns=["Tipo", "Medida", "Segundos"])
+    return df.groupby(["Tipo", "Medida"])["Segundos"].agg(
+        N="count", **{"p50 (s)": lambda s: s.quantile(0.5), "p95 (s)": lambda s: s.quantile(0.95)}
+    ).reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumen p50/p95 del log de métricas de la aplicación")
+    parser.add_argument("--log", default=RUTA_LOG)
+    parser.add_argument("--ultimas", type=int, default=2000, help="cantidad de mediciones recientes a considerar")
+    args = parser.parse_args()
+
+    resumen = percentiles(leer_log(args.log, args.ultimas))
+    print(resumen.to_string(index=False) if not resumen.empty else f"Sin mediciones en {args.log}")
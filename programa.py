@@ -1,13 +1,28 @@
 import streamlit as st
 import pandas as pd
-import os
-from openpyxl import load_workbook
 from datetime import datetime, date
+from concurrent.futures import TimeoutError as EsperaAgotada
+import functools
+import os
 import re
+import time
 import streamlit.components.v1 as components
+import calidad
+import metricas
+from agregados import resumir_agregado
+from almacenamiento import COLUMNA_ID, COLUMNAS_FINAL, obtener_almacen
+from escritura import EnvioRechazado, cola_escritura
+from exportacion import COLUMNAS_RESULTADOS, FORMATOS, exportar, produccion_real
+from indices import normalizar, partes_de_molde
+from maestros import cache_maestros
+from reglas import calcular_registros, preparar_filas, validar_envios
 
 st.set_page_config(page_title="Producción Yeseria", layout="wide")
 
+# Tiempos por fase, E/S y aciertos de caché de este rerun (metricas.py); se cierra al final del
+# script o justo antes de cada st.rerun()/st.stop()
+medicion_rerun = metricas.iniciar("rerun")
+
 if st.session_state.get("__desplazar_temp", False):
     components.html(
         """
@@ -30,519 +45,534 @@ st.title("📋 FORMULARIO PRODUCCIÓN DE YESERIA")
 
 ruta_archivo = "BASE_FINAL.xlsx"
 
+# Tamaño de la cuadrilla del formulario
+OPERARIOS_POR_DEFECTO = 5
+MAX_OPERARIOS = 20
+
+# Los indicadores se guardan como número y solo se formatean como porcentaje al mostrarlos
+formato_indicadores = {
+    "Indicador de Producción": st.column_config.NumberColumn(format="%.1f%%"),
+    "Indicador de Tiempo": st.column_config.NumberColumn(format="%.2f%%"),
+    "Indicador Retrabajo": st.column_config.NumberColumn(format="%.2f%%"),
+    "Producción Real Trabajada": st.column_config.NumberColumn(format="%.2f%%"),
+}
+almacen = obtener_almacen(ruta_archivo)
+escritor = cola_escritura(almacen)
+
 def limpiar_texto(texto):
     texto = texto.strip().upper()
     texto = texto.replace("Á", "A").replace("É", "E").replace("Í", "I").replace("Ó", "O").replace("Ú", "U")
     texto = re.sub(r"[^A-Z0-9]", "", texto)
     return texto
 
-def obtener_nombre(codigo, df_operarios):
-    fila = df_operarios[df_operarios["CÓDIGO"] == codigo]
-    return fila.iloc[0]["OPERARIO"] if not fila.empty else "NO ENCONTRADO"
-
-def obtener_hora_molde(molde, base_produccion):
-    fila = base_produccion[base_produccion["COD MAT"].astype(str).str.strip().str.upper() == molde.strip().upper()]
-    if not fila.empty:
-        moldes_turno = fila.iloc[0]["MOLDES/TURNO"]
-        personas_molde = fila.iloc[0]["PERSONAS/MOLDE"]
-        if pd.notna(moldes_turno) and pd.notna(personas_molde) and moldes_turno != 0:
-            return 8 * (personas_molde / moldes_turno)
-    return None
-
-@st.cache_data
 def cargar_datos():
+    # Caché del proceso con recarga en segundo plano: una edición del libro de maestros se ve
+    # en los reruns siguientes sin reiniciar la aplicación, y los guardados no la invalidan
     try:
-        base_produccion = pd.read_excel(ruta_archivo, sheet_name="Base_Produccion")
-        tiempo_fallas = pd.read_excel(ruta_archivo, sheet_name="Tiempo_Fallas")
-        operarios = pd.read_excel(ruta_archivo, sheet_name="Operarios", dtype={"CÓDIGO": str})
-
-        tiempo_fallas.columns = tiempo_fallas.columns.str.strip()
-        base_produccion.columns = base_produccion.columns.str.strip()
-        operarios.columns = operarios.columns.str.strip()
-
-        return base_produccion, tiempo_fallas, operarios
+        return cache_maestros(almacen.ruta_maestros()).obtener()
     except Exception as e:
         st.error(f"Error al cargar los datos: {e}")
-        return None, None, None
+        return None
 
-def cargar_final():
+def cargar_final(desde=None, hasta=None, columnas=None):
+    # El almacén mantiene una sola lectura en memoria por versión de los datos;
+    # con un rango de fechas el almacén particionado abre solo los meses del rango
     try:
-        df = pd.read_excel(ruta_archivo, sheet_name="FINAL")
-        if not pd.api.types.is_datetime64_any_dtype(df['Fecha']):
-            df['Fecha'] = pd.to_datetime(df['Fecha'], errors='coerce')
-        return df
+        if desde is None and hasta is None:
+            return almacen.leer_final(columnas)
+        return almacen.buscar(desde, hasta)
     except Exception as e:
         # Si la hoja no existe o hay error, devolver DF vacío
         return pd.DataFrame()
 
-base_produccion, tiempo_fallas, operarios = cargar_datos()
-df_final = cargar_final() 
-
-if not all([base_produccion is not None, tiempo_fallas is not None, operarios is not None]):
+def terminar_medicion(**datos):
+    # Antes de st.rerun(): cierra la medición en curso, sea la del script completo o la de una sección
+    en_curso = metricas.actual()
+    if en_curso is not None:
+        metricas.terminar(en_curso, **datos)
+
+def seccion(funcion):
+    # Cada sección de la página es un st.fragment: un cambio en uno de sus widgets vuelve a
+    # ejecutar solo esa sección, con sus propios datos. Guardar, eliminar y limpiar el
+    # formulario siguen pidiendo un rerun completo para que las demás secciones se actualicen.
+    # En un rerun parcial no corre el inicio del script, así que la sección se mide aparte.
+    @st.fragment
+    @functools.wraps(funcion)
+    def envoltura():
+        if metricas.actual() is not None:
+            return funcion()
+        with metricas.medicion("rerun_" + funcion.__name__.removeprefix("seccion_")):
+            return funcion()
+    return envoltura
+
+def operarios_llenos():
+    # Último operario del formulario con algún dato cargado (0 si no hay ninguno)
+    llenos = [
+        i for i in range(1, MAX_OPERARIOS + 1)
+        if st.session_state.get(f"op_{i}", "") or st.session_state.get(f"parte_{i}", "") or st.session_state.get(f"cant_{i}", 0)
+    ]
+    return max(llenos, default=0)
+
+def ajustar_cuadrilla():
+    # Al elegir un molde la cuadrilla toma sus PERSONAS/MOLDE de Base_Produccion; luego se puede cambiar.
+    # Solo se achica con el primer molde del registro: lo escrito en el formulario no llega a
+    # session_state hasta enviarlo, y quitar esas filas lo perdería. Nunca queda por debajo
+    # de los operarios que ya tienen datos.
+    datos = cargar_datos()
+    molde_elegido = st.session_state.get("molde", "")
+    primer_molde = "molde_cuadrilla" not in st.session_state
+    st.session_state["molde_cuadrilla"] = molde_elegido
+    datos_molde = datos.indices.moldes.get(normalizar(molde_elegido)) if datos is not None and molde_elegido else None
+    if datos_molde is not None and pd.notna(datos_molde.personas_molde):
+        personas = min(max(int(datos_molde.personas_molde), 1), MAX_OPERARIOS)
+        minimo = operarios_llenos() if primer_molde else st.session_state.get("n_operarios", OPERARIOS_POR_DEFECTO)
+        st.session_state["n_operarios"] = max(personas, minimo)
+
+with metricas.fase("datos_maestros"):
+    datos_maestros = cargar_datos()
+
+if datos_maestros is None:
+    metricas.terminar(medicion_rerun)
     st.stop()
 
-moldes = base_produccion["COD MAT"].dropna().astype(str).unique().tolist()
-codigos_operarios = operarios["CÓDIGO"].dropna().astype(str).tolist()
-partes = tiempo_fallas["PARTE MOLDE"].dropna().astype(str).str.strip().str.upper().unique().tolist()
-lineas_disponibles = tiempo_fallas["LINEA"].dropna().astype(str).unique().tolist()
-
-fecha = st.date_input("Fecha", value=st.session_state.get("fecha", date.today()), max_value=date.today(), key="fecha")
-
-if "molde" not in st.session_state:
-    st.session_state["molde"] = ""
-
-lista_moldes = [""] + moldes
-molde = st.selectbox("Molde", options=[""] + moldes, key="molde")
-cantidad_total = st.number_input("Cantidad Total Producida", min_value=0, value=st.session_state.get("cantidad_total", 0), key="cantidad_total")
-
-partes_por_letra = {
-    "I": ["BASE", "TAPA", "LATERAL"],
-    "D": ["MACHO", "HEMBRA"],
-    "L": ["MACHO", "HEMBRA"],
-    "V": ["MACHO", "HEMBRA"],
-    "O": ["BASE", "TAPA", "LATERAL"],
-    "T": ["MACHO", "HEMBRA"],
-}
+@seccion
+def seccion_formulario():
+    datos = cargar_datos()
+    if datos is None:
+        return
+    indices, opciones = datos.indices, datos.opciones
 
-# Obtener las piezas relacionadas al molde seleccionado (filtradas desde tiempo_fallas)
-piezas_disponibles = [molde] if molde else []
+    inicio_fase = time.perf_counter()
 
-st.subheader("Ingreso Operarios")
+    fecha = st.date_input("Fecha", value=st.session_state.get("fecha", date.today()), max_value=date.today(), key="fecha")
 
-with st.form("formulario_final"):
-    operarios_merma = []
+    if "molde" not in st.session_state:
+        st.session_state["molde"] = ""
 
-    for i in range(1, 6):
-        with st.expander(f"👷 Operario {i}", expanded=(i == 1)):
-            codigo_default = st.session_state.get(f"op_{i}", "")
-            op_codigo = st.selectbox(
-                f"Código Operario",
-                options=[""] + codigos_operarios,
-                index=([""] + codigos_operarios).index(codigo_default) if codigo_default in codigos_operarios else 0,
-                key=f"op_{i}"
-            )
+    molde = st.selectbox("Molde", options=opciones.moldes.valores, key="molde", on_change=ajustar_cuadrilla)
+    cantidad_total = st.number_input("Cantidad Total Producida", min_value=0, value=st.session_state.get("cantidad_total", 0), key="cantidad_total")
 
-            col1, col2, col3 = st.columns(3)
-
-            with col1:
-                st.markdown("#### 🛠️ Pieza Mal Hecha")
-                pieza = molde if molde else ""
-                st.text_input(f"Pieza", value=pieza, disabled=True, key=f"pieza_{i}")
-
-            with col2:
-                st.markdown("#### ")
-                letra_inicial = molde[0].upper() if molde else ""
-                partes_filtradas = partes_por_letra.get(letra_inicial, partes)
-                parte_default = st.session_state.get(f"parte_{i}", "")
-                parte = st.selectbox(
-                    f"Parte Molde",
-                    options=[""] + partes_filtradas,
-                    index=([""] + partes_filtradas).index(parte_default) if parte_default in partes_filtradas else 0,
-                    key=f"parte_{i}"
-                )
+    # Las opciones vienen precalculadas con los maestros (indices.construir_opciones), con un
+    # mapa valor -> posición para el índice por defecto de cada selectbox
+    partes_molde = partes_de_molde(opciones, molde)
 
-            with col3:
-                st.markdown("#### ")
-                cantidad_input = st.number_input(
-                    f"Cantidad",
-                    min_value=0,
-                    value=st.session_state.get(f"cant_{i}", 0),
-                    step=1,
-                    key=f"cant_{i}"
-                )
+    st.subheader("Ingreso Operarios")
+    if "n_operarios" not in st.session_state:
+        st.session_state["n_operarios"] = OPERARIOS_POR_DEFECTO
+    n_operarios = st.number_input("Número de operarios", min_value=1, max_value=MAX_OPERARIOS, step=1, key="n_operarios")
 
-            st.markdown("##### 🔄 Informe de Retrabajo")
-            colr1, colr2, colr3 = st.columns([3, 3, 4])
+    with st.form("formulario_final"):
+        operarios_merma = []
 
-            with colr1:
-                molde_retra_default = st.session_state.get(f"molde_retrabajo_{i}", molde)
-                molde_retrabajo = st.selectbox(
-                    f"Molde Retrabajo",
-                    options=[""] + moldes,
-                    index=([""] + moldes).index(molde_retra_default) if molde_retra_default in moldes else 0,
-                    key=f"molde_retrabajo_{i}"
+        # Solo se dibujan los operarios de la cuadrilla
+        for i in range(1, n_operarios + 1):
+            with st.expander(f"👷 Operario {i}", expanded=(i == 1)):
+                codigo_default = st.session_state.get(f"op_{i}", "")
+                op_codigo = st.selectbox(
+                    f"Código Operario",
+                    options=opciones.codigos.valores,
+                    index=opciones.codigos.posicion.get(codigo_default, 0),
+                    key=f"op_{i}"
                 )
 
-            with colr2:
-                linea_default = st.session_state.get(f"linea_retrabajo_{i}", "")
-                linea_retrabajo = st.selectbox(
-                    "Línea",
-                    options=[""] + lineas_disponibles,
-                    index=([""] + lineas_disponibles).index(linea_default) if linea_default in lineas_disponibles else 0,
-                    key=f"linea_retrabajo_{i}"
-                )
-
-            with colr3:
-                col_horas, col_minutos = st.columns([1, 1])
-                with col_horas:
-                    horas_retrabajo = st.number_input(
-                        "Horas",
-                        min_value=0,
-                        max_value=8,
-                        value=st.session_state.get(f"horas_retrabajo_{i}", 0),
-                        step=1,
-                        key=f"horas_retrabajo_{i}"
+                col1, col2, col3 = st.columns(3)
+
+                with col1:
+                    st.markdown("#### 🛠️ Pieza Mal Hecha")
+                    pieza = molde if molde else ""
+                    st.text_input(f"Pieza", value=pieza, disabled=True, key=f"pieza_{i}")
+
+                with col2:
+                    st.markdown("#### ")
+                    parte_default = st.session_state.get(f"parte_{i}", "")
+                    parte = st.selectbox(
+                        f"Parte Molde",
+                        options=partes_molde.valores,
+                        index=partes_molde.posicion.get(parte_default, 0),
+                        key=f"parte_{i}"
                     )
-                with col_minutos:
-                    minutos_retrabajo = st.number_input(
-                        "Minutos",
+
+                with col3:
+                    st.markdown("#### ")
+                    cantidad_input = st.number_input(
+                        f"Cantidad",
                         min_value=0,
-                        max_value=59,
-                        value=st.session_state.get(f"minutos_retrabajo_{i}", 0),
+                        value=st.session_state.get(f"cant_{i}", 0),
                         step=1,
-                        key=f"minutos_retrabajo_{i}"
+                        key=f"cant_{i}"
                     )
 
-        tiempo_retrabajo_total = horas_retrabajo * 60 + minutos_retrabajo
-        indicador_retrabajo = round((tiempo_retrabajo_total / 480) * 100, 2)
-
-        operarios_merma.append({
-            "codigo": op_codigo,
-            "pieza": pieza,
-            "parte": parte,
-            "cantidad_merma": cantidad_input,
-            "molde_retrabajo": molde_retrabajo,
-            "linea_retrabajo": linea_retrabajo,
-            "tiempo_retrabajo_min": tiempo_retrabajo_total,
-            "indicador_retrabajo": indicador_retrabajo,
-        })
-
-    submit = st.form_submit_button("✅ Guardar Registro de Producción")
-
-
-if st.button("🧹 Limpiar Formulario"):
-    # Guardamos una bandera para activar el scroll
-    st.session_state["__desplazar_temp"] = True
-
-    # Guardamos claves que queremos conservar
-    claves_conservar = ["__desplazar_temp"]
-
-    # Borramos todas las demás claves (formulario completo)
-    claves_a_borrar = [clave for clave in st.session_state.keys() if clave not in claves_conservar]
-    for clave in claves_a_borrar:
-        del st.session_state[clave]
-
-    st.rerun()
-
-if st.session_state.get("registro_exitoso", False):
-    st.success("✅ Registro guardado con éxito.")
-    del st.session_state["registro_exitoso"]
-
-if submit:
-    # Validar que ningún operario ya tenga un registro ese día
-    for op in operarios_merma:
-        if op["codigo"] != "":
-            registros_existentes = df_final[
-                (df_final["Código"].astype(str) == str(op["codigo"])) &
-                (df_final["Fecha"].dt.date == fecha)
-            ]
-            if not registros_existentes.empty:
-                st.warning(f"⚠️ El operario {op['codigo']} ya tiene un registro guardado para la fecha {fecha}. No se puede registrar más de una vez por día.")
-                st.stop()
-
-    for i, op in enumerate(operarios_merma, start=1):
-        if op["tiempo_retrabajo_min"] > 480:
-            st.warning(f"⚠️ Operario {i} ingresó más de 8 horas de retrabajo.")
-            st.stop()
-
-    for i, op in enumerate(operarios_merma, start=1):
-        tiene_datos_merma = (op["pieza"] != "" and op["parte"] != "" and op["cantidad_merma"] > 0)
-        tiene_datos_retrabajo = (op["molde_retrabajo"] != "" or op["linea_retrabajo"] != "" or op["tiempo_retrabajo_min"] > 0)
-
-        if op["codigo"] and op["tiempo_retrabajo_min"] > 480 and (tiene_datos_merma or tiene_datos_retrabajo):
-            st.warning(f"⚠️ El ingreso es más de 8 horas. No se permite superar las 8 horas.")
-            st.stop()
-
-    for i, op in enumerate(operarios_merma, start=1):
-        # Validación para evitar datos incompletos en piezas mal hechas
-        campos_llenos = any([
-            op["parte"],
-            op["cantidad_merma"] > 0,
-            op["molde_retrabajo"],
-            op["linea_retrabajo"],
-            op["tiempo_retrabajo_min"] > 0
-        ])
-        if op["codigo"] and not campos_llenos:
-            continue
-        if not op["codigo"] and not campos_llenos:
-            continue
-        if campos_llenos and not op["codigo"]:
-            st.warning(f"⚠️ El Operario {i} ingresó datos sin seleccionar un código.")
-            st.stop()
-        if (op["parte"] == "" and op["cantidad_merma"] > 0) or (op["parte"] != "" and op["cantidad_merma"] == 0):
-            st.warning(f"⚠️ El Operario {i} tiene datos incompletos en piezas mal hechas.")
-            st.stop()
-
-        # NUEVA VALIDACIÓN PARA INFORME DE RETRABAJO
-        molde_retrabajo = op["molde_retrabajo"]
-        linea_retrabajo = op["linea_retrabajo"]
-        tiempo_retrabajo_min = op["tiempo_retrabajo_min"]
-
-        if molde_retrabajo != "":
-            if linea_retrabajo == "" or tiempo_retrabajo_min == 0:
-                st.warning(f"⚠️ El Operario {i} tiene datos incompletos en Molde Retrabajo.")
-                st.stop()
-
-        if (linea_retrabajo != "" or tiempo_retrabajo_min > 0) and molde_retrabajo == "":
-            st.warning(f"⚠️ El Operario {i} tiene datos incompletos en Molde Retrabajo.")
-            st.stop()
-
-    if cantidad_total == 0:
-        st.warning("⚠️ La cantidad total producida no puede ser 0. Por favor, ingresa un valor mayor a cero para continuar.")
-    else:
-        suma_merma = sum(op["cantidad_merma"] for op in operarios_merma)
-        if suma_merma > cantidad_total:
-            st.warning(f"⚠️ La suma total de piezas mal hechas ({suma_merma}) supera la cantidad producida ({cantidad_total}). Verifica los datos.")
-            st.stop()
-
-        ahora = datetime.now()
-        fecha_dt = datetime.combine(fecha, ahora.time())
-
-        operadores = [op["codigo"] for op in operarios_merma if op["codigo"] != ""]
-        hora = obtener_hora_molde(molde, base_produccion)
-
-        fila_molde = base_produccion[base_produccion["COD MAT"].astype(str).str.strip().str.upper() == molde.strip().upper()]
-        max_moldes = fila_molde.iloc[0]["MOLDES/TURNO"] if not fila_molde.empty else None
-
-        if fecha is None:
-            st.warning("⚠️ Debes ingresar la fecha.")
-        elif molde == "":
-            st.warning("⚠️ Debes seleccionar un molde.")
-        elif fecha > datetime.now().date():
-            st.warning("⚠️ La fecha no puede ser superior a hoy.")
-        elif len(operadores) == 0:
-            st.warning("⚠️ Debes ingresar al menos un código de operario.")
-        elif len(operadores) != len(set(operadores)):
-            st.warning("⚠️ No puede haber operarios con el mismo código.")
-        elif max_moldes is not None and cantidad_total > max_moldes:
-            st.warning(f"⚠️ La cantidad supera el máximo permitido para el molde: {max_moldes}")
-        elif hora is None:
-            st.warning("⚠️ No se pudo calcular la hora por molde.")
-        else:
-            moldes_persona = cantidad_total / len(operadores)
-            tiempo_usado = moldes_persona * hora
-            indicador = round((tiempo_usado / 8) * 100, 1)
-
-            if indicador > 100:
-                st.warning("⚠️ Indicador supera el 100% por operario.")
-            else:
-                registros = []
-                for op in operarios_merma:
-                    if op["codigo"] != "":
-                        tiempo_merma = 0.0
-                        cantidad_kg = 0.0
-
-                        pieza_clean = str(op["pieza"]).strip().upper()
-                        parte_clean = str(op["parte"]).strip().upper()
-
-                        df_tiempo_fallas = tiempo_fallas.copy()
-                        df_tiempo_fallas["CODIGO"] = df_tiempo_fallas["CODIGO"].astype(str).str.strip().str.upper()
-                        df_tiempo_fallas["PARTE MOLDE"] = df_tiempo_fallas["PARTE MOLDE"].astype(str).str.strip().str.upper()
-
-                        fila_kg = df_tiempo_fallas[
-                            (df_tiempo_fallas["CODIGO"] == pieza_clean) &
-                            (df_tiempo_fallas["PARTE MOLDE"] == parte_clean)
-                        ]
-
-                        if not fila_kg.empty:
-                            try:
-                                kg_unitario = float(fila_kg.iloc[0]["CANTIDAD KG"])
-                                cantidad_kg = kg_unitario * op["cantidad_merma"]
-                            except:
-                                cantidad_kg = 0.0
-
-                            try:
-                                tiempo_unitario = float(fila_kg.iloc[0]["TIEMPO (MIN)"])
-                                tiempo_merma = tiempo_unitario * op["cantidad_merma"]
-                            except:
-                                tiempo_merma = 0.0
-
-                        pieza_final = op["pieza"]
-                        if op["parte"] == "" or op["cantidad_merma"] == 0:
-                            pieza_final = None
-
-                        registros.append({
-                            "Fecha": fecha_dt,
-                            "Molde": molde,
-                            "Moldes/Persona": round(moldes_persona, 2),
-                            "Código": op["codigo"],
-                            "Nombre": obtener_nombre(op["codigo"], operarios),
-                            "Tiempo Usado": round(tiempo_usado, 2),
-                            "Indicador de Producción": f"{indicador}%",
-                            "Pieza": pieza_final,
-                            "Parte": op["parte"],
-                            "Cantidad": op["cantidad_merma"],
-                            "Cantidad KG": cantidad_kg,
-                            "Tiempo en Minutos": round(tiempo_merma, 2),
-                            "Indicador de Tiempo": f"{round((tiempo_merma / 480) * 100, 2)}%",
-                            "Molde Retrabajo": op["molde_retrabajo"],
-                            "Linea Retrabajo": op["linea_retrabajo"],
-                            "Tiempo Retrabajo (minutos)": op["tiempo_retrabajo_min"],
-                            "Indicador Retrabajo": f"{op['indicador_retrabajo']}%"
-                        })
-
-                df_final = pd.DataFrame(registros)
+                st.markdown("##### 🔄 Informe de Retrabajo")
+                colr1, colr2, colr3 = st.columns([3, 3, 4])
 
-                try:
-                    if os.path.exists(ruta_archivo):
-                        libro = load_workbook(ruta_archivo)
-                        if "FINAL" in libro.sheetnames:
-                            existente = pd.read_excel(ruta_archivo, sheet_name="FINAL")
-                            df_final = pd.concat([existente, df_final], ignore_index=True)
-
-                    with pd.ExcelWriter(ruta_archivo, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                        df_final.to_excel(writer, sheet_name="FINAL", index=False)
-                    st.session_state["registro_exitoso"] = True
-                    st.rerun()
-
-                except Exception as e:
-                    st.error(f"❌ Error al guardar: {e}")
+                with colr1:
+                    molde_retra_default = st.session_state.get(f"molde_retrabajo_{i}", molde)
+                    molde_retrabajo = st.selectbox(
+                        f"Molde Retrabajo",
+                        options=opciones.moldes.valores,
+                        index=opciones.moldes.posicion.get(molde_retra_default, 0),
+                        key=f"molde_retrabajo_{i}"
+                    )
 
+                with colr2:
+                    linea_default = st.session_state.get(f"linea_retrabajo_{i}", "")
+                    linea_retrabajo = st.selectbox(
+                        "Línea",
+                        options=opciones.lineas.valores,
+                        index=opciones.lineas.posicion.get(linea_default, 0),
+                        key=f"linea_retrabajo_{i}"
+                    )
 
-# Función para cargar y ordenar los registros por fecha descendente
-def cargar_final_ordenado(ruta):
-    try:
-        df = pd.read_excel(ruta, sheet_name="FINAL")
-        if not pd.api.types.is_datetime64_any_dtype(df['Fecha']):
-            df['Fecha'] = pd.to_datetime(df['Fecha'], errors='coerce')
-        return df.sort_values(by="Fecha", ascending=False).reset_index(drop=True)
-    except Exception as e:
-        st.error(f"No se pudo cargar la hoja FINAL: {e}")
-        return pd.DataFrame()
+                with colr3:
+                    col_horas, col_minutos = st.columns([1, 1])
+                    with col_horas:
+                        horas_retrabajo = st.number_input(
+                            "Horas",
+                            min_value=0,
+                            max_value=8,
+                            value=st.session_state.get(f"horas_retrabajo_{i}", 0),
+                            step=1,
+                            key=f"horas_retrabajo_{i}"
+                        )
+                    with col_minutos:
+                        minutos_retrabajo = st.number_input(
+                            "Minutos",
+                            min_value=0,
+                            max_value=59,
+                            value=st.session_state.get(f"minutos_retrabajo_{i}", 0),
+                            step=1,
+                            key=f"minutos_retrabajo_{i}"
+                        )
+
+            tiempo_retrabajo_total = horas_retrabajo * 60 + minutos_retrabajo
+
+            operarios_merma.append({
+                "Posición": i,
+                "Código": op_codigo,
+                "Pieza": pieza,
+                "Parte": parte,
+                "Cantidad": cantidad_input,
+                "Molde Retrabajo": molde_retrabajo,
+                "Linea Retrabajo": linea_retrabajo,
+                "Tiempo Retrabajo (minutos)": tiempo_retrabajo_total,
+            })
+
+        submit = st.form_submit_button("✅ Guardar Registro de Producción")
+
+    metricas.sumar_fase("formulario", inicio_fase)
+
+    if st.button("🧹 Limpiar Formulario"):
+        # Guardamos una bandera para activar el scroll
+        st.session_state["__desplazar_temp"] = True
+
+        # Guardamos claves que queremos conservar
+        claves_conservar = ["__desplazar_temp"]
+
+        # Borramos todas las demás claves (formulario completo)
+        claves_a_borrar = [clave for clave in st.session_state.keys() if clave not in claves_conservar]
+        for clave in claves_a_borrar:
+            del st.session_state[clave]
+
+        terminar_medicion()
+        st.rerun()
+
+    if st.session_state.get("registro_exitoso", False):
+        st.success("✅ Registro guardado con éxito.")
+        del st.session_state["registro_exitoso"]
+
+    if submit:
+        # Las reglas del formulario viven en reglas.py y son las mismas de la carga por lotes (ingesta.py)
+        with metricas.fase("validacion"):
+            filas_envio = preparar_filas(pd.DataFrame(operarios_merma).assign(
+                **{"Envío": 0, "Fecha": fecha, "Molde": molde, "Cantidad Total": cantidad_total}
+            ))
+            motivo = validar_envios(
+                filas_envio, indices, almacen.registrados(), date.today(), almacen.meses_cerrados()
+            ).iloc[0]
+
+        if motivo is not None:
+            st.warning(motivo)
+        else:
+            df_nuevos = calcular_registros(filas_envio, indices, datetime.now())
+
+            def verificar(registrados):
+                # Otra sesión pudo guardar al mismo operario y día desde la validación de arriba:
+                # las reglas se repiten bajo el candado, contra lo que ya está guardado
+                return validar_envios(
+                    filas_envio, indices, registrados, date.today(), almacen.meses_cerrados()
+                ).iloc[0]
+
+            try:
+                # Solo se agregan las filas nuevas; el resto del libro no se reescribe.
+                # La escritura pasa por la cola única y se espera a que el lote quede guardado.
+                with metricas.fase("guardar"):
+                    escritor.agregar(df_nuevos, verificar=verificar).result(timeout=120)
+                st.session_state["registro_exitoso"] = True
+                terminar_medicion(guardado=len(df_nuevos))
+                st.rerun()
+
+            except EnvioRechazado as e:
+                st.warning(str(e))
+            except EsperaAgotada:
+                # La cola sigue ocupada: el envío no se perdió y se guardará cuando le toque
+                st.warning("⏳ El guardado sigue pendiente en la cola de escritura. No vuelvas a enviar el formulario; el registro aparecerá en la tabla cuando termine.")
+            except Exception as e:
+                st.error(f"❌ Error al guardar: {e}")
 
 # Mostrar tabla FINAL y eliminar registros
-try:
-    df_final = cargar_final_ordenado(ruta_archivo)
+@seccion
+def seccion_registros():
+    datos = cargar_datos()
+    if datos is None:
+        return
 
-    if not df_final.empty:
+    inicio_fase = time.perf_counter()
+    try:
         st.header("📊 REGISTROS DE PRODUCCIÓN")
-        st.dataframe(df_final)
 
-        st.subheader("🗑️ Eliminar Registro")
-        df_final["RESUMEN"] = df_final.apply(lambda row: f"{row['Fecha']} | {row['Código']}", axis=1)
-        indices = df_final.index.tolist()
-        opciones = [f"{i} - {df_final.at[i, 'RESUMEN']}" for i in indices]
-
-        seleccion = st.selectbox("Selecciona el registro a eliminar", options=opciones)
-        index_a_eliminar = int(seleccion.split(" - ")[0])
-
-        if st.button("Eliminar registro seleccionado"):
-            # Obtener la fecha y hora exacta del registro seleccionado
-            fecha_objetivo = df_final.at[index_a_eliminar, "Fecha"]
+        # Filtros, orden y paginación se aplican en el servidor; al navegador solo va la página visible
+        colr1, colr2, colr3, colr4 = st.columns(4)
+        with colr1:
+            registros_desde = st.date_input("📆 Desde", value=None, key="registros_desde")
+        with colr2:
+            registros_hasta = st.date_input("📆 Hasta", value=None, key="registros_hasta")
+        with colr3:
+            registros_codigo = st.text_input("👷 Código de operario", key="registros_codigo").strip()
+        with colr4:
+            registros_molde = st.selectbox("Molde", options=datos.opciones.moldes.valores, key="registros_molde")
+
+        colp1, colp2, colp3 = st.columns(3)
+        with colp1:
+            registros_orden = st.selectbox("Ordenar por", options=COLUMNAS_FINAL, key="registros_orden")
+        with colp2:
+            registros_descendente = st.checkbox("Descendente", value=True, key="registros_descendente")
+        with colp3:
+            tamano_pagina = st.selectbox("Filas por página", options=[25, 50, 100, 200], key="registros_tamano")
+
+        filtros_registros = {
+            "desde": registros_desde,
+            "hasta": registros_hasta,
+            "codigo": registros_codigo,
+            "molde": registros_molde,
+        }
+        numero_pagina = st.session_state.get("registros_pagina", 1)
+        df_pagina, total_registros = almacen.pagina(
+            (numero_pagina - 1) * tamano_pagina, tamano_pagina, registros_orden, registros_descendente, **filtros_registros
+        )
+        total_paginas = max(1, -(-total_registros // tamano_pagina))
+        if numero_pagina > total_paginas:
+            # Los filtros cambiaron y la página guardada ya no existe
+            numero_pagina = st.session_state["registros_pagina"] = 1
+            df_pagina, total_registros = almacen.pagina(
+                0, tamano_pagina, registros_orden, registros_descendente, **filtros_registros
+            )
 
-            # Filtrar todos los registros con la misma fecha y hora exacta
-            df_final = df_final[df_final["Fecha"] != fecha_objetivo].reset_index(drop=True)
+        if total_registros == 0:
+            if any(filtros_registros.values()):
+                st.warning("No se encontraron registros con los filtros aplicados.")
+            else:
+                st.info("ℹ️ No hay registros en la hoja 'FINAL'.")
+        else:
+            with metricas.fase("tabla_registros"):
+                st.dataframe(df_pagina, column_config=formato_indicadores)
+            colpag1, colpag2 = st.columns([1, 3])
+            with colpag1:
+                st.number_input("Página", min_value=1, max_value=total_paginas, step=1, key="registros_pagina")
+            with colpag2:
+                st.caption(f"{total_registros} registros · página {numero_pagina} de {total_paginas}")
 
-            # Guardar nuevamente el archivo sin los registros eliminados
-            with pd.ExcelWriter(ruta_archivo, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                df_final.drop(columns=["RESUMEN"]).to_excel(writer, sheet_name="FINAL", index=False)
+        st.subheader("🗑️ Eliminar Registro")
+        # Primero se busca por día (y opcionalmente operario); luego se elige el envío a eliminar
+        cole1, cole2 = st.columns(2)
+        with cole1:
+            eliminar_dia = st.date_input("📆 Fecha del registro", value=date.today(), max_value=date.today(), key="eliminar_dia")
+        with cole2:
+            eliminar_codigo = st.text_input("👷 Código de operario (opcional)", key="eliminar_codigo").strip()
+
+        envios = almacen.envios(eliminar_dia, eliminar_codigo)
+        if envios.empty:
+            st.info("ℹ️ No hay registros para esa búsqueda.")
+        else:
+            resumen_envios = {
+                id_envio: f"{fecha_envio} | {molde_envio} | {codigos_envio}"
+                for id_envio, fecha_envio, molde_envio, codigos_envio in zip(
+                    envios[COLUMNA_ID], envios["Fecha"], envios["Molde"], envios["Códigos"]
+                )
+            }
+            id_objetivo = st.selectbox(
+                "Selecciona el registro a eliminar",
+                options=list(resumen_envios),
+                format_func=resumen_envios.get,
+            )
 
-            st.success(f"✅ Todos los registros con fecha {fecha_objetivo} fueron eliminados correctamente.")
-            st.session_state.pop("activar_filtro", None)
-            st.rerun()
-    else:
-        st.info("ℹ️ No hay registros en la hoja 'FINAL'.")
-except Exception as e:
-    st.error(f"❌ Error mostrando registros: {e}")
+            if st.button("Eliminar registro seleccionado"):
+                # Se eliminan todas las filas del envío; el almacén solo anota su ID
+                try:
+                    with metricas.fase("eliminar"):
+                        escritor.eliminar_envio(id_objetivo).result(timeout=120)
+                except EsperaAgotada:
+                    st.warning(f"⏳ La eliminación del envío {resumen_envios[id_objetivo]} sigue pendiente en la cola de escritura; se aplicará cuando termine.")
+                else:
+                    st.success(f"✅ Todos los registros del envío {resumen_envios[id_objetivo]} fueron eliminados correctamente.")
+                    st.session_state.pop("activar_filtro", None)
+                    metricas.sumar_fase("registros", inicio_fase)
+                    terminar_medicion(eliminado=True)
+                    st.rerun()
+    except Exception as e:
+        st.error(f"❌ Error mostrando registros: {e}")
+    metricas.sumar_fase("registros", inicio_fase)
 
 # 🔍 Buscador de Producción Final
-st.header("🔍 Buscador de Producción Real")
-
-def cargar_datos_final(ruta):
-    try:
-        df = pd.read_excel(ruta, sheet_name="FINAL")
-        return df
-    except Exception as e:
-        st.error(f"No se pudo cargar la hoja FINAL: {e}")
-        return pd.DataFrame()
+@seccion
+def seccion_buscador():
+    inicio_fase = time.perf_counter()
+    st.header("🔍 Buscador de Producción Real")
 
-df_final = cargar_datos_final(ruta_archivo)
+    if not almacen.hay_registros():
+        st.info("No hay datos en la hoja FINAL para mostrar.")
+    else:
+        activar_filtro = st.checkbox("🔍 Aplicar filtro por fecha y código", key="activar_filtro")
+
+        fecha_inicio = None
+        fecha_fin = None
+        cod_operario_buscar = ""
+        filtros_validos = True
+        mostrar_tabla = False
+
+        if activar_filtro:
+            colf1, colf2 = st.columns(2)
+            with colf1:
+                fecha_inicio = st.date_input("📆 Fecha inicial", key="buscar_fecha_inicio")
+            with colf2:
+                fecha_fin = st.date_input("📆 Fecha final", key="buscar_fecha_fin")
+
+            if fecha_inicio > fecha_fin:
+                st.warning("⚠️ La fecha inicial no puede ser mayor que la fecha final.")
+                filtros_validos = False
+            else:
+                # Solo se leen los registros del rango de fechas, no todo el historial
+                df_rango = cargar_final(fecha_inicio, fecha_fin)
+                codigos_disponibles = df_rango["Código"].dropna().astype(str).unique().tolist() if not df_rango.empty else []
+                cod_operario_buscar = st.selectbox("👷 Código de operario", options=[""] + codigos_disponibles, key="buscar_codigo")
 
-if df_final.empty:
-    st.info("No hay datos en la hoja FINAL para mostrar.")
-else:
-    if not pd.api.types.is_datetime64_any_dtype(df_final['Fecha']):
-        df_final['Fecha'] = pd.to_datetime(df_final['Fecha'], errors='coerce')
+                if fecha_inicio and fecha_fin and cod_operario_buscar != "":
+                    mostrar_tabla = True
+        else:
+            mostrar_tabla = True
 
-    codigos_disponibles = df_final["Código"].dropna().astype(str).unique().tolist()
-    activar_filtro = st.checkbox("🔍 Aplicar filtro por fecha y código", key="activar_filtro")
+        columnas_mostrar = COLUMNAS_RESULTADOS
 
-    fecha_inicio = None
-    fecha_fin = None
-    cod_operario_buscar = ""
-    filtros_validos = True
-    mostrar_tabla = False
+        if mostrar_tabla:
+            if activar_filtro and filtros_validos:
+                df_filtrado = df_rango[df_rango["Código"].astype(str) == cod_operario_buscar]
+            else:
+                # Solo las columnas de la tabla; sin caché se leen de la instantánea columnar
+                df_filtrado = cargar_final(columnas=[col for col in columnas_mostrar if col in COLUMNAS_FINAL])
 
-    df_filtrado = df_final.copy()
+            df_filtrado = df_filtrado.sort_values(by="Fecha", ascending=False)
 
-    if activar_filtro:
-        colf1, colf2 = st.columns(2)
-        with colf1:
-            fecha_inicio = st.date_input("📆 Fecha inicial", key="buscar_fecha_inicio")
-        with colf2:
-            fecha_fin = st.date_input("📆 Fecha final", key="buscar_fecha_fin")
+            if df_filtrado.empty:
+                st.warning("No se encontraron registros con los filtros aplicados.")
+            else:
+                df_filtrado = produccion_real(df_filtrado)
+
+                columnas_mostrar = [col for col in columnas_mostrar if col in df_filtrado.columns]
+
+                st.header("📊 Resultados de Producción Real Trabajada")
+                with metricas.fase("tabla_resultados"):
+                    st.dataframe(df_filtrado[columnas_mostrar].reset_index(drop=True), column_config=formato_indicadores)
+
+                # La descarga se genera recién al pulsar el botón, en otro hilo, leyendo el almacén por bloques
+                filtro_exportar = (fecha_inicio, fecha_fin, cod_operario_buscar) if activar_filtro else (None, None, None)
+                colx1, colx2 = st.columns([1, 3])
+                with colx1:
+                    formato_exportar = st.selectbox("Formato", options=list(FORMATOS), key="exportar_formato")
+                with colx2:
+                    st.markdown("#### ")
+                    st.download_button(
+                        "⬇️ Descargar resultados",
+                        data=lambda: exportar(almacen, formato_exportar, *filtro_exportar),
+                        file_name=f"produccion_real_{date.today():%Y%m%d}.{formato_exportar}",
+                        mime=FORMATOS[formato_exportar],
+                        on_click="ignore",
+                    )
 
-        if fecha_inicio > fecha_fin:
-            st.warning("⚠️ La fecha inicial no puede ser mayor que la fecha final.")
-            filtros_validos = False
-        else:
-            cod_operario_buscar = st.selectbox("👷 Código de operario", options=[""] + codigos_disponibles, key="buscar_codigo")
+                # Aquí calculamos y mostramos el promedio simple y el porcentaje ponderado real trabajado.
+                # Se leen las filas del agregado (operario, día, molde), no los registros del historial.
+                if activar_filtro and not df_filtrado.empty:
+                    resumen = resumir_agregado(almacen.agregado(fecha_inicio, fecha_fin, cod_operario_buscar)).iloc[0]
+                    promedio_simple = resumen["Promedio Real (%)"]
+                    porcentaje_ponderado = resumen["Ponderado Real (%)"]
 
-            if fecha_inicio and fecha_fin and cod_operario_buscar != "":
-                mostrar_tabla = True
-    else:
-        mostrar_tabla = True
+                    st.markdown(f"### ✅ Promedio Producción Real Trabajada: **{promedio_simple:.2f}%**")
+                    st.markdown(f"### ⚖️ Porcentaje Ponderado Real Trabajado: **{porcentaje_ponderado:.2f}%** "
+                                f"({resumen['Horas Reales']:.2f} h en {resumen['Días']} días)")
 
-    if mostrar_tabla:
         if activar_filtro and filtros_validos:
-            df_filtrado = df_filtrado[
-                (df_filtrado['Fecha'].dt.date >= fecha_inicio) &
-                (df_filtrado['Fecha'].dt.date <= fecha_fin) &
-                (df_filtrado["Código"].astype(str) == cod_operario_buscar)
-            ]
-
-        df_filtrado = df_filtrado.sort_values(by="Fecha", ascending=False)
-
-        if df_filtrado.empty:
-            st.warning("No se encontraron registros con los filtros aplicados.")
+            with st.expander("📅 Resumen por operario y mes"):
+                agregado_rango = almacen.agregado(fecha_inicio, fecha_fin, cod_operario_buscar)
+                if agregado_rango.empty:
+                    st.info("No hay registros en el rango seleccionado.")
+                else:
+                    formato_resumen = {
+                        "Promedio Real (%)": st.column_config.NumberColumn(format="%.2f%%"),
+                        "Ponderado Real (%)": st.column_config.NumberColumn(format="%.2f%%"),
+                        "Horas Reales": st.column_config.NumberColumn(format="%.2f"),
+                    }
+                    st.dataframe(resumir_agregado(agregado_rango, ["Código", "Mes"]), column_config=formato_resumen, hide_index=True)
+                    st.dataframe(resumir_agregado(agregado_rango, ["Código"]), column_config=formato_resumen, hide_index=True)
+
+    metricas.sumar_fase("buscador", inicio_fase)
+
+# Panel de rendimiento para administración: ?admin=1 en la URL o YESERIA_ADMIN=1
+def panel_administracion():
+    with st.expander("⏱️ Rendimiento"):
+        actual = medicion_rerun.como_dict()
+        st.caption(f"Este rerun hasta aquí: {actual['total_s']:.3f} s")
+        colm1, colm2, colm3 = st.columns(3)
+        with colm1:
+            st.dataframe(pd.Series(actual["fases"], name="Segundos", dtype=float), column_config={"Segundos": st.column_config.NumberColumn(format="%.3f")})
+        with colm2:
+            st.dataframe(pd.Series(actual["io"], name="E/S", dtype="Int64"))
+        with colm3:
+            st.dataframe(pd.Series(actual["cache"], name="Caché", dtype="Int64"))
+        st.caption(f"p50/p95 de las últimas mediciones en {metricas.RUTA_LOG}")
+        st.dataframe(metricas.percentiles(metricas.leer_log()), hide_index=True)
+
+    with st.expander("🔎 Calidad del historial"):
+        # Se muestra el último reporte guardado; la revisión (solo de los meses que cambiaron)
+        # corre en segundo plano cuando se pide, no en cada rerun
+        hallazgos, generado, al_dia = calidad.reporte(almacen)
+        if calidad.escaneo_en_curso(almacen):
+            st.caption("Revisión en curso; el reporte se actualiza al terminar.")
+        elif not al_dia and st.button("🔎 Revisar los cambios"):
+            calidad.escanear_en_segundo_plano(almacen)
+            st.caption("Revisión en curso; el reporte se actualiza al terminar.")
+        if generado is None:
+            st.info("Todavía no hay un reporte de calidad.")
         else:
-            def parse_percent(valor):
-                if isinstance(valor, str) and valor.endswith('%'):
-                    return float(valor.strip('%'))
-                try:
-                    return float(valor)
-                except:
-                    return 0.0
-
-            df_filtrado['Indicador Producción (%)'] = df_filtrado['Indicador de Producción'].apply(parse_percent)
-            df_filtrado['Indicador Tiempo (%)'] = df_filtrado['Indicador de Tiempo'].apply(parse_percent)
-            df_filtrado['Indicador Retrabajo (%)'] = df_filtrado['Indicador Retrabajo'].apply(parse_percent)
-
-            df_filtrado['Producción Real Trabajada Num'] = (
-                df_filtrado['Indicador Producción (%)']
-                - df_filtrado['Indicador Tiempo (%)']
-                - df_filtrado['Indicador Retrabajo (%)']
-            )
-
-            df_filtrado['Producción Real Trabajada'] = df_filtrado['Producción Real Trabajada Num'].apply(lambda x: f"{x:.2f}%")
-
-            columnas_mostrar = [
-                'Fecha', 'Molde', 'Moldes/Persona', 'Código', 'Nombre',
-                'Cantidad', 'Indicador de Producción', 'Indicador de Tiempo',
-                'Indicador Retrabajo','Producción Real Trabajada'
-            ]
-            columnas_mostrar = [col for col in columnas_mostrar if col in df_filtrado.columns]
-
-            st.header("📊 Resultados de Producción Real Trabajada")
-            st.dataframe(df_filtrado[columnas_mostrar].reset_index(drop=True))
-
-            # Aquí calculamos y mostramos el promedio simple y el porcentaje ponderado real trabajado
-            # Aquí calculamos y mostramos el promedio simple y el porcentaje ponderado real trabajado
-            if activar_filtro and not df_filtrado.empty:
-                dias_unicos = df_filtrado['Fecha'].dt.date.nunique()
-                promedio_simple = df_filtrado['Producción Real Trabajada Num'].mean()
-                horas_trabajadas_reales = (df_filtrado['Producción Real Trabajada Num'] / 100 * 8).sum()
-                horas_posibles = dias_unicos * 8
-                porcentaje_ponderado = (horas_trabajadas_reales / horas_posibles) * 100
-
-                st.markdown(f"### ✅ Promedio Producción Real Trabajada: **{promedio_simple:.2f}%**")
+            st.caption(f"Reporte del {generado}" + ("" if al_dia else " (hay registros posteriores)"))
+            if hallazgos.empty:
+                st.success("Sin hallazgos en el historial.")
+            else:
+                st.dataframe(hallazgos.groupby("Descripción").size().rename("Hallazgos"))
+                st.dataframe(hallazgos, hide_index=True)
+
+    with st.expander("🧹 Envíos eliminados"):
+        # La compactación reescribe todo el historial y no corre desde la app: bloquearía la cola
+        # de escritura mientras dura. Se lanza a mano fuera del horario de carga.
+        bajas = len(almacen.bajas())
+        st.caption(f"{bajas} envíos eliminados siguen físicamente en el almacén.")
+        if almacen.requiere_compactacion():
+            st.warning("Conviene compactar el almacén fuera del horario de carga: python almacenamiento.py compactar")
+
+# Un rerun cortado (st.rerun, st.stop, una excepción o una interacción nueva) también cierra su
+# medición y la quita del hilo: si quedara, los reruns parciales de las secciones se sumarían a ella
+try:
+    seccion_formulario()
+    seccion_registros()
+    seccion_buscador()
+    if st.query_params.get("admin") == "1" or os.environ.get("YESERIA_ADMIN") == "1":
+        panel_administracion()
+finally:
+    metricas.terminar(medicion_rerun)
@@ -0,0 +1,227 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from almacenamiento import COLUMNAS_FINAL, nuevo_id_envio
+from indices import partes_validas
+
+# Reglas de validación y cálculo de un envío del formulario, compartidas por programa.py y
+# por la carga por lotes (ingesta.py). Trabajan sobre un DataFrame con una fila por operario;
+# "Envío" agrupa las filas que se guardan juntas y "Posición" es el número de operario (1..n).
+
+COLUMNAS_TEXTO = ["Código", "Molde", "Pieza", "Parte", "Molde Retrabajo", "Linea Retrabajo"]
+COLUMNAS_NUMERO = ["Cantidad Total", "Cantidad", "Tiempo Retrabajo (minutos)"]
+
+MINUTOS_TURNO = 480
+
+# Fechas aceptadas: ISO (2026-07-05, con o sin hora, o la fecha de una celda de Excel) o
+# día/mes/año (05/07/2026). Nunca mes/día: 05/07 es siempre 5 de julio.
+FORMATO_FECHA_DIA = "%d/%m/%Y"
+
+
+def preparar_filas(filas):
+    df = filas.copy()
+    if "Pieza" not in df.columns:
+        df["Pieza"] = df["Molde"]
+    for columna in COLUMNAS_TEXTO:
+        df[columna] = df[columna].fillna("").astype(str).str.strip()
+    for columna in COLUMNAS_NUMERO:
+        df[columna] = pd.to_numeric(df[columna], errors="coerce").fillna(0)
+    fecha = df["Fecha"].astype(object)
+    leida = pd.to_datetime(fecha, format="ISO8601", errors="coerce")
+    leida = leida.fillna(pd.to_datetime(fecha.where(leida.isna()), format=FORMATO_FECHA_DIA, errors="coerce"))
+    # Una fecha escrita que no tiene ninguno de los dos formatos se rechaza, no se adivina
+    vacia = fecha.isna() | (fecha.astype(str).str.strip() == "")
+    df["Fecha Inválida"] = leida.isna() & ~vacia
+    df["Fecha"] = leida.dt.date
+    if "Envío" not in df.columns:
+        # Sin columna de envío, las filas consecutivas con la misma fecha, molde y cantidad van juntas
+        clave = df[["Fecha", "Molde", "Cantidad Total"]].fillna("").astype(str).agg("|".join, axis=1)
+        df["Envío"] = (clave != clave.shift()).cumsum()
+    if "Posición" not in df.columns:
+        df["Posición"] = df.groupby("Envío").cumcount() + 1
+    return df
+
+
+def _normalizada(serie):
+    return serie.astype(str).str.strip().str.upper()
+
+
+def _primer_motivo(df, mascara, mensaje):
+    # Mensaje de la primera fila que incumple la regla, por envío
+    primeras = df[mascara].groupby("Envío").head(1)
+    return pd.Series([mensaje(fila) for fila in primeras.to_dict("records")], index=primeras["Envío"], dtype=object)
+
+
+def _datos_molde(molde, indices):
+    return indices.moldes.get(str(molde).strip().upper())
+
+
+def validar_envios(filas, indices, registrados, hoy, meses_cerrados=()):
+    # Devuelve, por envío, el primer motivo de rechazo (None si el envío es válido).
+    # El orden de las reglas es el mismo en que el formulario muestra las advertencias.
+    # meses_cerrados: meses ("%Y-%m") cuyo historial ya no admite registros nuevos.
+    df = filas
+    con_codigo = df["Código"] != ""
+    envios = df.groupby("Envío", sort=False).agg(
+        Fecha=("Fecha", "first"), Fecha_Invalida=("Fecha Inválida", "any"), Molde=("Molde", "first"),
+        Cantidad_Total=("Cantidad Total", "first"), Suma_Merma=("Cantidad", "sum"),
+    )
+    motivos = pd.Series(None, index=envios.index, dtype=object)
+
+    def aplicar(nuevos):
+        nonlocal motivos
+        motivos = motivos.combine_first(nuevos.reindex(motivos.index))
+
+    # Solo operarios que existen en la hoja Operarios
+    aplicar(_primer_motivo(
+        df, con_codigo & ~df["Código"].isin(indices.nombres),
+        lambda f: f"⚠️ El código {f['Código']} no está en la lista de operarios.",
+    ))
+
+    # Un registro por operario y día, contra lo ya guardado y contra envíos anteriores del mismo lote
+    ya_guardado = pd.Series(
+        [registrados[(codigo, fecha)] > 0 for codigo, fecha in zip(df["Código"], df["Fecha"])], index=df.index
+    )
+    pares = df[con_codigo].drop_duplicates(["Envío", "Código", "Fecha"])
+    repetido_lote = pares.duplicated(["Código", "Fecha"]).reindex(df.index, fill_value=False)
+    aplicar(_primer_motivo(
+        df, con_codigo & (ya_guardado | repetido_lote),
+        lambda f: f"⚠️ El operario {f['Código']} ya tiene un registro guardado para la fecha {f['Fecha']}. No se puede registrar más de una vez por día.",
+    ))
+
+    tiempo = df["Tiempo Retrabajo (minutos)"]
+    aplicar(_primer_motivo(
+        df, tiempo > MINUTOS_TURNO,
+        lambda f: f"⚠️ Operario {f['Posición']} ingresó más de 8 horas de retrabajo.",
+    ))
+
+    # Datos incompletos en piezas mal hechas y en el informe de retrabajo
+    parte, cantidad = df["Parte"], df["Cantidad"]
+    molde_retrabajo, linea = df["Molde Retrabajo"], df["Linea Retrabajo"]
+    campos_llenos = (parte != "") | (cantidad > 0) | (molde_retrabajo != "") | (linea != "") | (tiempo > 0)
+    posicion = df["Posición"].astype(str)
+    # Parte, molde y línea deben ser opciones de los datos maestros, como en el formulario
+    parte_desconocida = pd.Series(
+        [p not in partes_validas(indices, m) for p, m in zip(_normalizada(parte), df["Molde"])], index=df.index
+    ) & (parte != "")
+    molde_desconocido = (molde_retrabajo != "") & ~_normalizada(molde_retrabajo).isin(indices.moldes)
+    linea_desconocida = (linea != "") & ~_normalizada(linea).isin(indices.lineas)
+    motivo_fila = pd.Series(np.select(
+        [
+            campos_llenos & ~con_codigo,
+            campos_llenos & (((parte == "") & (cantidad > 0)) | ((parte != "") & (cantidad == 0))),
+            campos_llenos & (
+                ((molde_retrabajo != "") & ((linea == "") | (tiempo == 0)))
+                | (((linea != "") | (tiempo > 0)) & (molde_retrabajo == ""))
+            ),
+            parte_desconocida,
+            molde_desconocido,
+            linea_desconocida,
+        ],
+        [
+            "⚠️ El Operario " + posicion + " ingresó datos sin seleccionar un código.",
+            "⚠️ El Operario " + posicion + " tiene datos incompletos en piezas mal hechas.",
+            "⚠️ El Operario " + posicion + " tiene datos incompletos en Molde Retrabajo.",
+            "⚠️ El Operario " + posicion + " ingresó una parte que no existe para el molde: " + parte,
+            "⚠️ El Operario " + posicion + " ingresó un molde de retrabajo que no existe: " + molde_retrabajo,
+            "⚠️ El Operario " + posicion + " ingresó una línea que no existe: " + linea,
+        ],
+        default="",
+    ), index=df.index)
+    aplicar(_primer_motivo(df.assign(_motivo=motivo_fila), motivo_fila != "", lambda f: f["_motivo"]))
+
+    total = envios["Cantidad_Total"]
+    aplicar(pd.Series(
+        "⚠️ La cantidad total producida no puede ser 0. Por favor, ingresa un valor mayor a cero para continuar.",
+        index=envios.index[total == 0], dtype=object,
+    ))
+    excede = envios[envios["Suma_Merma"] > total]
+    aplicar(pd.Series(
+        [f"⚠️ La suma total de piezas mal hechas ({s:g}) supera la cantidad producida ({t:g}). Verifica los datos."
+         for s, t in zip(excede["Suma_Merma"], excede["Cantidad_Total"])],
+        index=excede.index, dtype=object,
+    ))
+
+    codigos = df[con_codigo].groupby("Envío")["Código"]
+    n_operarios = codigos.size().reindex(envios.index, fill_value=0)
+    n_unicos = codigos.nunique().reindex(envios.index, fill_value=0)
+    datos_molde = envios["Molde"].map(lambda molde: _datos_molde(molde, indices))
+    max_moldes = datos_molde.map(lambda datos: datos.moldes_turno if datos else None)
+    hora = datos_molde.map(lambda datos: datos.horas_molde if datos else None).astype(float)
+
+    fecha = envios["Fecha"]
+    condiciones = [
+        (envios["Fecha_Invalida"], lambda e: "⚠️ La fecha no es válida: usa AAAA-MM-DD o DD/MM/AAAA."),
+        (fecha.isna(), lambda e: "⚠️ Debes ingresar la fecha."),
+        (envios["Molde"] == "", lambda e: "⚠️ Debes seleccionar un molde."),
+        (fecha.map(lambda f: pd.notna(f) and f > hoy), lambda e: "⚠️ La fecha no puede ser superior a hoy."),
+        (fecha.map(lambda f: pd.notna(f) and f.strftime("%Y-%m") in meses_cerrados),
+         lambda e: f"⚠️ El mes {fecha[e]:%Y-%m} ya está cerrado; no admite registros nuevos."),
+        (n_operarios == 0, lambda e: "⚠️ Debes ingresar al menos un código de operario."),
+        (n_operarios != n_unicos, lambda e: "⚠️ No puede haber operarios con el mismo código."),
+        (max_moldes.notna() & (total > max_moldes.astype(float)),
+         lambda e: f"⚠️ La cantidad supera el máximo permitido para el molde: {max_moldes[e]}"),
+        (hora.isna(), lambda e: "⚠️ No se pudo calcular la hora por molde."),
+    ]
+    for condicion, mensaje in condiciones:
+        indice = envios.index[condicion.to_numpy(dtype=bool) & motivos.isna().to_numpy()]
+        aplicar(pd.Series([mensaje(e) for e in indice], index=indice, dtype=object))
+
+    indicador = (total / n_operarios.where(n_operarios > 0) * hora / 8 * 100).round(1)
+    aplicar(pd.Series("⚠️ Indicador supera el 100% por operario.", index=envios.index[indicador > 100], dtype=object))
+
+    return motivos.astype(object).where(motivos.notna(), None)
+
+
+def calcular_registros(filas, indices, ahora):
+    # Filas de la hoja FINAL para los envíos ya validados, calculadas para todo el lote a la vez.
+    # Cada envío recibe su ID (la eliminación lo identifica por él) y su propia marca de tiempo,
+    # separadas por 1 ms para conservar el orden de guardado. La Fecha se guarda con precisión
+    # de milisegundos, la misma que conserva el libro de Excel.
+    df = filas[filas["Código"] != ""]
+    if df.empty:
+        return pd.DataFrame(columns=COLUMNAS_FINAL)
+    ahora = ahora.replace(microsecond=ahora.microsecond // 1000 * 1000)
+
+    orden_envio = {envio: k for k, envio in enumerate(df["Envío"].unique())}
+    ids = {envio: nuevo_id_envio(fecha) for envio, fecha in zip(df["Envío"], df["Fecha"])}
+    fechas = [
+        datetime.combine(fecha, ahora.time()) + timedelta(milliseconds=orden_envio[envio])
+        for fecha, envio in zip(df["Fecha"], df["Envío"])
+    ]
+
+    horas = {molde: _datos_molde(molde, indices) for molde in df["Molde"].unique()}
+    hora = df["Molde"].map(lambda molde: horas[molde].horas_molde if horas[molde] else None).astype(float)
+    moldes_persona = df["Cantidad Total"] / df.groupby("Envío")["Código"].transform("size")
+    tiempo_usado = moldes_persona * hora
+
+    fallas = [indices.fallas.get(clave) for clave in zip(_normalizada(df["Pieza"]), _normalizada(df["Parte"]))]
+    kg_unitario = np.array([f.cantidad_kg if f is not None and f.cantidad_kg is not None else 0.0 for f in fallas])
+    minutos_unitario = np.array([f.tiempo_min if f is not None and f.tiempo_min is not None else 0.0 for f in fallas])
+    cantidad = df["Cantidad"]
+    cantidad_kg = kg_unitario * cantidad
+    tiempo_merma = minutos_unitario * cantidad
+    tiempo_retrabajo = df["Tiempo Retrabajo (minutos)"]
+
+    return pd.DataFrame({
+        "Fecha": fechas,
+        "Molde": df["Molde"],
+        "Moldes/Persona": moldes_persona.round(2),
+        "Código": df["Código"],
+        "Nombre": df["Código"].map(lambda codigo: indices.nombres.get(codigo, "NO ENCONTRADO")),
+        "Tiempo Usado": tiempo_usado.round(2),
+        "Indicador de Producción": (tiempo_usado / 8 * 100).round(1),
+        "Pieza": df["Pieza"].where((df["Parte"] != "") & (cantidad != 0), None),
+        "Parte": df["Parte"],
+        "Cantidad": cantidad,
+        "Cantidad KG": cantidad_kg,
+        "Tiempo en Minutos": tiempo_merma.round(2),
+        "Indicador de Tiempo": (tiempo_merma / MINUTOS_TURNO * 100).round(2),
+        "Molde Retrabajo": df["Molde Retrabajo"],
+        "Linea Retrabajo": df["Linea Retrabajo"],
+        "Tiempo Retrabajo (minutos)": tiempo_retrabajo,
+        "Indicador Retrabajo": (tiempo_retrabajo / MINUTOS_TURNO * 100).round(2),
+        "ID Envío": df["Envío"].map(ids),
+    }, columns=COLUMNAS_FINAL).reset_index(drop=True)